@@ -0,0 +1,131 @@
+"""JSON API (v1): sparse fieldsets and compact, row-based serialization.
+
+The /api/v1 routes (in app.py) run the same queries as the HTML pages, but
+select just the columns a client asks for and turn the rows straight into
+JSON -- no model instances in between:
+
+    GET /api/v1/users/1/likes?fields[messages]=id,text&fields[users]=username
+
+Each type's fields are columns (see FIELDS); `fields[TYPE]=a,b` picks some
+(default: all). Lists come a page at a time, newest first, with `next` the
+`?before=` cursor for the next page (or null). Messages bring their authors
+along once each, under "users", rather than repeated in every message.
+
+Responses are compact JSON, gzipped when the client accepts it and they're
+at least API_GZIP_MIN_BYTES long (API_GZIP_LEVEL=0: never).
+"""
+
+import gzip
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app, request
+
+from models import Message, User
+
+FIELDS = {
+    'messages': OrderedDict([
+        ('id', Message.id),
+        ('text', Message.text),
+        ('timestamp', Message.timestamp),
+        ('user_id', Message.user_id),
+        ('likes_count', Message.likes_count),
+        # did the viewer like it (logged in only; not a column)
+        ('liked', None),
+    ]),
+    'users': OrderedDict([
+        ('id', User.id),
+        ('username', User.username),
+        ('image_url', User.image_url),
+        ('header_image_url', User.header_image_url),
+        ('bio', User.bio),
+        ('location', User.location),
+        ('messages_count', User.messages_count),
+        ('following_count', User.following_count),
+        ('followers_count', User.followers_count),
+        ('likes_count', User.likes_count),
+    ]),
+}
+
+# what the queries need whichever fields are asked for: ids, and the
+# messages' cursor position and authors
+NEEDED = {
+    'messages': ('id', 'timestamp', 'user_id'),
+    'users': ('id', ),
+}
+
+
+class ApiError(Exception):
+    """Answered with `{"error": message}` and `status`."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def fieldset(kind):
+    """The fields of `kind` asked for with `?fields[kind]=`, in FIELDS
+    order; all of them if not asked."""
+
+    asked = request.args.get(f'fields[{kind}]')
+    if asked is None:
+        return list(FIELDS[kind])
+
+    names = {name.strip() for name in asked.split(',')} - {''}
+    unknown = names - set(FIELDS[kind])
+    if unknown:
+        raise ApiError(
+            400, f"Unknown {kind} fields: {', '.join(sorted(unknown))}")
+    return [name for name in FIELDS[kind] if name in names]
+
+
+def columns(kind, fields):
+    """Columns to select for `fields` of `kind`, plus those always NEEDED."""
+
+    names = list(fields) + [name for name in NEEDED[kind]
+                            if name not in fields]
+    return [FIELDS[kind][name] for name in names
+            if FIELDS[kind][name] is not None]
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        # stored as naive UTC
+        return value.isoformat() + 'Z'
+    return value
+
+
+def serialize(kind, rows, fields, computed=None):
+    """`[{field: value}]` for result `rows` of `kind`. `computed` maps the
+    fields that aren't columns to a function of the row; any it doesn't
+    have are left out."""
+
+    computed = computed or {}
+    fields = [name for name in fields
+              if FIELDS[kind][name] is not None or name in computed]
+    return [
+        OrderedDict(
+            (name, computed[name](row) if name in computed
+             else _value(getattr(row, name)))
+            for name in fields)
+        for row in rows
+    ]
+
+
+def response(payload, status=200):
+    """Compact JSON response for `payload`, gzipped if worth it."""
+
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    resp = current_app.response_class(
+        body, status=status, mimetype='application/json')
+    resp.vary.add('Accept-Encoding')
+
+    level = current_app.config['API_GZIP_LEVEL']
+    if (level and len(body) >= current_app.config['API_GZIP_MIN_BYTES']
+            and request.accept_encodings['gzip']):
+        resp.set_data(gzip.compress(body, level))
+        resp.headers['Content-Encoding'] = 'gzip'
+
+    return resp
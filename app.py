@@ -1,11 +1,41 @@
+import atexit
+import json
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+import api
+from api import ApiError
 from forms import UserAddForm, LoginForm, MessageForm, EditUserProfileForm, FlagForm
-from models import db, connect_db, User, Message, Like, Flag
+from fragments import FragmentCache, author_version, profile_version
+from hashing import HashingBusy, passwords
+import http_cache
+from http_cache import cache_control, conditional
+from importer import Importer
+from instrumentation import Instrumentation
+from jobs import Jobs
+import migrations
+from models import (db, connect_db, User, Message, FollowersFollowee, Like,
+                    Flag, Suggestion)
+import query_counter
+from pagination import (cursor_arg, decode_cursor, flagged_key,
+                        most_flagged, page_from, paginate_messages,
+                        paginate_users)
+from parallel import Parallel
+from push import Push, PushBusy, RESYNC, cursor_for, sse
+from query_counter import query_budget
+import query_plans
+from replicas import read_replica
+from search import Search
+from shards import Shards, plan_moves
+import suggestions
+from timeline import Timelines, entry_for, entry_key
+from trending import Trending
+from user_cache import SessionUsers
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,11 +50,198 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ.get(
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+
+# Read-only pages may read from these replicas (comma-separated URLs), unless
+# the user wrote something in the last DATABASE_REPLICA_LAG seconds; and
+# each engine's connection pool (see replicas.py)
+app.config['DATABASE_REPLICA_URLS'] = list(
+    filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))
+app.config['DATABASE_REPLICA_LAG'] = float(
+    os.environ.get('DATABASE_REPLICA_LAG', 5))
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(
+    os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_RECYCLE'] = int(
+    os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+app.config['DATABASE_POOL_PRE_PING'] = (
+    os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1')
+
+# More databases to shard messages, likes and flags over by user
+# (comma-separated URLs; the main database is shard 0), and how long each
+# worker caches which shard a user is on (see shards.py)
+app.config['SHARD_URLS'] = list(
+    filter(None, os.environ.get('SHARD_URLS', '').split(',')))
+app.config['SHARD_DIRECTORY_TTL'] = int(
+    os.environ.get('SHARD_DIRECTORY_TTL', 60))
+app.config['SHARD_WORKERS'] = int(os.environ.get('SHARD_WORKERS', 8))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Home timelines: where they live and when an account counts as a
+# "celebrity" whose messages are merged at read time instead of fanned out.
+app.config['TIMELINE_STORE_URL'] = os.environ.get(
+    'TIMELINE_STORE_URL', 'memory://')
+app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = int(
+    os.environ.get('CELEBRITY_FOLLOWER_THRESHOLD', 10000))
+
+# Page sizes for the cursor-paginated list views (see pagination.py)
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 60
+
+# Usernames allowed to use the moderation queue, comma-separated, and how
+# many flags hide a message until a moderator looks at it
+app.config['MODERATORS'] = set(
+    filter(None, os.environ.get('MODERATORS', '').split(',')))
+app.config['FLAG_HIDE_THRESHOLD'] = int(
+    os.environ.get('FLAG_HIDE_THRESHOLD', 5))
+
+# "Who to follow": how many are precomputed per user, and shown on the home
+# page (see suggestions.py)
+app.config['SUGGESTIONS_PER_USER'] = int(
+    os.environ.get('SUGGESTIONS_PER_USER', 20))
+app.config['SUGGESTIONS_SHOWN'] = 5
+
+# Trending hashtags and messages (see trending.py): the window is
+# TRENDING_WINDOW_BUCKETS buckets of TRENDING_BUCKET_SECONDS, checkpointed to
+# a file per process beside TRENDING_CHECKPOINT if set
+app.config['TRENDING_BUCKET_SECONDS'] = int(
+    os.environ.get('TRENDING_BUCKET_SECONDS', 60))
+app.config['TRENDING_WINDOW_BUCKETS'] = int(
+    os.environ.get('TRENDING_WINDOW_BUCKETS', 60))
+app.config['TRENDING_CHECKPOINT'] = os.environ.get('TRENDING_CHECKPOINT')
+app.config['TRENDING_SIZE'] = 10
+
+# Most like/unlike changes one POST /likes may make
+app.config['LIKES_BULK_MAX'] = 500
+
+# JSON API responses at least this long are gzipped, at this level, for
+# clients that accept it (0: never); see api.py
+app.config['API_GZIP_MIN_BYTES'] = int(
+    os.environ.get('API_GZIP_MIN_BYTES', 1024))
+app.config['API_GZIP_LEVEL'] = int(os.environ.get('API_GZIP_LEVEL', 6))
+
+# Live feed streams (see push.py): the broker carrying new messages between
+# workers, how many streams a worker takes, how many events one may fall
+# behind, and how often an idle one is sent a keep-alive (seconds)
+app.config['PUSH_BROKER_URL'] = os.environ.get('PUSH_BROKER_URL', 'memory://')
+app.config['PUSH_MAX_CONNECTIONS'] = int(
+    os.environ.get('PUSH_MAX_CONNECTIONS', 500))
+app.config['PUSH_SYNC_MAX_CONNECTIONS'] = int(
+    os.environ.get('PUSH_SYNC_MAX_CONNECTIONS', 0))
+app.config['PUSH_QUEUE_SIZE'] = int(os.environ.get('PUSH_QUEUE_SIZE', 64))
+app.config['PUSH_HEARTBEAT'] = float(os.environ.get('PUSH_HEARTBEAT', 15))
+
+# Logged-in user snapshots (see user_cache.py); share them between workers
+# with e.g. USER_CACHE_URL=sqlite:////tmp/warbler-users.db
+app.config['USER_CACHE_URL'] = os.environ.get('USER_CACHE_URL', 'memory://')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+
+# 'postgres', 'memory' or 'auto' (by database); see search.py
+app.config['SEARCH_ENGINE'] = os.environ.get('SEARCH_ENGINE', 'auto')
+
+# bcrypt cost, and how many hashes may run and wait at once (see hashing.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_QUEUE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE', 64))
+
+# /metrics and X-Profile need this token (if unset: localhost only); see
+# instrumentation.py
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+# Rendered message cards and profile headers kept per worker (fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 20000))
+
+# Background jobs (jobs.py): the queue, and threads per process running them
+app.config['JOB_QUEUE_URL'] = os.environ.get('JOB_QUEUE_URL', 'memory://')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE') == '1'
+
+# Load a page's independent queries at once, on this many threads (see
+# parallel.py; asgi.py turns it on unless PARALLEL_QUERIES=0), and the
+# threads the ASGI entry point runs requests on
+app.config['PARALLEL_QUERIES'] = os.environ.get('PARALLEL_QUERIES') == '1'
+app.config['PARALLEL_WORKERS'] = int(os.environ.get('PARALLEL_WORKERS', 8))
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 32))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+shards = Shards(app)
+passwords.init_app(app)
+query_counter.init_app(app)
+http_cache.init_app(app)
+metrics = Instrumentation(app)
+timelines = Timelines(app)
+session_users = SessionUsers(app)
+search_index = Search(app)
+fragment_cache = FragmentCache(app)
+jobs = Jobs(app)
+trending = Trending(app)
+atexit.register(trending.checkpoint)
+parallel = Parallel(app)
+push = Push(app)
+metrics.add_source('fragment_cache', fragment_cache.stats)
+metrics.add_source('password_hashing', passwords.stats)
+metrics.add_source('jobs', jobs.stats)
+metrics.add_source('database', db.stats)
+metrics.add_source('trending', trending.stats)
+metrics.add_source('parallel_queries', parallel.stats)
+metrics.add_source('push', push.stats)
+
+##############################################################################
+# Background jobs
+
+
+@jobs.handler('publish_messages', batched=True)
+def publish_messages(arg_lists):
+    """Fan new messages out to followers' timelines and index them, and
+    push them to open feed streams."""
+
+    for msg in republish_messages(arg_lists):
+        push.message(entry_for(msg))
+
+
+@jobs.handler('republish_messages', batched=True)
+def republish_messages(arg_lists):
+    """Fan messages out to followers' timelines and index them, without
+    pushing them (restored messages aren't new). Returns them, oldest
+    first."""
+
+    msg_ids = [msg_id for msg_id, in arg_lists]
+    msgs = shards.load_messages(msg_ids, Message.visible(), authors=False)
+    for msg_id in sorted(msgs):
+        timelines.fan_out(msgs[msg_id])
+        search_index.index_message(msgs[msg_id])
+    return [msgs[msg_id] for msg_id in sorted(msgs)]
+
+
+@jobs.handler('update_suggestions')
+def update_suggestions(user_id, followee_id):
+    """Fold a new follow into the follower's who-to-follow list."""
+
+    suggestions.add_follow(user_id, followee_id,
+                           app.config['SUGGESTIONS_PER_USER'])
+    db.session.commit()
+
+
+@jobs.handler('unpublish_message')
+def unpublish_message(msg_id, author_id):
+    """Take a deleted message out of timelines and search."""
+
+    timelines.remove_message(msg_id, author_id)
+    search_index.remove_message(msg_id)
+
+
+@jobs.handler('forget_user')
+def forget_user(user_id, follower_ids):
+    """Take a deleted user's messages out of their followers' timelines."""
+
+    timelines.forget_user(user_id, follower_ids)
+
 
 ##############################################################################
 # User signup/login/logout
@@ -32,10 +249,14 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    This is a cached `CurrentUser` snapshot, not a `User` -- load the real
+    row in routes that change the user.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = session_users.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -77,6 +298,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            search_index.index_user(user)
 
         except IntegrityError as e:
             flash("Username already taken", 'danger')
@@ -100,6 +322,7 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            db.session.commit()  # in case the hash was upgraded
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,37 +347,77 @@ def logout():
 
 
 @app.route('/users')
+@read_replica
+@query_budget(5)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search users by username,
+    location and bio, best matches first, and a 'before' cursor for the
+    next page (of the matches, or of all users).
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = paginate_users(User.query, cursor_arg(1),
+                              app.config['USERS_PER_PAGE'])
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search_index.paginate_users(search, cursor_arg(2),
+                                           app.config['USERS_PER_PAGE'])
+    following_ids = (g.user.following_among([u.id for u in page.items])
+                     if g.user else set())
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=page.items,
+        next_cursor=page.next_cursor,
+        following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>')
+@read_replica
+@query_budget(5)
+@cache_control('private, no-cache')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    newest = db.select([db.func.max(Message.timestamp)]).where(
+        db.and_(Message.user_id == user_id, Message.hidden == db.false()))
+    if shards.sharded:
+        # their messages are on another database
+        user = User.query.get_or_404(user_id)
+        with shards.using(user.shard):
+            newest = db.session.execute(newest).scalar()
+    else:
+        user, newest = (db.session.query(User, newest.as_scalar())
+                        .filter(User.id == user_id).first_or_404())
+
+    # a new message changes `newest`, a deleted or hidden one the count
+    not_modified = conditional(
+        profile_version(user), user.messages_count, newest,
+        user.following_count, user.followers_count, user.likes_count,
+        g.user and g.user.id != user.id and g.user.is_following(user))
+    if not_modified:
+        return not_modified
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message.query.filter(Message.user_id == user_id).order_by(
-        Message.timestamp.desc()).limit(100).all())
-    # messages -> [<Message 1003> <Message 1004>]
-    return render_template('users/show.html', user=user, messages=messages)
+    with shards.using(user.shard):
+        page = paginate_messages(
+            Message.by_author(user_id), cursor_arg(2),
+            app.config['MESSAGES_PER_PAGE'])
+
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
+@read_replica
+@query_budget(4)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -163,10 +426,14 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following_ids = g.user.following_among([u.id for u in user.following])
+    return render_template(
+        'users/following.html', user=user, following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_replica
+@query_budget(4)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -175,7 +442,9 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    following_ids = g.user.following_among([u.id for u in user.followers])
+    return render_template(
+        'users/followers.html', user=user, following_ids=following_ids)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -187,8 +456,20 @@ def add_follow(follow_id):
         return redirect("/")
 
     followee = User.query.get_or_404(follow_id)
-    g.user.following.append(followee)
-    db.session.commit()
+
+    if not g.user.is_following(followee):
+        FollowersFollowee.add(g.user.id, followee.id)
+        User.adjust_counts(g.user.id, following_count=1)
+        User.adjust_counts(followee.id, followers_count=1)
+        Suggestion.query.filter(
+            Suggestion.user_id == g.user.id,
+            Suggestion.suggested_id == followee.id).delete(
+                synchronize_session=False)
+        db.session.commit()
+        session_users.invalidate(g.user.id, followee.id)
+        timelines.follow(g.user.id, followee.id)
+        push.follow(g.user.id, followee.id)
+        jobs.enqueue('update_suggestions', g.user.id, followee.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -201,9 +482,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
-    db.session.commit()
+    followee = User.query.get_or_404(follow_id)
+
+    if g.user.is_following(followee):
+        FollowersFollowee.remove(g.user.id, followee.id)
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(followee.id, followers_count=-1)
+        db.session.commit()
+        session_users.invalidate(g.user.id, followee.id)
+        timelines.unfollow(g.user.id, followee.id)
+        push.unfollow(g.user.id, followee.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -220,18 +508,20 @@ def edit(user_id):
         return redirect("/")
 
     if form.validate_on_submit():
-        user.username = form.username.data
-        user.bio = form.bio.data
-        user.email = form.email.data
         password = form.password.data
-        user.image_url = form.image_url.data
-        user.header_image_url = form.header_image_url.data
-
-        # import pdb
-        # pdb.set_trace()
 
+        # check the password before touching `user`, so the lookup by
+        # username isn't thrown by a pending rename
         if User.authenticate(g.user.username, password):
+            user.username = form.username.data
+            user.bio = form.bio.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
             db.session.commit()
+            session_users.invalidate(user.id)
+            search_index.index_user(user)
+            fragment_cache.invalidate_user(user.id)
             flash("edits saved")
             return redirect(f'/users/{user.id}')
         else:
@@ -286,15 +576,219 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    # read before the follows go with the account
+    follower_ids = [
+        row[0] for row in FollowersFollowee.follower_ids(user_id)
+    ]
+    User.delete_account(user_id)
     db.session.commit()
+    session_users.invalidate(user_id)
+    search_index.remove_user(user_id)
+    fragment_cache.invalidate_user(user_id)
+    jobs.enqueue('forget_user', user_id, follower_ids)
 
     return redirect("/signup")
 
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    """Too many logins/signups in flight: ask the client to retry."""
+
+    return ("Warbler is busy right now -- please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """custom page not found 404"""
-    return render_template('users/404.html')
+    if request.path.startswith('/api/'):
+        return api.response({'error': "Not found."}, 404)
+    return render_template('users/404.html'), 404
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute every user's follower/following/message/like counts and
+    every message's like count."""
+
+    User.recompute_counts()
+    Message.recompute_counts()
+    db.session.commit()
+    print("Counters recomputed.")
+
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help="Just list the migrations.")
+def migrate(status):
+    """Bring the database schema up to date (see migrations.py)."""
+
+    if status:
+        for mig, applied in migrations.status():
+            mark = "applied" if applied else "pending"
+            print(f"{mig.version:>4}  {mark:<8} {mig.description}")
+        return
+
+    if not migrations.upgrade():
+        print("Schema is up to date.")
+    if shards.sharded:
+        shards.create_tables()
+        print(f"Tables on all {shards.count} shards.")
+
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+@click.option('--wait', type=float,
+              help="Seconds to let workers notice the move "
+              "(default: SHARD_DIRECTORY_TTL).")
+def move_user(user_id, shard, wait):
+    """Move a user and their messages to another shard (see shards.py)."""
+
+    try:
+        shards.move_user(user_id, shard, wait=wait, log=click.echo)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+
+@app.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help="Just list the moves.")
+@click.option('--wait', type=float,
+              help="Seconds to let workers notice each move "
+              "(default: SHARD_DIRECTORY_TTL).")
+def rebalance_shards(dry_run, wait):
+    """Move users between shards until they hold about as many messages
+    each."""
+
+    loads = shards.loads()
+    for shard, counts in sorted(loads.items()):
+        click.echo(f"Shard {shard}: {sum(counts.values())} messages, "
+                   f"{len(counts)} users")
+
+    moves = plan_moves(loads)
+    for user_id, source, dest in moves:
+        click.echo(f"User {user_id}: shard {source} -> {dest}")
+        if not dry_run:
+            shards.move_user(user_id, dest, wait=wait, log=click.echo)
+    if not moves:
+        click.echo("Shards are balanced.")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if a hot query would scan a whole table (see query_plans.py)."""
+
+    problems = query_plans.check()
+    for name, tables in problems.items():
+        print(f"{name}: scans {', '.join(tables)}")
+    if problems:
+        raise SystemExit(1)
+    print("All hot queries use indexes.")
+
+
+@app.cli.command('compute-suggestions')
+@click.option('--top', type=int, help="Suggestions kept per user.")
+@click.option('--block-rows', type=int, default=2000, show_default=True,
+              help="Users scored at a time (bounds memory).")
+def compute_suggestions(top, block_rows):
+    """Recompute everyone's who-to-follow suggestions (see suggestions.py)."""
+
+    suggestions.compute(
+        top or app.config['SUGGESTIONS_PER_USER'],
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'], block_rows)
+
+
+@app.cli.command('run-jobs')
+@click.option('--burst', is_flag=True,
+              help="Exit once no jobs are ready instead of waiting for more.")
+def run_jobs(burst):
+    """Run background jobs from JOB_QUEUE_URL (see jobs.py)."""
+
+    try:
+        jobs.work(burst=burst)
+    except KeyboardInterrupt:
+        pass
+    print(f"Ran {jobs.stats()['done']} jobs.")
+
+
+@app.cli.command('import-data')
+@click.option('--users', type=click.Path(exists=True, dir_okay=False))
+@click.option('--messages', type=click.Path(exists=True, dir_okay=False))
+@click.option('--follows', type=click.Path(exists=True, dir_okay=False))
+@click.option('--likes', type=click.Path(exists=True, dir_okay=False))
+@click.option('--name', default='default', help="Name to resume it by.")
+@click.option('--append', is_flag=True, help="Add to existing data.")
+@click.option('--resume', is_flag=True, help="Carry on an interrupted run.")
+@click.option('--batch-size', default=10000)
+@click.option('--rebuild-indexes/--keep-indexes', default=None,
+              help="Drop indexes for the load (default: unless appending).")
+def import_data(users, messages, follows, likes, name, append, resume,
+                batch_size, rebuild_indexes):
+    """Stream CSV files into the database (see importer.py)."""
+
+    paths = dict(users=users, messages=messages, follows=follows, likes=likes)
+    try:
+        Importer(batch_size=batch_size, log=click.echo).run(
+            {source: path for source, path in paths.items() if path},
+            name=name, append=append, resume=resume,
+            rebuild_indexes=rebuild_indexes)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+    # everything derived from the tables in this process is now stale
+    timelines.store.clear()
+    session_users.cache.clear()
+    search_index.reset()
+
+
+##############################################################################
+# Search routes:
+
+
+@app.route('/search')
+@read_replica
+@query_budget(5)
+def search():
+    """Ranked search of users and messages for the 'q' param."""
+
+    q = request.args.get('q', '')
+    limit = app.config['USERS_PER_PAGE']
+
+    return render_template(
+        'search.html',
+        q=q,
+        users=search_index.search_users(q, limit),
+        messages=search_index.search_messages(q, limit))
+
+
+@app.route('/search/typeahead')
+def search_typeahead():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    users = search_index.suggest_users(request.args.get('q', ''), 10)
+
+    return jsonify([
+        dict(id=user.id, username=user.username, image_url=user.image_url)
+        for user in users
+    ])
+
+
+@app.route('/trending')
+@read_replica
+@query_budget(3)
+def trending_now():
+    """Trending hashtags and messages, from the latest snapshot."""
+
+    snapshot = trending.current()
+    likes = dict(snapshot.messages)
+    by_id = shards.load_messages(list(likes), Message.visible())
+
+    return render_template(
+        'trending.html',
+        hashtags=snapshot.hashtags,
+        messages=[by_id[msg_id] for msg_id, _ in snapshot.messages
+                  if msg_id in by_id],
+        likes=likes)
 
 
 ##############################################################################
@@ -315,20 +809,54 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        msg = Message(
+            id=shards.new_message_id(), text=form.text.data,
+            user_id=g.user.id)
+        with shards.for_user(g.user.id):
+            db.session.add(msg)
+            User.adjust_counts(g.user.id, messages_count=1)
+            db.session.commit()
+            session_users.invalidate(g.user.id)
+            timelines.add_own(msg)
+            trending.record_post(msg)
+            jobs.enqueue('publish_messages', msg.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+def message_or_404(msg_id):
+    """Message `msg_id`, with its author, from whichever shard has it."""
+
+    msg = shards.load_messages([msg_id]).get(msg_id)
+    if msg is None:
+        abort(404)
+    return msg
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_replica
+@query_budget(4)
+@cache_control('private, no-cache')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = message_or_404(message_id)
+
+    # hidden messages are only for their author and the moderators
+    if msg.hidden and not (g.user and g.user.id == msg.user_id
+                           or is_moderator(g.user)):
+        abort(404)
+
+    # messages can't be edited; only how their author looks, how many
+    # likes they have and whether they're hidden can change
+    not_modified = conditional(
+        author_version(msg.user), msg.likes_count, msg.hidden,
+        g.user and g.user.id != msg.user_id
+        and g.user.is_following(msg.user))
+    if not_modified:
+        return not_modified
     return render_template('messages/show.html', message=msg)
 
 
@@ -340,9 +868,28 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
+    msg = message_or_404(message_id)
+    msg_id, author_id = msg.id, msg.user_id
+
+    with shards.for_user(author_id):
+        liker_ids = [
+            row[0] for row in db.session.query(Like.user_id).filter(
+                Like.msg_id == msg_id)
+        ]
+
+        if not msg.hidden:
+            User.adjust_counts(author_id, messages_count=-1)
+        User.adjust_counts(liker_ids, likes_count=-1)
+        for mark in (Like, Flag):
+            mark.query.filter(mark.msg_id == msg_id).delete(
+                synchronize_session=False)
+        Message.query.filter(Message.id == msg_id).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    session_users.invalidate(author_id, *liker_ids)
+    fragment_cache.invalidate_message(msg_id)
+    jobs.enqueue('unpublish_message', msg_id, author_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -351,73 +898,559 @@ def messages_destroy(message_id):
 # Likes routes:
 
 
-@app.route('/like/<int:msg_id>', methods=["GET"])
-def add_like(msg_id):
-    user_id = g.user.id
-    like = Like.query.filter_by(msg_id=msg_id, user_id=user_id).first()
-    if like:
-        db.session.delete(like)
-        db.session.commit()
+@app.route('/messages/<int:msg_id>/like', methods=["POST"])
+def like_message(msg_id):
+    """Like a message; liking it again changes nothing."""
+
+    return set_like(msg_id, True)
+
+
+@app.route('/messages/<int:msg_id>/unlike', methods=["POST"])
+def unlike_message(msg_id):
+    """Stop liking a message; unliking it again changes nothing."""
+
+    return set_like(msg_id, False)
+
+
+def set_like(msg_id, liked):
+    """Make the logged-in user's like of `msg_id` match `liked`."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
+    if liked:
+        changed = Like.apply(g.user.id, like=[msg_id])[0]
     else:
-        new_like = Like(msg_id=msg_id, user_id=user_id)
-        db.session.add(new_like)
-        db.session.commit()
+        changed = Like.apply(g.user.id, unlike=[msg_id])[1]
+    db.session.commit()
 
+    if changed:
+        session_users.invalidate(g.user.id)
+        trending.record_likes(
+            shards.load_messages([msg_id], authors=False).values(),
+            1 if liked else -1)
+    elif liked and not shards.load_messages([msg_id], authors=False):
+        abort(404)
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(msg_id=msg_id, liked=liked)
     return redirect('/')
 
 
+@app.route('/likes', methods=["POST"])
+def bulk_likes():
+    """Apply many like changes in one transaction.
+
+    Takes JSON `{"like": [msg ids], "unlike": [msg ids]}` and returns the
+    ids whose state actually changed, as `{"liked": [...], "unliked": [...]}`.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return jsonify(error="Expected a JSON object."), 400
+
+    like = changes.get('like', [])
+    unlike = changes.get('unlike', [])
+    if not all(
+            isinstance(ids, list) and all(
+                isinstance(id, int) and not isinstance(id, bool)
+                for id in ids) for ids in (like, unlike)):
+        return jsonify(error="'like' and 'unlike' must be lists of ids."), 400
+    if len(like) + len(unlike) > app.config['LIKES_BULK_MAX']:
+        return jsonify(
+            error=f"At most {app.config['LIKES_BULK_MAX']} changes."), 400
+    if set(like) & set(unlike):
+        return jsonify(error="Can't both like and unlike a message."), 400
+
+    liked, unliked = Like.apply(g.user.id, like=like, unlike=unlike)
+    db.session.commit()
+
+    if liked or unliked:
+        session_users.invalidate(g.user.id)
+        for msg_ids, delta in ((liked, 1), (unliked, -1)):
+            if msg_ids:
+                trending.record_likes(
+                    shards.load_messages(msg_ids, authors=False).values(),
+                    delta)
+
+    return jsonify(liked=liked, unliked=unliked)
+
+
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
+@read_replica
+@query_budget(5)
 def show_likes(user_id):
+    """Show messages this user has liked, newest first."""
 
-    # import pdb
-    # pdb.set_trace()
-    messages = g.user.liked_msgs
+    user = User.query.get_or_404(user_id)
+    # (their likes are with the messages, on every shard)
+    page = shards.paginate(
+        Message.liked_by(user_id), cursor_arg(2),
+        app.config['MESSAGES_PER_PAGE'])
 
     return render_template(
-        'users/user_likes.html', messages=messages, user=g.user)
+        'users/user_likes.html',
+        messages=page.items,
+        user=user,
+        next_cursor=page.next_cursor)
 
 ##############################################################################
 # Flag routes:
 
+
+def is_moderator(user):
+    """May `user` (a User, CurrentUser or None) use the moderation queue?"""
+
+    return bool(user) and user.username in app.config['MODERATORS']
+
+
+app.add_template_global(is_moderator)
+
+
 @app.route('/flag/<int:msg_id>', methods=["GET"])
 def create_flag(msg_id):
-    """need to hook this up properly to the db"""
-    user_id = g.user.id
-    flag = Flag.query.filter_by(msg_id=msg_id, user_id=user_id).first()
-    if flag:
-        db.session.delete(flag)
-        db.session.commit()
+    """Old flag link: the form now lives with the message."""
 
-    else:
-        new_flag = Flag(msg_id=msg_id, user_id=user_id)
-        db.session.add(new_flag)
-        db.session.commit()
+    return redirect(f"/messages/{msg_id}/flag")
 
-    return redirect('/flag/new')
 
-@app.route('/flag/new', methods=["GET", "POST"])
-def flag_add():
-    """Add a flag message:
+@app.route('/messages/<int:msg_id>/flag', methods=["GET", "POST"])
+def flag_message(msg_id):
+    """Flag a message for the moderators, with a reason.
 
-    Show form if GET. If valid, update flag message and redirect to user page.
+    Show form if GET. Flagging again changes nothing. A message reaching
+    FLAG_HIDE_THRESHOLD flags is hidden until a moderator restores it.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    msg = message_or_404(msg_id)
     form = FlagForm()
-    
+
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        with shards.for_user(msg.user_id):
+            if Flag.apply(g.user.id, msg.id, True, reason=form.text.data):
+                hidden = Message.set_hidden(
+                    msg.id, True, min_flags=app.config['FLAG_HIDE_THRESHOLD'])
+                db.session.commit()
+                if hidden:
+                    message_hidden(msg)
+
+        flash("Thanks -- a moderator will take a look.", "success")
+        return redirect("/")
+
+    return render_template('flags/new.html', form=form, message=msg)
+
+
+@app.route('/messages/<int:msg_id>/unflag', methods=["POST"])
+def unflag_message(msg_id):
+    """Withdraw the logged-in user's flag of a message."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    with shards.for_message(msg_id):
+        Flag.apply(g.user.id, msg_id, False)
+        db.session.commit()
+    return redirect("/")
+
+
+def message_hidden(msg):
+    """Follow-up to hiding `msg`: drop it from timelines and search."""
+
+    session_users.invalidate(msg.user_id)
+    fragment_cache.invalidate_message(msg.id)
+    jobs.enqueue('unpublish_message', msg.id, msg.user_id)
+
+
+@app.route('/moderation')
+@query_budget(4)
+def moderation_queue():
+    """Most-flagged messages first, hidden or not, with their reasons."""
+
+    if not is_moderator(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    page = shards.paginate(
+        Message.query.filter(Message.flags_count > 0), cursor_arg(2),
+        app.config['MESSAGES_PER_PAGE'], most_flagged, flagged_key)
+
+    reasons = {}
+    for shard, msgs in shards.group(page.items).items():
+        with shards.using(shard):
+            reasons.update(Flag.reasons([msg.id for msg in msgs]))
+
+    return render_template(
+        'flags/queue.html',
+        messages=page.items,
+        next_cursor=page.next_cursor,
+        reasons=reasons)
+
+
+@app.route('/moderation/<int:msg_id>/hide', methods=["POST"])
+def moderation_hide(msg_id):
+    """Hide a message, however many flags it has."""
+
+    if not is_moderator(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = message_or_404(msg_id)
+    with shards.for_user(msg.user_id):
+        if Message.set_hidden(msg.id, True):
+            db.session.commit()
+            message_hidden(msg)
+
+    return redirect("/moderation")
+
+
+@app.route('/moderation/<int:msg_id>/restore', methods=["POST"])
+def moderation_restore(msg_id):
+    """Show a message again and dismiss its flags."""
+
+    if not is_moderator(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = message_or_404(msg_id)
+    msg_id, author_id = msg.id, msg.user_id
+    with shards.for_user(author_id):
+        shown = Message.set_hidden(msg_id, False)
+        Flag.clear(msg_id)
         db.session.commit()
-        return redirect(f"/")
 
-    return render_template('flags/new.html', form=form)
+    if shown:
+        session_users.invalidate(author_id)
+        fragment_cache.invalidate_message(msg_id)
+        jobs.enqueue('republish_messages', msg_id)
+
+    return redirect("/moderation")
+
+
+##############################################################################
+# JSON API (v1): the pages' queries, answered with rows (see api.py)
+
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return api.response({'error': e.message}, e.status)
+
+
+def api_cursor(arity):
+    """The `?before=` cursor of `arity` values, if any; 400 if it's bad."""
+
+    try:
+        return decode_cursor(request.args.get('before'), arity)
+    except ValueError as e:
+        raise ApiError(400, str(e))
+
+
+def api_user_or_404(user_id, *columns):
+    """Row of `columns` for user `user_id`."""
+
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+    if row is None:
+        raise ApiError(404, "No such user.")
+    return row
+
+
+def api_users(user_ids, columns):
+    """`{id: row}` of `columns` for users `user_ids`, in one query."""
+
+    if not user_ids:
+        return {}
+    return {
+        row.id: row
+        for row in db.session.query(*columns).filter(User.id.in_(user_ids))
+    }
+
+
+def api_liked(rows):
+    """Ids of message `rows` the logged-in user likes; None if they aren't
+    logged in or didn't ask."""
+
+    if not g.user or 'liked' not in api.fieldset('messages'):
+        return None
+    return shards.marked(Like, g.user.id,
+                         {row.id: row.user_id for row in rows})
+
+
+def api_messages(rows, users, liked=None):
+    """Payload of message `rows`, with their authors from `users` (rows by
+    id) once each, and whether the viewer likes them if `liked` is given."""
+
+    computed = {}
+    if liked is not None:
+        computed['liked'] = lambda row: row.id in liked
+    author_ids = dict.fromkeys(row.user_id for row in rows)
+
+    return {
+        'messages': api.serialize(
+            'messages', rows, api.fieldset('messages'), computed),
+        'users': api.serialize(
+            'users', [users[id] for id in author_ids if id in users],
+            api.fieldset('users')),
+    }
+
 
+@app.route('/api/v1/feed')
+@read_replica
+@query_budget(6)
+def api_feed():
+    """The logged-in user's home feed; see `homepage()`."""
 
+    if not g.user:
+        raise ApiError(401, "Access unauthorized.")
+
+    user_id = g.user.id
+    per_page = app.config['MESSAGES_PER_PAGE']
+    page = page_from(timelines.entries(user_id, per_page + 1, api_cursor(2)),
+                     per_page, entry_key)
+    entries = page.items
+    authors = {entry[1]: entry[2] for entry in entries}
+    message_columns = api.columns('messages', api.fieldset('messages'))
+    user_columns = api.columns('users', api.fieldset('users'))
+    want_liked = 'liked' in api.fieldset('messages')
+
+    # the authors are known from the timeline, so load with the messages
+    rows, liked, users = parallel.run(
+        lambda: timelines.messages(entries, message_columns),
+        lambda: shards.marked(Like, user_id, authors) if want_liked else None,
+        lambda: api_users(set(authors.values()), user_columns))
+
+    return api.response(
+        dict(api_messages(rows, users, liked), next=page.next_cursor))
+
+
+@app.route('/api/v1/feed/stream')
+@read_replica
+@query_budget(6)
+def api_feed_stream():
+    """New messages for the logged-in user's feed, as server-sent events
+    (see push.py).
+
+    Resumes after the cursor in the Last-Event-ID header (as EventSource
+    sends on reconnecting) or `?after=`, starting with what was missed.
+    """
+
+    if not g.user:
+        raise ApiError(401, "Access unauthorized.")
+    if request.method == 'HEAD':
+        # there'd be no body to end the stream's subscription
+        raise ApiError(405, "Streams are GET only.")
+
+    try:
+        after = decode_cursor(request.headers.get('Last-Event-ID')
+                              or request.args.get('after'), 2)
+    except ValueError as e:
+        raise ApiError(400, str(e))
+
+    # a single-threaded worker can't serve anything else while streaming
+    limit = None
+    if not ('asgi.scope' in request.environ
+            or request.environ.get('wsgi.multithread')):
+        limit = app.config['PUSH_SYNC_MAX_CONNECTIONS']
+        if not limit:
+            raise ApiError(
+                503, "Streams need SERVER_MODE=asgi or threaded workers.")
+
+    # subscribe first, so nothing posted meanwhile is missed (the client
+    # may be sent a message twice; messages have ids)
+    user_id = g.user.id
+    subscription = push.subscribe(user_id, [
+        row[0] for row in FollowersFollowee.following_ids(user_id)
+    ], limit)
+    try:
+        first = b"" if after is None else push_missed(user_id, after)
+    except Exception:
+        subscription.close()
+        raise
+
+    if 'asgi.scope' in request.environ:
+        # served from the event loop (see asgi.py), which closes it
+        request.environ['asgi.stream'] = subscription.async_chunks(first)
+        return app.response_class((), mimetype='text/event-stream',
+                                  headers={'X-Accel-Buffering': 'no'})
+
+    resp = app.response_class(subscription.chunks(first),
+                              mimetype='text/event-stream',
+                              headers={'X-Accel-Buffering': 'no'})
+    # even if the body's closed before it starts
+    resp.call_on_close(subscription.close)
+    return resp
+
+
+@push.renderer
+def render_pushed(entries):
+    """The messages of timeline `entries` as /api/v1/feed has them, all
+    fields but `liked`."""
+
+    fields = list(api.FIELDS['messages'])
+    user_fields = list(api.FIELDS['users'])
+    rows = timelines.messages(entries, api.columns('messages', fields))
+    users = api_users({row.user_id for row in rows},
+                      api.columns('users', user_fields))
+
+    return {
+        'messages': api.serialize('messages', rows, fields),
+        'users': api.serialize('users', list(users.values()), user_fields),
+    }
+
+
+def push_missed(user_id, after):
+    """The event for `user_id`'s feed messages newer than cursor `after`;
+    a resync if there's more than a page of them."""
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    entries = [
+        entry for entry in timelines.entries(user_id, per_page + 1)
+        if entry[:2] > after
+    ]
+    if not entries:
+        return b""
+    if len(entries) > per_page:
+        return RESYNC
+
+    payload = render_pushed(entries)
+    return sse('messages', json.dumps(payload, separators=(',', ':')),
+               id=cursor_for(entries[0]))
+
+
+@app.errorhandler(PushBusy)
+def push_busy(e):
+    """This worker has all the feed streams it takes: try another."""
+
+    resp = api.response({'error': "Too many streams; try again shortly."},
+                        503)
+    resp.headers['Retry-After'] = '5'
+    return resp
+
+
+@app.route('/api/v1/users/<int:user_id>')
+@read_replica
+@query_budget(3)
+@cache_control('private, no-cache')
+def api_user(user_id):
+    """A user's profile; see `users_show()`."""
+
+    fields = api.fieldset('users')
+    user = api_user_or_404(user_id, *api.columns('users', fields))
+
+    not_modified = conditional(tuple(user))
+    if not_modified:
+        return not_modified
+    return api.response({'user': api.serialize('users', [user], fields)[0]})
+
+
+@app.route('/api/v1/users/<int:user_id>/messages')
+@read_replica
+@query_budget(4)
+def api_user_messages(user_id):
+    """A user's messages, newest first; see `users_show()`."""
+
+    user = api_user_or_404(
+        user_id, User.shard, *api.columns('users', api.fieldset('users')))
+    with shards.using(user.shard):
+        page = paginate_messages(
+            Message.by_author(user_id).with_entities(
+                *api.columns('messages', api.fieldset('messages'))),
+            api_cursor(2), app.config['MESSAGES_PER_PAGE'])
+
+    return api.response(
+        dict(api_messages(page.items, {user.id: user}, api_liked(page.items)),
+             next=page.next_cursor))
+
+
+@app.route('/api/v1/users/<int:user_id>/likes')
+@read_replica
+@query_budget(5)
+def api_user_likes(user_id):
+    """Messages a user has liked, newest first; see `show_likes()`."""
+
+    api_user_or_404(user_id, User.id)
+    page = shards.paginate(
+        Message.liked_by(user_id).with_entities(
+            *api.columns('messages', api.fieldset('messages'))),
+        api_cursor(2), app.config['MESSAGES_PER_PAGE'], authors=False)
+    users = api_users({row.user_id for row in page.items},
+                      api.columns('users', api.fieldset('users')))
+
+    return api.response(
+        dict(api_messages(page.items, users, api_liked(page.items)),
+             next=page.next_cursor))
+
+
+@app.route('/api/v1/messages/<int:message_id>')
+@read_replica
+@query_budget(4)
+def api_message(message_id):
+    """A message and its author; see `messages_show()`."""
+
+    msg = shards.load_messages(
+        [message_id], Message.query.with_entities(
+            Message.hidden,
+            *api.columns('messages', api.fieldset('messages'))),
+        authors=False).get(message_id)
+
+    # hidden messages are only for their author and the moderators
+    if msg is None or msg.hidden and not (g.user and g.user.id == msg.user_id
+                                          or is_moderator(g.user)):
+        raise ApiError(404, "No such message.")
+
+    users = api_users([msg.user_id],
+                      api.columns('users', api.fieldset('users')))
+    payload = api_messages([msg], users, api_liked([msg]))
+    return api.response(
+        {'message': payload['messages'][0], 'users': payload['users']})
+
+
+@app.route('/api/v1/users/<int:user_id>/following')
+@read_replica
+@query_budget(4)
+def api_following(user_id):
+    """Users this user follows; see `show_following()`."""
+
+    return api_follows(user_id, FollowersFollowee.follower_id,
+                       FollowersFollowee.followee_id)
+
+
+@app.route('/api/v1/users/<int:user_id>/followers')
+@read_replica
+@query_budget(4)
+def api_followers(user_id):
+    """Users following this user; see `users_followers()`."""
+
+    return api_follows(user_id, FollowersFollowee.followee_id,
+                       FollowersFollowee.follower_id)
+
+
+def api_follows(user_id, listed, by):
+    """Page of the users in follows column `listed` where column `by` is
+    `user_id`, newest users first (the follows' columns read backwards; see
+    FollowersFollowee)."""
+
+    if not g.user:
+        raise ApiError(401, "Access unauthorized.")
+
+    api_user_or_404(user_id, User.id)
+    fields = api.fieldset('users')
+    page = paginate_users(
+        db.session.query(*api.columns('users', fields)).join(
+            FollowersFollowee, listed == User.id).filter(by == user_id),
+        api_cursor(1), app.config['USERS_PER_PAGE'])
+
+    return api.response({
+        'users': api.serialize('users', page.items, fields),
+        'next': page.next_cursor,
+    })
 
 
 ##############################################################################
@@ -425,51 +1458,48 @@ def flag_add():
 
 
 @app.route('/')
+@read_replica
+@query_budget(7)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: 100 most recent messages of followees, a page at a time
     """
 
     if g.user:
-        # only from the users that the logged-in user is following, and that use
-
-        followings = g.user.following  #a list of followers's objects
-
-        # create a list of followers' name + g.user.name
-        following_ids = [following.id
-                         for following in followings] + [g.user.id]
-        # import pdb
-        # pdb.set_trace()
-
-        likes_msg_list = [msg.id for msg in g.user.liked_msgs]
-        # break up into lines to make it more readable
-        messages = (Message.query.filter(
-            Message.user_id.in_(following_ids)).order_by(
-                Message.timestamp.desc()).limit(100).all())
+        # the user's materialized timeline (see timeline.py) -- followees'
+        # messages plus their own, newest first
+
+        user_id = g.user.id
+        per_page = app.config['MESSAGES_PER_PAGE']
+        # page on the timeline entries rather than the messages loaded for
+        # them, so messages deleted since they were fanned out don't end
+        # the feed early
+        page = page_from(
+            timelines.entries(user_id, per_page + 1, cursor_arg(2)),
+            per_page, entry_key)
+        entries = page.items
+        authors = {entry[1]: entry[2] for entry in entries}
+
+        # the messages, like/flag state for just those (one query each, per
+        # shard) and suggestions don't depend on each other, so may load at
+        # once (see parallel.py)
+        msgs, liked, flagged, suggested = parallel.run(
+            lambda: timelines.messages(entries),
+            lambda: shards.marked(Like, user_id, authors),
+            lambda: shards.marked(Flag, user_id, authors),
+            lambda: Suggestion.for_user(
+                user_id, app.config['SUGGESTIONS_SHOWN']))
 
         return render_template(
-            'home.html', messages=messages, Like=likes_msg_list)
+            'home.html',
+            messages=msgs,
+            next_cursor=page.next_cursor,
+            Like=liked,
+            Flag=flagged,
+            suggested_users=suggested,
+            hashtags=trending.current().hashtags)
 
     else:
         return render_template('home-anon.html')
-
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
@@ -0,0 +1,297 @@
+"""ASGI entry point: the same app, served from an event loop.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+(or set SERVER_MODE=asgi; see the Procfile). The event loop holds the
+connections -- reading request bodies, writing responses, waiting on slow
+clients and keep-alives -- without a thread each, so a worker can take many
+more of them than it has threads. The views are the same Flask views:
+
+  - each request runs on a pool of ASGI_THREADS threads, off the loop
+    (size the database pools to match; see replicas.py);
+  - a page's independent queries run at once (PARALLEL_QUERIES is on here;
+    see parallel.py), so it waits for the slowest, not their sum;
+  - password hashing is limited to a few at once, on the view's thread
+    (see hashing.py).
+
+Flask 1.0 and SQLAlchemy 1.2 have no async views or drivers, so a query
+still blocks the thread running it -- just never the event loop.
+
+A response is sent as the view produces it, a chunk at a time, and a slow
+client pauses the view once a few chunks are waiting (`BUFFERED_CHUNKS`);
+a client that goes away stops it at the next chunk.
+
+A view whose response goes on and on (a feed stream; see push.py) can
+instead put an async iterable of the body's chunks in the WSGI environ as
+'asgi.stream'. Once the view returns, that's sent from the event loop, so
+it doesn't hold a thread while it waits.
+"""
+
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+
+# chunks of a response waiting to be sent before the view has to wait
+BUFFERED_CHUNKS = 8
+
+
+class AsgiApp:
+    """ASGI (3.0) application running WSGI app `wsgi_app` on `threads`
+    threads."""
+
+    def __init__(self, wsgi_app, threads=32):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+        self.threads = threads
+        self.in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Can't serve {scope['type']!r} connections")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        environ = self.environ(scope, b''.join(body))
+        outbox = asyncio.Queue(BUFFERED_CHUNKS)
+        gone = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(outbox.put(message),
+                                             loop).result()
+
+        def respond():
+            try:
+                return self._respond(environ, put, gone)
+            finally:
+                put(None)
+
+        self.in_flight += 1
+        left = asyncio.Event()
+        job = loop.run_in_executor(self.executor, respond)
+        watcher = loop.create_task(self._watch(receive, gone, left))
+        try:
+            while True:
+                message = await outbox.get()
+                if message is None:
+                    break
+                # once the client's gone, just let the view wind down
+                if not gone.is_set():
+                    await send(message)
+            stream = await job
+            if stream is not None:
+                await self._stream(stream, send, left)
+        finally:
+            self.in_flight -= 1
+            watcher.cancel()
+
+    @staticmethod
+    async def _watch(receive, gone, left):
+        """Set `gone` and `left` when the client disconnects."""
+
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                gone.set()
+                left.set()
+                return
+
+    @staticmethod
+    async def _stream(stream, send, left):
+        """Send async iterable `stream` until it ends or the client has
+        `left`."""
+
+        leaving = asyncio.ensure_future(left.wait())
+        try:
+            while True:
+                chunk = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait({chunk, leaving},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    chunk.cancel()
+                    try:
+                        await chunk
+                    except asyncio.CancelledError:
+                        pass
+                    return
+                try:
+                    body = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': body,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            leaving.cancel()
+            if hasattr(stream, 'aclose'):
+                await stream.aclose()
+
+    def _respond(self, environ, put, gone):
+        """Run the WSGI app (on a pool thread), `put`ting ASGI messages;
+        returns its 'asgi.stream', if any, for the loop to send."""
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started and started[0] is None:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [(status, headers)]
+            return write
+
+        def send_start():
+            if started and started[0] is not None:
+                status, headers = started[0]
+                put({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers],
+                })
+                started[0] = None  # sent
+
+        def write(data):
+            send_start()
+            put({'type': 'http.response.body', 'body': data,
+                 'more_body': True})
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            stream = environ.get('asgi.stream')
+            if stream is not None:
+                send_start()
+                return stream
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+                if gone.is_set():
+                    return
+            send_start()
+            put({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    @staticmethod
+    def environ(scope, body):
+        """WSGI environ for ASGI http `scope` with request `body`."""
+
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode(
+                'latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'asgi.scope': scope,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = (
+                scope['client'][0], str(scope['client'][1]))
+
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                separator = '; ' if name == 'HTTP_COOKIE' else ','
+                value = environ[name] + separator + value
+            environ[name] = value
+
+        # the body's all here, however it came (chunked, say)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
+    def stats(self):
+        return dict(threads=self.threads, in_flight=self.in_flight)
+
+
+async def request(asgi_app, method, path, query_string=b'', headers=(),
+                  body=b'', state=None):
+    """Send one request straight to `asgi_app`, as a server would.
+
+    Returns `(status, [(name, value), ...], body)`, bytes throughout. The
+    app sees `state` as the scope's 'state'.
+    """
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query_string,
+        'headers': [(b'host', b'localhost')] + list(headers),
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 0),
+        'state': {} if state is None else state,
+    }
+    sent = [{'type': 'http.request', 'body': body}]
+    done = asyncio.Event()
+    response = {'headers': [], 'body': []}
+
+    async def receive():
+        if sent:
+            return sent.pop()
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message['headers']
+        else:
+            response['body'].append(message.get('body', b''))
+            if not message.get('more_body'):
+                done.set()
+
+    await asgi_app(scope, receive, send)
+    return response['status'], response['headers'], b''.join(
+        response['body'])
+
+
+if 'PARALLEL_QUERIES' not in os.environ:
+    flask_app.config['PARALLEL_QUERIES'] = True
+
+app = AsgiApp(flask_app, flask_app.config['ASGI_THREADS'])
@@ -0,0 +1,468 @@
+"""Load and latency benchmark of Warbler's core routes.
+
+Simulated users, each logged in as a random user on their own thread, pick
+actions from a weighted mix -- home feed, profiles, user search, posting,
+liking, following and unfollowing -- and fire them at the app in-process
+through the test client (so the numbers are the app's and the database's,
+not a web server's). For every route it reports p50/p95/p99 latency and
+SQL queries per request, plus the overall throughput.
+
+    python benchmark.py --seed-data --users 10000 --messages 200000 \\
+        --follows 500000 --likes 200000
+    python benchmark.py --clients 16 --duration 60 --save-baseline
+    ... change things ...
+    python benchmark.py --clients 16 --duration 60
+
+With --logins the simulated users only log in (as benchmark users with a
+known password, created if need be), measuring how many logins per second
+one worker process sustains with the configured bcrypt cost and hashing
+pool; 503s from the pool's admission control count as errors.
+
+    BCRYPT_LOG_ROUNDS=12 python benchmark.py --logins --clients 16
+
+With --asgi the same mix goes through the ASGI entry point (asgi.py)
+instead: the simulated users are coroutines on one event loop, sending
+requests with a session cookie, and the views run on its thread pool with
+PARALLEL_QUERIES on -- as deployed with SERVER_MODE=asgi. Compare it with
+the sync mode by saving a baseline from one and running the other:
+
+    python benchmark.py --clients 64 --save-baseline
+    python benchmark.py --clients 64 --asgi
+
+A run is compared against the saved baseline (benchmark-baseline.json by
+default): it fails, exiting 1, if any route's p95 latency is more than
+--tolerance slower or it runs more queries per request than before.
+
+Point DATABASE_URL at a scratch database: --seed-data replaces its
+contents.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from app import app, CURR_USER_KEY, session_users, timelines, search_index
+from importer import Importer, progress_metadata
+from migrations import migrations_metadata, stamp
+from models import db, User, Message
+from query_counter import count_queries
+from search import WORD_RE
+
+DEFAULT_BASELINE = 'benchmark-baseline.json'
+
+# action name, weight
+MIX = [
+    ('home', 40),
+    ('profile', 20),
+    ('search', 10),
+    ('post', 10),
+    ('like', 10),
+    ('follow', 5),
+    ('unfollow', 5),
+]
+
+LOGIN_MIX = [('login', 1)]
+
+LOGIN_PASSWORD = 'benchmark-password'
+
+# queries/request may creep up by this much before it counts as a regression
+QUERY_SLACK = 0.05
+
+
+def percentile(values, pct):
+    """Nearest-rank `pct`th percentile of `values`."""
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+class Dataset:
+    """What the simulated users pick their targets from."""
+
+    def __init__(self, login_users=0):
+        self.logins = self._login_users(login_users)
+        self.user_ids = [row[0] for row in db.session.query(User.id)]
+        # (sharded: sampled from the main database; ids elsewhere come
+        # from the id counter)
+        with db.shards.using(0):
+            self.max_msg_id = max(
+                db.session.query(db.func.max(Message.id)).scalar() or 0,
+                db.shards.message_id_high_water())
+            self.words = [
+                word for (text, ) in db.session.query(Message.text).limit(200)
+                for word in WORD_RE.findall(text.lower())
+            ] or ['warble']
+        db.session.remove()
+
+    @staticmethod
+    def _login_users(count):
+        """Usernames of `count` users with LOGIN_PASSWORD, made if needed."""
+
+        usernames = [f"benchlogin{n}" for n in range(count)]
+        existing = {
+            row[0]
+            for row in db.session.query(User.username).filter(
+                User.username.in_(usernames))
+        }
+        for username in usernames:
+            if username not in existing:
+                User.signup(username, f"{username}@example.com",
+                            LOGIN_PASSWORD, None)
+        db.session.commit()
+        return usernames
+
+    def user_id(self, rng):
+        return rng.choice(self.user_ids)
+
+    def msg_id(self, rng):
+        return rng.randint(1, self.max_msg_id or 1)
+
+
+def plan(action, dataset, rng):
+    """`(method, path, params)` for a request doing `action`; `params` has
+    the `query_string` or form `data`, if any."""
+
+    if action == 'home':
+        return 'GET', '/', {}
+    if action == 'profile':
+        return 'GET', f'/users/{dataset.user_id(rng)}', {}
+    if action == 'search':
+        return 'GET', '/users', {
+            'query_string': {'q': rng.choice(dataset.words)}}
+    if action == 'post':
+        return 'POST', '/messages/new', {'data': {
+            'text': " ".join(rng.choices(dataset.words, k=8))[:140]}}
+    if action == 'like':
+        return 'POST', f'/messages/{dataset.msg_id(rng)}/like', {}
+    if action == 'follow':
+        return 'POST', f'/users/follow/{dataset.user_id(rng)}', {}
+    if action == 'unfollow':
+        return 'POST', f'/users/stop-following/{dataset.user_id(rng)}', {}
+    if action == 'login':
+        return 'POST', '/login', {'data': {
+            'username': rng.choice(dataset.logins),
+            'password': LOGIN_PASSWORD}}
+    raise ValueError(f"Unknown action: {action}")
+
+
+def record(results, action, elapsed, queries, status):
+    # 404s are a random target that's gone, not a failure
+    ok = status < 400 or status == 404
+    results.append((action, elapsed, queries, ok))
+
+
+class SimulatedUser(threading.Thread):
+    """Logs in as a random user and performs actions until `deadline`."""
+
+    def __init__(self, dataset, mix, seed, deadline, max_requests, results):
+        super().__init__(daemon=True)
+        self.dataset = dataset
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.deadline = deadline
+        self.max_requests = max_requests
+        self.results = results
+
+    def request(self, client, action):
+        method, path, params = plan(action, self.dataset, self.rng)
+        return client.open(path, method=method, **params)
+
+    def run(self):
+        actions, weights = zip(*self.mix)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.dataset.user_id(self.rng)
+
+        done = 0
+        while time.monotonic() < self.deadline and done < self.max_requests:
+            action = self.rng.choices(actions, weights)[0]
+
+            started = time.perf_counter()
+            with count_queries() as counter:
+                try:
+                    status = self.request(client, action).status_code
+                except Exception:
+                    status = 500
+            record(self.results, action, time.perf_counter() - started,
+                   counter.count, status)
+            done += 1
+
+
+def counted(environ, start_response):
+    """The app, noting each request's query count in its ASGI scope."""
+
+    with count_queries() as counter:
+        result = app(environ, start_response)
+        try:
+            body = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    environ['asgi.scope']['state']['queries'] = counter.count
+    return body
+
+
+async def simulated_asgi_user(asgi_app, dataset, mix, seed, deadline,
+                              max_requests, results):
+    """SimulatedUser as a coroutine, sending requests to `asgi_app`."""
+
+    from asgi import request
+
+    rng = random.Random(seed)
+    actions, weights = zip(*mix)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    cookie = app.session_interface.get_signing_serializer(app).dumps(
+        {CURR_USER_KEY: dataset.user_id(rng)})
+
+    done = 0
+    while time.monotonic() < deadline and done < max_requests:
+        action = rng.choices(actions, weights)[0]
+        method, path, params = plan(action, dataset, rng)
+        headers = [(b'cookie', f"{cookie_name}={cookie}".encode())]
+        body = b''
+        if 'data' in params:
+            body = urlencode(params['data']).encode()
+            headers.append(
+                (b'content-type', b'application/x-www-form-urlencoded'))
+        state = {'queries': 0}
+
+        started = time.perf_counter()
+        try:
+            status, response_headers, _ = await request(
+                asgi_app, method, path,
+                urlencode(params.get('query_string', {})).encode(),
+                headers, body, state=state)
+        except Exception:
+            status, response_headers = 500, []
+        record(results, action, time.perf_counter() - started,
+               state['queries'], status)
+        done += 1
+
+        for name, value in response_headers:
+            if name == b'set-cookie' and value.startswith(
+                    f"{cookie_name}=".encode()):
+                cookie = value.decode().split(';', 1)[0].split('=', 1)[1]
+
+
+async def run_asgi(dataset, clients, deadline, max_requests, seed, mix,
+                   results):
+    from asgi import AsgiApp
+
+    asgi_app = AsgiApp(counted, app.config['ASGI_THREADS'])
+    await asyncio.gather(*(
+        simulated_asgi_user(asgi_app, dataset, mix, f"{seed}:{n}", deadline,
+                            max_requests, results)
+        for n in range(clients)
+    ))
+    asgi_app.executor.shutdown()
+
+
+def run(clients, duration, max_requests, seed, mix=MIX, asgi=False):
+    """Drive the app; returns (results, wall-clock seconds)."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    dataset = Dataset(login_users=clients if mix is LOGIN_MIX else 0)
+    results = []
+
+    started = time.monotonic()
+    deadline = started + duration
+    if asgi:
+        # (importing asgi turns on PARALLEL_QUERIES, as deployed)
+        asyncio.run(run_asgi(dataset, clients, deadline, max_requests, seed,
+                             mix, results))
+        return results, time.monotonic() - started
+
+    threads = [
+        SimulatedUser(dataset, mix, f"{seed}:{n}", deadline, max_requests,
+                      results)
+        for n in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.monotonic() - started
+
+
+def summarize(results, elapsed, mix=MIX, mode='sync'):
+    """Per-action latency/query stats and overall throughput."""
+
+    summary = {
+        'mode': mode,
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(results) / max(elapsed, 1e-9), 1),
+        'routes': {},
+    }
+
+    for action, _ in mix:
+        rows = [row for row in results if row[0] == action]
+        if not rows:
+            continue
+        latencies = [row[1] * 1000 for row in rows]
+        summary['routes'][action] = {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if not row[3]),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries': round(sum(row[2] for row in rows) / len(rows), 2),
+        }
+
+    return summary
+
+
+def regressions(summary, baseline, tolerance):
+    """Descriptions of routes that got slower or chattier than `baseline`."""
+
+    problems = []
+    for action, stats in summary['routes'].items():
+        before = baseline['routes'].get(action)
+        if before is None:
+            continue
+
+        if stats['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            problems.append(f"{action}: p95 {stats['p95_ms']}ms, "
+                            f"was {before['p95_ms']}ms")
+        if stats['queries'] > before['queries'] * (1 + QUERY_SLACK):
+            problems.append(f"{action}: {stats['queries']} queries/request, "
+                            f"was {before['queries']}")
+
+    return problems
+
+
+def report(summary, baseline=None):
+    print(f"{'route':<10} {'reqs':>6} {'errs':>5} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+
+    for action, stats in summary['routes'].items():
+        line = (f"{action:<10} {stats['requests']:>6} {stats['errors']:>5} "
+                f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                f"{stats['p99_ms']:>8} {stats['queries']:>8}")
+        before = baseline and baseline['routes'].get(action)
+        if before:
+            line += f"   (p95 was {before['p95_ms']})"
+        print(line)
+
+    print(f"{summary['requests']} requests in {summary['seconds']}s: "
+          f"{summary['throughput']} req/s ({summary['mode']})")
+    if baseline:
+        print(f"baseline: {baseline['throughput']} req/s "
+              f"({baseline.get('mode', 'sync')})")
+
+
+def seed_data(opts):
+    """Replace the database's contents with a generated dataset."""
+
+    db.drop_all()
+    progress_metadata.drop_all(db.engine)
+    migrations_metadata.drop_all(db.engine)
+    db.create_all()
+    stamp()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run([
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py'),
+            '--users', str(opts.users),
+            '--messages', str(opts.messages),
+            '--follows', str(opts.follows),
+            '--likes', str(opts.likes),
+            '--seed', str(opts.seed),
+            '--end', '2019-01-01',
+            '--out', tmp,
+        ], check=True)
+
+        Importer().run({
+            name: os.path.join(tmp, f"{name}.csv")
+            for name in ('users', 'messages', 'follows', 'likes')
+            if os.path.exists(os.path.join(tmp, f"{name}.csv"))
+        })
+
+    timelines.store.clear()
+    session_users.cache.clear()
+    search_index.reset()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--seed-data', action='store_true',
+                        help="generate and load a dataset first")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--logins', action='store_true',
+                        help="benchmark logins (password hashing) only")
+    parser.add_argument('--asgi', action='store_true',
+                        help="go through the ASGI entry point (asgi.py)")
+    parser.add_argument('--clients', type=int, default=8,
+                        help="concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run for")
+    parser.add_argument('--requests', type=int, default=sys.maxsize,
+                        help="stop each client after this many requests")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store this run as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed p95 slowdown (0.2 = 20%%)")
+    parser.add_argument('--json', help="also write the results here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+
+    if opts.seed_data:
+        seed_data(opts)
+
+    mix = LOGIN_MIX if opts.logins else MIX
+    results, elapsed = run(opts.clients, opts.duration, opts.requests,
+                           opts.seed, mix, asgi=opts.asgi)
+    summary = summarize(results, elapsed, mix,
+                        mode='asgi' if opts.asgi else 'sync')
+
+    baseline = None
+    if not opts.save_baseline and os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+
+    report(summary, baseline)
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if opts.save_baseline:
+        with open(opts.baseline, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Saved baseline to {opts.baseline}.")
+        return 0
+
+    if baseline is not None:
+        problems = regressions(summary, baseline, opts.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
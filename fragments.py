@@ -0,0 +1,146 @@
+"""Cache of rendered HTML fragments: message cards and profile headers.
+
+A message card's markup only depends on the message and on how its author
+looks (username, avatar), so it's rendered once and reused on every feed,
+profile and likes page. Per-viewer bits (like/flag stars, follow buttons)
+stay in the page templates around the cached fragment.
+
+Keys include the *version* of what the fragment shows -- for a card, the
+author's username and image URL -- so a profile edit in another worker can
+never serve a stale card from this one; the explicit `invalidate_*` calls
+just free the dead entries sooner.
+
+Templates call the `message_card(msg)`, `profile_hero(user)` and
+`profile_sidebar(user)` globals.
+"""
+
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+def author_version(user):
+    """What a message card shows of its author."""
+
+    return (user.username, user.image_url)
+
+
+def profile_version(user):
+    """What the cached parts of a profile page show of the user."""
+
+    return (user.username, user.image_url, user.header_image_url, user.bio,
+            user.location)
+
+
+class FragmentCache:
+    """Bounded LRU of rendered fragments, wired up like `db`."""
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()
+        self._owned = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 20000)
+
+        self.app = app
+        self.max_size = app.config['FRAGMENT_CACHE_SIZE']
+
+        app.jinja_env.globals.update(
+            message_card=self.message_card,
+            profile_hero=self.profile_hero,
+            profile_sidebar=self.profile_sidebar)
+
+    def render(self, key, owners, template_name, **context):
+        """Rendered `template_name`, from cache under `key` if possible.
+
+        `owners` are the `(kind, id)` pairs whose invalidation drops it.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        html = Markup(
+            self.app.jinja_env.get_template(template_name).render(**context))
+
+        with self._lock:
+            self._entries[key] = (html, owners)
+            for owner in owners:
+                self._owned.setdefault(owner, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                old_key, (_, old_owners) = self._entries.popitem(last=False)
+                self._disown(old_key, old_owners)
+
+        return html
+
+    def _disown(self, key, owners):
+        for owner in owners:
+            keys = self._owned.get(owner)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._owned[owner]
+
+    def _invalidate(self, owner):
+        with self._lock:
+            for key in self._owned.pop(owner, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._disown(key, entry[1])
+
+    def message_card(self, msg):
+        """The `<a>`s and message area of a message's `<li>`."""
+
+        return self.render(
+            ('message', msg.id) + author_version(msg.user),
+            [('message', msg.id), ('user', msg.user_id)],
+            'messages/_card.html',
+            msg=msg)
+
+    def profile_hero(self, user):
+        """Header image and avatar at the top of a profile."""
+
+        return self.render(('hero', user.id) + profile_version(user),
+                           [('user', user.id)], 'users/_hero.html', user=user)
+
+    def profile_sidebar(self, user):
+        """Username, bio and location beside a profile's content."""
+
+        return self.render(('sidebar', user.id) + profile_version(user),
+                           [('user', user.id)],
+                           'users/_sidebar.html',
+                           user=user)
+
+    def invalidate_message(self, msg_id):
+        """Drop fragments showing message `msg_id`."""
+
+        self._invalidate(('message', msg_id))
+
+    def invalidate_user(self, user_id):
+        """Drop fragments showing user `user_id` or their messages."""
+
+        self._invalidate(('user', user_id))
+
+    def stats(self):
+        """Hit/miss counts and current size."""
+
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses, size=len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owned.clear()
+            self.hits = self.misses = 0
@@ -2,76 +2,232 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows -- e.g. to load-test at
+production scale:
+
+    python generator/create_csvs.py --users 2000000 --messages 200000000 \\
+        --follows 300000000 --likes 100000000 --processes 16 --out /data
+
+and load the result with `flask import-data` (see importer.py).
+
+Everything is made up offline from a seeded RNG, so the same arguments give
+the same files. Follows and likes go mostly to a few popular users and
+messages (a power law with exponent --alpha), as on real social sites.
+
+Rows are generated in chunks by a pool of processes, each writing its own
+part file, which are then concatenated in order; memory use doesn't depend
+on the number of rows. Ids in the files are 1-based row numbers in
+users.csv / messages.csv.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from helpers import (IMAGE_URLS, PASSWORD_HASH, WORDS, Scatter, place,
+                     power_law_rank, sentence)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+LIKES_CSV_HEADERS = ['user_id', 'msg_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
-fake = Faker()
+# newest message date unless --end says otherwise; fixed (not today), so
+# the same arguments give the same files whenever they're run
+DEFAULT_END = datetime(2020, 1, 1)
 
-# Generate random profile image URLs to use for users
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+def user_rows(rng, start, stop, opts):
+    for user_id in range(start, stop):
+        # the id suffix keeps usernames (and emails) unique
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+        yield [
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            sentence(rng),
+            HEADER_IMAGE_URL,
+            place(rng),
+        ]
+
+
+def message_rows(rng, start, stop, opts):
+    authors = Scatter(opts['users'], opts['seed'])
+    first = opts['end'] - timedelta(days=365 * opts['years'])
+    span = (opts['end'] - first).total_seconds()
+
+    for _ in range(start, stop):
+        timestamp = first + timedelta(seconds=rng.random() * span)
+        yield [
+            sentence(rng, max_length=MAX_WARBLER_LENGTH),
+            timestamp,
+            # active users post more, like popular ones get followed more
+            authors(power_law_rank(rng, opts['users'], opts['alpha'] / 2)),
+        ]
+
+
+def distinct_targets(rng, count, n, alpha, scatter, exclude=None):
+    """`count` distinct ids in 1..n (not `exclude`), popular ones likelier."""
+
+    available = n - (exclude is not None)
+    count = min(count, available)
+    targets = set()
+
+    tries = 0
+    while len(targets) < count and tries < count * 20:
+        target = scatter(power_law_rank(rng, n, alpha))
+        if target != exclude:
+            targets.add(target)
+        tries += 1
 
-# Generate random header image URLs to use for users
+    # only with tiny or very dense graphs: fill up uniformly
+    while len(targets) < count:
+        target = rng.randint(1, n)
+        if target != exclude:
+            targets.add(target)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    return targets
+
+
+def per_user(total, users, user_id):
+    """How many of `total` rows user `user_id` makes (spread evenly)."""
+
+    return total // users + (user_id <= total % users)
+
+
+def follow_rows(rng, start, stop, opts):
+    scatter = Scatter(opts['users'], opts['seed'])
+
+    for user_id in range(start, stop):
+        count = per_user(opts['follows'], opts['users'], user_id)
+        # the follows table's columns are backwards: `followee_id` follows
+        # `follower_id` (see models.FollowersFollowee)
+        for followed in sorted(distinct_targets(
+                rng, count, opts['users'], opts['alpha'], scatter, user_id)):
+            yield [user_id, followed]
+
+
+def like_rows(rng, start, stop, opts):
+    scatter = Scatter(opts['messages'], opts['seed'] + 1)
+
+    for user_id in range(start, stop):
+        count = per_user(opts['likes'], opts['users'], user_id)
+        for msg_id in sorted(distinct_targets(
+                rng, count, opts['messages'], opts['alpha'], scatter)):
+            yield [user_id, msg_id]
+
+
+# name, headers, row function, count option the chunks range over
+TABLES = [
+    ('users', USERS_CSV_HEADERS, user_rows, 'users'),
+    ('messages', MESSAGES_CSV_HEADERS, message_rows, 'messages'),
+    ('follows', FOLLOWS_CSV_HEADERS, follow_rows, 'users'),
+    ('likes', LIKES_CSV_HEADERS, like_rows, 'users'),
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+
+def write_part(job):
+    """Write rows `start` to `stop` of a table to a part file."""
+
+    name, rows_for, start, stop, path, opts = job
+    rng = random.Random(f"{opts['seed']}:{name}:{start}")
+
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows_for(rng, start, stop, opts):
+            writer.writerow(row)
+            rows += 1
+
+    return path, rows
+
+
+def jobs_for(name, rows_for, over, opts, parts_dir):
+    """Part-file jobs covering ids 1..opts[over] of table `name`."""
+
+    per_item = 1
+    if name in ('follows', 'likes'):
+        per_item = max(1, opts[name] // max(opts['users'], 1))
+    step = max(1, opts['chunk_size'] // per_item)
+
+    for start in range(1, opts[over] + 1, step):
+        stop = min(start + step, opts[over] + 1)
+        path = os.path.join(parts_dir, f"{name}-{start:012}.csv")
+        yield (name, rows_for, start, stop, path, opts)
+
+
+def generate(opts, pool):
+    os.makedirs(opts['out'], exist_ok=True)
+
+    for name, headers, rows_for, over in TABLES:
+        if not opts[name] or not opts[over]:
+            continue
+
+        started = time.monotonic()
+        total = 0
+        parts_dir = tempfile.mkdtemp(prefix=f".{name}-", dir=opts['out'])
+
+        with open(os.path.join(opts['out'], f"{name}.csv"), 'w',
+                  newline='') as out:
+            csv.writer(out).writerow(headers)
+            # parts come back in order as they finish, and are appended and
+            # removed straight away
+            for path, rows in pool.imap(
+                    write_part, jobs_for(name, rows_for, over, opts,
+                                         parts_dir)):
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+                total += rows
+
+        os.rmdir(parts_dir)
+        elapsed = time.monotonic() - started
+        print(f"{name}: {total} rows in {elapsed:.1f}s "
+              f"({total / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSVs of any size.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--alpha', type=float, default=1.1,
+        help="power-law exponent of followers/likes per user/message")
+    parser.add_argument(
+        '--end', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+        default=DEFAULT_END,
+        help="newest message date, YYYY-MM-DD (default: "
+        f"{DEFAULT_END:%Y-%m-%d})")
+    parser.add_argument('--years', type=int, default=2,
+                        help="how far back messages go")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help="rows per part file")
+    parser.add_argument('--out', default='generator')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opts = vars(parse_args(argv))
+    with Pool(opts['processes']) as pool:
+        generate(opts, pool)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
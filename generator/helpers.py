@@ -1,8 +1,47 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
+from math import gcd
 from random import uniform
 
+WORDS = """
+    time year people way day man thing woman life child world school state
+    family student group country problem hand part place case week company
+    system program question work government number night point home water
+    room mother area money story fact month lot right study book eye job word
+    business issue side kind head house service friend father power hour game
+    line end member law car city community name president team minute idea kid
+    body information back parent face others level office door health person
+    art war history party result change morning reason research girl guy
+    moment air teacher force education foot boy age policy music market sense
+    nation plan college interest death experience effect class control care
+    field development role effort rate heart drug show leader light voice wife
+    police mind price report decision son view relationship town road arm
+    difference value building action model season society tax director
+    position player record paper space ground form event official matter
+    center couple site project activity star table need court oil situation
+    cost industry figure street image phone data picture practice piece land
+    product doctor wall patient worker news test movie north love support
+    technology step baby computer type attention film tree source organization
+    hair window evidence population site truth coffee bird warble song sky
+""".split()
+
+PLACE_PARTS = """
+    north south east west port lake new old fort mount glen river spring
+    green fair oak pine ash elm red stone bridge ford field haven brook dale
+""".split()
+
+PLACE_SUFFIXES = ["ton", "ville", "burgh", "field", "mouth", "view", "side"]
+
+PASSWORD_HASH = (
+    '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe')
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
 
 def get_random_datetime(year_gap=2):
     """Get a random datetime within the last few years."""
@@ -12,3 +51,55 @@ def get_random_datetime(year_gap=2):
     random_timestamp = uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def sentence(rng, min_words=4, max_words=14, max_length=None):
+    """Random capitalized sentence of dictionary words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    text = " ".join(words).capitalize() + "."
+    if max_length is not None:
+        text = text[:max_length]
+    return text
+
+
+def place(rng):
+    """Random made-up town name."""
+
+    return (rng.choice(PLACE_PARTS) + rng.choice(PLACE_PARTS) +
+            rng.choice(PLACE_SUFFIXES)).capitalize()
+
+
+def power_law_rank(rng, n, alpha):
+    """Rank in 1..`n` drawn with P(rank) roughly proportional to
+    rank ** -`alpha` (a Zipf distribution; alpha=1 is the classic one)."""
+
+    u = rng.random()
+    if alpha == 1:
+        x = (n + 1)**u
+    else:
+        top = (n + 1)**(1 - alpha)
+        x = ((top - 1) * u + 1)**(1 / (1 - alpha))
+    return min(int(x), n)
+
+
+class Scatter:
+    """Bijection of 1..n onto itself, so that popular ranks (1, 2, 3...)
+    land on ids spread over the whole range rather than the oldest users."""
+
+    def __init__(self, n, seed):
+        self.n = n
+        self.offset = seed % n if n else 0
+        self.step = self._coprime_step(n, seed)
+
+    @staticmethod
+    def _coprime_step(n, seed):
+        # a step near n / golden ratio scatters neighbouring ranks widely
+        step = max((int(n * 0.6180339887) + seed) % n, 1) if n > 1 else 1
+        while gcd(step, n) != 1:
+            step += 1
+        return step
+
+    def __call__(self, rank):
+        return (rank * self.step + self.offset) % self.n + 1
+
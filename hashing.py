@@ -0,0 +1,125 @@
+"""Password hashing with a limit on how many run at once.
+
+bcrypt is slow on purpose, and a burst of logins used to have every thread
+hashing at once, each slower for the others. Now at most
+PASSWORD_HASH_WORKERS hashes or checks run at a time in a process (bcrypt
+releases the GIL, so they use several cores), and at most
+PASSWORD_HASH_QUEUE may be running or waiting for a turn: past that, or if
+one waits longer than PASSWORD_HASH_TIMEOUT seconds, `HashingBusy` is
+raised and the app answers 503 straight away instead of piling up more work.
+
+The hash runs on the request's own thread. This is a concurrency limit,
+not an offload: it only bites where a process serves several requests at
+once (threaded or ASGI workers), not under gunicorn's sync workers.
+
+The work factor is BCRYPT_LOG_ROUNDS. Hashes made with a different one are
+upgraded (or downgraded) the next time their user logs in; see
+`User.authenticate()`.
+"""
+
+import os
+import threading
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already running or waiting."""
+
+
+def hash_rounds(hashed):
+    """Work factor of bcrypt hash `hashed` ('$2b$12$...' -> 12)."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Bounded bcrypt hashing, wired up like `db`.
+
+    Usable before `init_app`, with the defaults.
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.timeout = 10
+        self._configure(os.cpu_count() or 1, 64)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 64)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self._configure(app.config['PASSWORD_HASH_WORKERS'],
+                        app.config['PASSWORD_HASH_QUEUE'])
+
+    def _configure(self, workers, queue):
+        self._running = threading.BoundedSemaphore(workers)
+        self._slots = threading.BoundedSemaphore(queue)
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.queue = queue
+        self.in_flight = 0
+        self.done = 0
+        self.rejected = 0
+
+    def _run(self, fn, *args):
+        """`fn(*args)` once there's room; HashingBusy if there's too much
+        waiting, or the wait is too long."""
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+
+        try:
+            if not self._running.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.rejected += 1
+                raise HashingBusy()
+
+            with self._lock:
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                self._running.release()
+                with self._lock:
+                    self.in_flight -= 1
+                    self.done += 1
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as text."""
+
+        return self._run(bcrypt.generate_password_hash, password,
+                         self.rounds).decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        with self._lock:
+            return dict(workers=self.workers, queue=self.queue,
+                        in_flight=self.in_flight, done=self.done,
+                        rejected=self.rejected, rounds=self.rounds)
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,130 @@
+"""HTTP caching: per-route Cache-Control, ETags and fingerprinted static URLs.
+
+Routes declare how their responses may be cached with `@cache_control(...)`;
+routes that don't are sent `no-store`, as every response used to be.
+
+Pages that are cheap to validate but expensive to build (a profile, a
+message) compute a weak ETag from the few values they show -- counters,
+newest timestamps, the viewer -- *before* loading the rest, and answer a
+matching `If-None-Match` with an empty 304:
+
+    not_modified = conditional(user.messages_count, newest)
+    if not_modified:
+        return not_modified
+
+They don't send Last-Modified: a page also changes when e.g. its author
+edits their profile, which no single timestamp covers.
+
+Templates link static files with `static_url(filename)`, which adds a hash
+of the file's contents; those URLs never change content, so they are
+cached for STATIC_MAX_AGE. Plain /static/ URLs are revalidated each time.
+"""
+
+import hashlib
+import os
+from functools import wraps
+
+from flask import g, request, session, url_for
+from werkzeug.wrappers import Response
+
+
+def cache_control(value):
+    """Declare the Cache-Control header of a view's responses."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return view(*args, **kwargs)
+
+        wrapper.cache_control = value
+        return wrapper
+
+    return decorator
+
+
+def etag_for(*parts):
+    """ETag value for a page built from `parts` (anything with a repr)."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+
+
+def conditional(*parts):
+    """Tag this response with an ETag of `parts` and the viewer.
+
+    Returns a 304 response if the client already has that version, else
+    None. Pages with flashed messages pending are never 304'd.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    viewer = g.user and (g.user.id, g.user.username, g.user.image_url)
+    g.etag = etag_for(request.full_path, viewer, *parts)
+
+    if request.if_none_match.contains_weak(g.etag):
+        return Response(status=304)
+
+    return None
+
+
+class StaticFingerprints:
+    """Content hashes of static files, recomputed when a file changes."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._hashes = {}
+
+    def __call__(self, filename):
+        path = os.path.join(self.folder, filename)
+        mtime = os.path.getmtime(path)
+
+        cached = self._hashes.get(filename)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:12]
+            cached = self._hashes[filename] = (mtime, digest)
+
+        return cached[1]
+
+
+def init_app(app):
+    """Set caching headers on every response from `app`."""
+
+    app.config.setdefault('DEFAULT_CACHE_CONTROL', 'no-store')
+    app.config.setdefault('STATIC_MAX_AGE', 365 * 24 * 60 * 60)
+
+    fingerprint = StaticFingerprints(app.static_folder)
+
+    def static_url(filename):
+        """URL for static `filename` that changes whenever the file does."""
+
+        return url_for('static', filename=filename, v=fingerprint(filename))
+
+    app.jinja_env.globals['static_url'] = static_url
+
+    @app.after_request
+    def set_cache_headers(response):
+        if request.endpoint == 'static':
+            # only look at files the static view actually found
+            versioned = (response.status_code in (200, 304)
+                         and request.args.get('v') == fingerprint(
+                             request.view_args['filename']))
+
+            if versioned:
+                response.headers['Cache-Control'] = (
+                    f"public, max-age={app.config['STATIC_MAX_AGE']}, "
+                    "immutable")
+            else:
+                response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        response.headers['Cache-Control'] = getattr(
+            view, 'cache_control', app.config['DEFAULT_CACHE_CONTROL'])
+
+        etag = g.pop('etag', None)
+        if etag is not None and response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+            response.vary.add('Cookie')
+
+        return response
@@ -0,0 +1,336 @@
+"""Streaming bulk import of users, messages, follows and likes from CSV.
+
+Files are read in batches of `batch_size` rows, so memory use doesn't grow
+with the file. Each batch is written with Postgres `COPY` when the database
+is Postgres (plain multi-row INSERTs otherwise) and committed together with
+a progress record, so an interrupted import picks up exactly where it
+stopped when re-run with `resume=True`.
+
+The CSVs use the generator's columns (see generator/create_csvs.py). Ids in
+them are 1-based row numbers in the users and messages files, so a dataset
+can be appended to a database that already has data: its ids are shifted
+past the highest existing ones.
+
+Secondary indexes on the loaded tables are dropped for the load and built
+again at the end (by default only for imports into an empty database, where
+that's always cheaper), then the tables are ANALYZEd, Postgres sequences are
+moved past the new ids and the users' counters are recomputed.
+
+    flask import-data --users u.csv --messages m.csv --follows f.csv
+"""
+
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import (Boolean, Column, Integer, MetaData, Table, Text, func,
+                        text)
+
+from models import db, User, Message, FollowersFollowee, Like
+
+# What each file holds, in load order: the table, and which of its columns
+# are ids from the users/messages files (shifted when appending).
+SOURCES = [
+    ('users', User.__table__, {'id': 'users'}),
+    ('messages', Message.__table__, {'id': 'messages', 'user_id': 'users'}),
+    ('follows', FollowersFollowee.__table__, {
+        'followee_id': 'users',
+        'follower_id': 'users'
+    }),
+    ('likes', Like.__table__, {'user_id': 'users', 'msg_id': 'messages'}),
+]
+
+progress_metadata = MetaData()
+
+import_progress = Table(
+    'import_progress', progress_metadata,
+    Column('name', Text, primary_key=True),
+    Column('user_base', Integer, nullable=False),
+    Column('message_base', Integer, nullable=False),
+    Column('users_done', Integer, nullable=False, default=0),
+    Column('messages_done', Integer, nullable=False, default=0),
+    Column('follows_done', Integer, nullable=False, default=0),
+    Column('likes_done', Integer, nullable=False, default=0),
+    Column('rebuild_indexes', Boolean, nullable=False),
+    # JSON {table: [[index name, CREATE INDEX statement], ...]}
+    Column('dropped_indexes', Text, nullable=False, default='{}'),
+    Column('finished', Boolean, nullable=False, default=False))
+
+
+def _converter(column):
+    """Function turning a CSV string into a value for `column`."""
+
+    python_type = column.type.python_type
+
+    if python_type is datetime:
+        parse = datetime.fromisoformat
+    elif python_type is bool:
+        parse = lambda value: value.lower() in ('1', 't', 'true', 'yes')
+    else:
+        parse = python_type
+
+    def convert(value):
+        if value == '' and python_type is not str:
+            return None
+        return parse(value)
+
+    return convert
+
+
+def _batches(rows, size):
+    """Lists of up to `size` items from iterator `rows`."""
+
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Importer:
+    """Load CSV files into the database in bounded-memory batches.
+
+        Importer(batch_size=5000).run({'users': 'users.csv', ...})
+
+    `log` gets one progress line per file and a summary.
+    """
+
+    def __init__(self, session=None, batch_size=10000, log=print):
+        self.session = session or db.session
+        self.batch_size = batch_size
+        self.log = log
+
+    @property
+    def dialect(self):
+        return self.session.get_bind().dialect.name
+
+    def run(self, paths, name='default', append=False, resume=False,
+            rebuild_indexes=None):
+        """Import `paths` ({'users': path, ...}); returns rows per table.
+
+        A new import into a non-empty database needs `append`; a name that
+        was used before needs `resume` (which ignores the other options in
+        favour of the ones the import started with).
+
+        Sharded, it all goes into the main database (the imported users are
+        on shard 0); `flask rebalance-shards` spreads them out afterwards.
+        """
+
+        with db.shards.using(0):
+            return self._run(paths, name, append, resume, rebuild_indexes)
+
+    def _run(self, paths, name, append, resume, rebuild_indexes):
+        progress_metadata.create_all(self.session.get_bind())
+        progress = self._start(name, append, resume, rebuild_indexes)
+
+        if progress['finished']:
+            self.log(f"Import {name!r} already finished.")
+            return {}
+
+        bases = {
+            'users': progress['user_base'],
+            'messages': progress['message_base']
+        }
+        if progress['rebuild_indexes']:
+            self._drop_indexes(name, progress, paths)
+
+        started = time.monotonic()
+        counts = {}
+        for source, table, id_columns in SOURCES:
+            if source in paths:
+                counts[source] = self._load(name, source, table, id_columns,
+                                            paths[source], bases,
+                                            progress[f'{source}_done'])
+
+        self._finish(name, progress)
+
+        total = sum(counts.values())
+        elapsed = time.monotonic() - started
+        self.log(f"Imported {total} rows in {elapsed:.1f}s "
+                 f"({total / max(elapsed, 1e-9):,.0f} rows/s).")
+        return counts
+
+    def _start(self, name, append, resume, rebuild_indexes):
+        """The progress row for import `name`, creating it if it's new."""
+
+        row = self.session.execute(import_progress.select().where(
+            import_progress.c.name == name)).first()
+
+        if row is not None:
+            if not resume:
+                raise ValueError(f"Import {name!r} exists; resume it or "
+                                 f"pick another name")
+            return dict(row)
+
+        if resume:
+            raise ValueError(f"No import {name!r} to resume")
+
+        max_user = self.session.query(func.max(User.id)).scalar() or 0
+        # (sharded, message ids on other shards come from a counter)
+        max_message = max(
+            self.session.query(func.max(Message.id)).scalar() or 0,
+            db.shards.message_id_high_water())
+        if (max_user or max_message) and not append:
+            raise ValueError("Database isn't empty; use append")
+
+        progress = dict(
+            name=name,
+            user_base=max_user,
+            message_base=max_message,
+            users_done=0,
+            messages_done=0,
+            follows_done=0,
+            likes_done=0,
+            rebuild_indexes=(not append
+                             if rebuild_indexes is None else rebuild_indexes),
+            dropped_indexes='{}',
+            finished=False)
+        self.session.execute(import_progress.insert().values(**progress))
+        self.session.commit()
+        return progress
+
+    def _load(self, name, source, table, id_columns, path, bases, done):
+        """Stream `path` into `table`, skipping the `done` rows already in.
+
+        Returns the number of rows loaded this time.
+        """
+
+        started = time.monotonic()
+        loaded = 0
+
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            columns = [table.c[col] for col in header]
+            if 'id' in id_columns and 'id' not in header:
+                columns.insert(0, table.c.id)
+
+            converters = [_converter(column) for column in columns]
+            shifts = [
+                bases[id_columns[column.name]]
+                if column.name in id_columns else None for column in columns
+            ]
+
+            for batch in _batches(islice(reader, done, None), self.batch_size):
+                rows = []
+                for raw in batch:
+                    if 'id' in id_columns and 'id' not in header:
+                        raw = [str(done + len(rows) + 1)] + raw
+                    row = [
+                        convert(value) for convert, value in zip(converters, raw)
+                    ]
+                    rows.append([
+                        value + shift if shift is not None else value
+                        for value, shift in zip(row, shifts)
+                    ])
+
+                self._insert(table, columns, rows)
+                done += len(rows)
+                loaded += len(rows)
+                self.session.execute(import_progress.update().where(
+                    import_progress.c.name == name).values(
+                        **{f'{source}_done': done}))
+                self.session.commit()
+
+        elapsed = time.monotonic() - started
+        self.log(f"{source}: {loaded} rows in {elapsed:.1f}s "
+                 f"({loaded / max(elapsed, 1e-9):,.0f} rows/s)")
+        return loaded
+
+    def _insert(self, table, columns, rows):
+        """Write `rows` (lists in `columns` order) into `table`."""
+
+        if self.dialect == 'postgresql':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                ['' if value is None else value for value in row]
+                for row in rows)
+            buffer.seek(0)
+
+            names = ", ".join(column.name for column in columns)
+            cursor = self.session.connection().connection.cursor()
+            cursor.copy_expert(
+                f"COPY {table.name} ({names}) FROM STDIN WITH (FORMAT csv)",
+                buffer)
+        else:
+            names = [column.name for column in columns]
+            self.session.execute(table.insert(),
+                                 [dict(zip(names, row)) for row in rows])
+
+    ##########################################################################
+    # Index rebuilds
+
+    def _secondary_indexes(self, table):
+        """`[name, CREATE INDEX sql]` for `table`'s non-unique indexes."""
+
+        if self.dialect == 'postgresql':
+            rows = self.session.execute(
+                text("SELECT i.relname, pg_get_indexdef(i.oid) "
+                     "FROM pg_index x "
+                     "JOIN pg_class i ON i.oid = x.indexrelid "
+                     "JOIN pg_class t ON t.oid = x.indrelid "
+                     "WHERE t.relname = :table AND NOT x.indisunique"),
+                {'table': table})
+        elif self.dialect == 'sqlite':
+            rows = self.session.execute(
+                text("SELECT name, sql FROM sqlite_master "
+                     "WHERE type = 'index' AND tbl_name = :table "
+                     "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'"),
+                {'table': table})
+        else:
+            return []
+
+        return [list(row) for row in rows]
+
+    def _drop_indexes(self, name, progress, paths):
+        """Drop secondary indexes of the tables in `paths`, recording them
+        so `_finish` (in this run or a resumed one) can rebuild them."""
+
+        dropped = json.loads(progress['dropped_indexes'])
+
+        for source, table, _ in SOURCES:
+            if source not in paths or table.name in dropped:
+                continue
+
+            indexes = self._secondary_indexes(table.name)
+            for index_name, _ in indexes:
+                self.session.execute(text(f'DROP INDEX "{index_name}"'))
+            dropped[table.name] = indexes
+
+        progress['dropped_indexes'] = json.dumps(dropped)
+        self.session.execute(import_progress.update().where(
+            import_progress.c.name == name).values(
+                dropped_indexes=progress['dropped_indexes']))
+        self.session.commit()
+
+    def _finish(self, name, progress):
+        """Rebuild indexes, refresh statistics, sequences and counters."""
+
+        started = time.monotonic()
+
+        for table, indexes in json.loads(progress['dropped_indexes']).items():
+            for _, sql in indexes:
+                self.session.execute(text(sql))
+
+        if self.dialect == 'postgresql':
+            for table in ('users', 'messages'):
+                self.session.execute(
+                    text(f"SELECT setval(pg_get_serial_sequence('{table}', "
+                         f"'id'), coalesce(max(id), 1)) FROM {table}"))
+
+        User.recompute_counts()
+        Message.recompute_counts()
+
+        self.session.execute(import_progress.update().where(
+            import_progress.c.name == name).values(finished=True))
+        self.session.commit()
+
+        for _, table, _ in SOURCES:
+            self.session.execute(text(f"ANALYZE {table.name}"))
+        self.session.commit()
+
+        self.log(f"Indexes, statistics and counters rebuilt in "
+                 f"{time.monotonic() - started:.1f}s.")
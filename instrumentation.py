@@ -0,0 +1,272 @@
+"""Always-on per-route request metrics, plus on-demand profiling.
+
+For every request this records, under its endpoint, the wall time, the time
+spent in SQL and rendering templates, the number of statements and the
+slowest ones. That costs a few timer calls per request and per statement.
+
+    GET /metrics                   per-route numbers as JSON
+    GET /metrics/profiles          recent profiles
+    GET /metrics/profiles/<id>     one profile, as `pstats` text
+
+A request is run under cProfile if it sends `X-Profile: 1`, or at random
+for a PROFILE_SAMPLE_RATE fraction of requests; its response then carries
+an `X-Profile-Id` header naming the stored profile.
+
+The metrics routes and the profiling header need the METRICS_TOKEN (in an
+`X-Metrics-Token` header). Without one they only work in debug or testing,
+from localhost and not through a proxy -- behind a proxy on the same host,
+every request comes from localhost.
+"""
+
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import (abort, g, jsonify, request, before_render_template,
+                   template_rendered)
+
+from query_counter import count_queries
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def _percentile(ordered, pct):
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+
+class RouteMetrics:
+    """Running totals for one endpoint."""
+
+    def __init__(self, samples, slowest):
+        self.requests = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.sql = 0.0
+        self.render = 0.0
+        self.queries = 0
+        self.max_wall = 0.0
+        self.walls = deque(maxlen=samples)
+        self.slowest_kept = slowest
+        self.slowest = []
+
+    def add(self, status, wall, sql, render, counter):
+        self.requests += 1
+        self.errors += status >= 500
+        self.wall += wall
+        self.sql += sql
+        self.render += render
+        self.queries += counter.count
+        self.max_wall = max(self.max_wall, wall)
+        self.walls.append(wall)
+
+        self.slowest = heapq.nlargest(
+            self.slowest_kept,
+            itertools.chain(self.slowest,
+                            zip(counter.durations, counter.statements)))
+
+    def to_dict(self):
+        walls = sorted(self.walls)
+        n = self.requests
+        return {
+            'requests': n,
+            'errors': self.errors,
+            'wall_ms': {
+                'mean': _ms(self.wall / n),
+                'p50': _ms(_percentile(walls, 50)),
+                'p95': _ms(_percentile(walls, 95)),
+                'p99': _ms(_percentile(walls, 99)),
+                'max': _ms(self.max_wall),
+            },
+            'sql_ms': _ms(self.sql / n),
+            'render_ms': _ms(self.render / n),
+            'queries': round(self.queries / n, 2),
+            'slowest_statements': [{
+                'ms': _ms(seconds),
+                'statement': statement
+            } for seconds, statement in self.slowest],
+        }
+
+
+class Instrumentation:
+    """Per-route metrics and profiling, wired up like `db`."""
+
+    def __init__(self, app=None):
+        self._routes = {}
+        self._profiles = OrderedDict()
+        self._profile_ids = itertools.count(1)
+        self._sources = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILES_KEPT', 50)
+        app.config.setdefault('METRICS_LATENCY_SAMPLES', 1000)
+        app.config.setdefault('METRICS_SLOWEST_STATEMENTS', 5)
+
+        self.app = app
+
+        app.before_request(self._start)
+        app.after_request(self._record_response)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        app.add_url_rule('/metrics/profiles', 'metrics_profiles',
+                         self.profiles_view)
+        app.add_url_rule('/metrics/profiles/<int:profile_id>',
+                         'metrics_profile', self.profile_view)
+
+    def add_source(self, name, stats):
+        """Include `stats()` (a JSON-able dict) in /metrics as `name`."""
+
+        self._sources[name] = stats
+
+    ##########################################################################
+    # Recording
+
+    def _authorized(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            return request.headers.get('X-Metrics-Token') == token
+        return ((self.app.debug or self.app.testing)
+                and 'X-Forwarded-For' not in request.headers
+                and request.remote_addr in ('127.0.0.1', '::1'))
+
+    def _start(self):
+        g.instrumentation = {
+            'started': time.perf_counter(),
+            'counter': count_queries().__enter__(),
+            'render': 0.0,
+            'render_started': [],
+            'profiler': None,
+        }
+
+        wanted = (request.headers.get('X-Profile') == '1'
+                  and self._authorized())
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if wanted or (rate and random.random() < rate):
+            profiler = cProfile.Profile()
+            g.instrumentation['profiler'] = profiler
+            g.instrumentation['profile_id'] = next(self._profile_ids)
+            profiler.enable()
+
+    def _render_started(self, app, template, context, **extra):
+        state = g.get('instrumentation')
+        if state is not None:
+            state['render_started'].append(time.perf_counter())
+
+    def _render_finished(self, app, template, context, **extra):
+        state = g.get('instrumentation')
+        if state is not None and state['render_started']:
+            state['render'] += (
+                time.perf_counter() - state['render_started'].pop())
+
+    def _record_response(self, response):
+        state = g.get('instrumentation')
+        if state is not None:
+            state['status'] = response.status_code
+            if state['profiler'] is not None:
+                response.headers['X-Profile-Id'] = str(state['profile_id'])
+        return response
+
+    def _finish(self, exc):
+        state = g.pop('instrumentation', None)
+        if state is None:
+            return
+
+        wall = time.perf_counter() - state['started']
+        counter = state['counter']
+        counter.__exit__(None, None, None)
+
+        endpoint = request.endpoint or '<unmatched>'
+        status = 500 if exc is not None else state.get('status', 500)
+
+        with self._lock:
+            route = self._routes.get(endpoint)
+            if route is None:
+                route = self._routes[endpoint] = RouteMetrics(
+                    self.app.config['METRICS_LATENCY_SAMPLES'],
+                    self.app.config['METRICS_SLOWEST_STATEMENTS'])
+            route.add(status, wall, counter.seconds, state['render'],
+                      counter)
+
+        profiler = state['profiler']
+        if profiler is not None:
+            profiler.disable()
+            self._keep_profile(state['profile_id'], endpoint, wall, profiler)
+
+    def _keep_profile(self, profile_id, endpoint, wall, profiler):
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative') \
+            .print_stats(40)
+
+        with self._lock:
+            self._profiles[profile_id] = {
+                'id': profile_id,
+                'endpoint': endpoint,
+                'path': request.full_path,
+                'wall_ms': _ms(wall),
+                'at': time.time(),
+                'stats': out.getvalue(),
+            }
+            while len(self._profiles) > self.app.config['PROFILES_KEPT']:
+                self._profiles.popitem(last=False)
+
+    ##########################################################################
+    # Reporting
+
+    def snapshot(self):
+        """Everything /metrics shows, as a dict."""
+
+        with self._lock:
+            routes = {
+                endpoint: route.to_dict()
+                for endpoint, route in sorted(self._routes.items())
+            }
+
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'routes': routes,
+            **{name: stats() for name, stats in self._sources.items()},
+        }
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+            self._profiles.clear()
+
+    def metrics_view(self):
+        if not self._authorized():
+            abort(404)
+        return jsonify(self.snapshot())
+
+    def profiles_view(self):
+        if not self._authorized():
+            abort(404)
+        with self._lock:
+            profiles = [{k: v
+                         for k, v in profile.items() if k != 'stats'}
+                        for profile in reversed(self._profiles.values())]
+        return jsonify(profiles=profiles)
+
+    def profile_view(self, profile_id):
+        if not self._authorized():
+            abort(404)
+        with self._lock:
+            profile = self._profiles.get(profile_id)
+        if profile is None:
+            abort(404)
+        return profile['stats'], 200, {'Content-Type': 'text/plain'}
@@ -0,0 +1,486 @@
+"""Background jobs, so routes can hand off their follow-up work.
+
+Fanning a message out to followers' timelines, indexing it for search and
+the like used to run inside the request, before the response went out.
+Routes now `jobs.enqueue('name', *args)` that work instead; the jobs a
+request enqueues are handed to the queue together once it has succeeded,
+and worker threads run them shortly after.
+
+A job is a function registered with `@jobs.handler(name)`, taking
+JSON-able arguments (ids, not model instances). Handlers registered with
+`batched=True` are called once with the argument lists of every job of
+that name taken in one go, so e.g. a burst of posts is fanned out with one
+query. A job that raises is retried up to JOB_MAX_ATTEMPTS times, backing
+off exponentially from JOB_RETRY_DELAY seconds, and then kept as failed.
+
+The queue is picked with JOB_QUEUE_URL:
+
+    memory://               per-process (default; lost on restart)
+    sqlite:////path/to.db   local file that survives restarts, shared by
+                            every worker on the box
+
+JOB_WORKERS threads in each app process run jobs. With a durable queue,
+jobs can also be run by a separate process (`flask run-jobs`), but only
+those touching shared state: per-process stores (the memory:// timeline
+store, the in-memory search index) must be updated from the process that
+serves them. Set JOBS_INLINE to run jobs at the end of the request instead,
+as the tests do.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import g, has_request_context
+
+from models import db
+
+log = logging.getLogger(__name__)
+
+Job = namedtuple('Job', ['id', 'name', 'args', 'attempts'])
+
+Handler = namedtuple('Handler', ['fn', 'batched'])
+
+
+##############################################################################
+# Backends
+
+
+class JobBackend:
+    """Interface for job queue backends.
+
+    Jobs taken with `take()` are leased to the taker, who must `ack()`,
+    `retry()` or `bury()` each of them; jobs whose lease runs out (their
+    worker died) are handed out again.
+    """
+
+    def put(self, jobs):
+        """Queue `(name, args)` pairs, ready to run now."""
+
+        raise NotImplementedError
+
+    def take(self, limit, lease):
+        """Up to `limit` ready jobs, oldest first, leased for `lease`
+        seconds."""
+
+        raise NotImplementedError
+
+    def ack(self, job_ids):
+        """Forget finished jobs."""
+
+        raise NotImplementedError
+
+    def retry(self, job, run_at, error):
+        """Put `job` back, to run again at time `run_at`."""
+
+        raise NotImplementedError
+
+    def bury(self, job, error):
+        """Keep `job` as failed; it won't run again."""
+
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        """Block for up to `timeout` seconds, or until jobs are put."""
+
+        time.sleep(timeout)
+
+    def counts(self):
+        """`{'ready': n, 'running': n, 'failed': n}`."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every job."""
+
+        raise NotImplementedError
+
+
+class MemoryJobBackend(JobBackend):
+    """Jobs kept in this process."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._ready = []
+        self._running = {}
+        self._failed = []
+        self._cond = threading.Condition()
+
+    def put(self, jobs):
+        now = time.time()
+        with self._cond:
+            for name, args in jobs:
+                job = Job(next(self._ids), name, list(args), 0)
+                heapq.heappush(self._ready, (now, job.id, job))
+            self._cond.notify_all()
+
+    def take(self, limit, lease):
+        now = time.time()
+        with self._cond:
+            for job_id, (until, job) in list(self._running.items()):
+                if until < now:
+                    del self._running[job_id]
+                    heapq.heappush(self._ready, (now, job.id, job))
+
+            taken = []
+            while (self._ready and len(taken) < limit
+                   and self._ready[0][0] <= now):
+                job = heapq.heappop(self._ready)[2]
+                self._running[job.id] = (now + lease, job)
+                taken.append(job)
+            return taken
+
+    def ack(self, job_ids):
+        with self._cond:
+            for job_id in job_ids:
+                self._running.pop(job_id, None)
+
+    def retry(self, job, run_at, error):
+        with self._cond:
+            if self._running.pop(job.id, None) is not None:
+                job = job._replace(attempts=job.attempts + 1)
+                heapq.heappush(self._ready, (run_at, job.id, job))
+
+    def bury(self, job, error):
+        with self._cond:
+            if self._running.pop(job.id, None) is not None:
+                self._failed.append((job._replace(attempts=job.attempts + 1),
+                                     error))
+
+    def wait(self, timeout):
+        with self._cond:
+            if self._ready:
+                timeout = min(timeout,
+                              max(0, self._ready[0][0] - time.time()))
+            self._cond.wait(timeout)
+
+    def counts(self):
+        with self._cond:
+            return {
+                'ready': len(self._ready),
+                'running': len(self._running),
+                'failed': len(self._failed),
+            }
+
+    def clear(self):
+        with self._cond:
+            self._ready.clear()
+            self._running.clear()
+            self._failed.clear()
+
+
+class SQLiteJobBackend(JobBackend):
+    """Jobs kept in a local SQLite file, shared by all workers."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            args TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'ready',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, run_at, id);
+    """
+
+    # seconds between polls when idle; other processes can't wake us
+    POLL = 0.5
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._put = threading.Event()
+        with self._lock:
+            self._conn.executescript(self.SCHEMA)
+
+    def _write(self, fn):
+        """`fn(conn)` in one write transaction; returns its result."""
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def put(self, jobs):
+        now = time.time()
+        self._write(lambda conn: conn.executemany(
+            "INSERT INTO jobs (name, args, run_at) VALUES (?, ?, ?)",
+            [(name, json.dumps(list(args)), now) for name, args in jobs]))
+        self._put.set()
+
+    def take(self, limit, lease):
+        now = time.time()
+
+        def take(conn):
+            # running jobs' run_at is when their lease runs out
+            rows = conn.execute(
+                "SELECT id, name, args, attempts FROM jobs "
+                "WHERE state IN ('ready', 'running') AND run_at <= ? "
+                "ORDER BY run_at, id LIMIT ?", (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = 'running', run_at = ? WHERE id = ?",
+                [(now + lease, row[0]) for row in rows])
+            return [
+                Job(id, name, json.loads(args), attempts)
+                for id, name, args, attempts in rows
+            ]
+
+        return self._write(take)
+
+    def ack(self, job_ids):
+        self._write(lambda conn: conn.executemany(
+            "DELETE FROM jobs WHERE id = ?", [(id, ) for id in job_ids]))
+
+    def retry(self, job, run_at, error):
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET state = 'ready', run_at = ?, error = ?, "
+            "attempts = attempts + 1 WHERE id = ?", (run_at, error, job.id)))
+
+    def bury(self, job, error):
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET state = 'failed', error = ?, "
+            "attempts = attempts + 1 WHERE id = ?", (error, job.id)))
+
+    def wait(self, timeout):
+        if self._put.wait(min(timeout, self.POLL)):
+            self._put.clear()
+
+    def counts(self):
+        counts = {'ready': 0, 'running': 0, 'failed': 0}
+        with self._lock:
+            counts.update(self._conn.execute(
+                "SELECT state, count(*) FROM jobs GROUP BY state"))
+        return counts
+
+    def clear(self):
+        self._write(lambda conn: conn.execute("DELETE FROM jobs"))
+
+
+def backend_from_url(url):
+    """Build the job queue backend named by `url`."""
+
+    if url == "memory://":
+        return MemoryJobBackend()
+
+    if url.startswith("sqlite:///"):
+        return SQLiteJobBackend(url[len("sqlite:///"):])
+
+    raise ValueError(f"Unknown job queue: {url}")
+
+
+##############################################################################
+# Queue and workers
+
+
+class Jobs:
+    """Background job queue, wired up like `db`."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self._handlers = {}
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.done = 0
+        self.retried = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_QUEUE_URL', 'memory://')
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_BATCH_SIZE', 100)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOB_RETRY_DELAY', 1.0)
+        app.config.setdefault('JOB_LEASE', 300)
+        app.config.setdefault('JOBS_INLINE', False)
+
+        self.app = app
+        self.backend = backend_from_url(app.config['JOB_QUEUE_URL'])
+        app.after_request(self._flush)
+
+    def handler(self, name, batched=False):
+        """Register the decorated function as job `name`.
+
+        It's called as `fn(*args)`, or if `batched`, as `fn(arg_lists)`
+        with the arguments of several jobs.
+        """
+
+        def decorator(fn):
+            self._handlers[name] = Handler(fn, batched)
+            return fn
+
+        return decorator
+
+    def enqueue(self, name, *args):
+        """Run job `name` with `args` in the background.
+
+        Inside a request, jobs wait until the response is ready (and are
+        dropped if the view fails); outside one they're queued straight
+        away.
+        """
+
+        assert name in self._handlers, f"Unknown job: {name}"
+        if has_request_context():
+            g.setdefault('pending_jobs', []).append((name, args))
+        else:
+            self.backend.put([(name, args)])
+            self._start_workers()
+
+    def _flush(self, response):
+        pending = g.pop('pending_jobs', None)
+        if pending:
+            if self.app.config['JOBS_INLINE']:
+                self._run_inline(pending)
+            else:
+                self.backend.put(pending)
+                self._start_workers()
+        return response
+
+    def _run_inline(self, pending):
+        for name, arg_lists in self._grouped(pending):
+            handler = self._handlers[name]
+            if handler.batched:
+                handler.fn(arg_lists)
+            else:
+                for args in arg_lists:
+                    handler.fn(*args)
+        with self._lock:
+            self.done += len(pending)
+
+    @staticmethod
+    def _grouped(jobs):
+        """`(name, [args, ...])` for `(name, args)` pairs, in order."""
+
+        groups = OrderedDict()
+        for name, args in jobs:
+            groups.setdefault(name, []).append(list(args))
+        return groups.items()
+
+    ##########################################################################
+    # Working
+
+    def run_once(self):
+        """Run one batch of ready jobs; returns how many were taken."""
+
+        jobs = self.backend.take(self.app.config['JOB_BATCH_SIZE'],
+                                 self.app.config['JOB_LEASE'])
+        if not jobs:
+            return 0
+
+        by_name = OrderedDict()
+        for job in jobs:
+            by_name.setdefault(job.name, []).append(job)
+
+        with self.app.app_context():
+            try:
+                for name, group in by_name.items():
+                    self._run_group(name, group)
+            finally:
+                db.session.remove()
+
+        return len(jobs)
+
+    def _run_group(self, name, group):
+        handler = self._handlers.get(name)
+        if handler is None:
+            for job in group:
+                self.backend.bury(job, f"Unknown job: {name}")
+            return
+
+        if handler.batched:
+            try:
+                handler.fn([job.args for job in group])
+            except Exception as e:
+                db.session.rollback()
+                if len(group) == 1:
+                    self._failed(group[0], e)
+                    return
+                # find the culprit(s): run the batch's jobs one by one
+                for job in group:
+                    self._run_group(name, [job])
+                return
+            self._succeeded(group)
+            return
+
+        for job in group:
+            try:
+                handler.fn(*job.args)
+            except Exception as e:
+                db.session.rollback()
+                self._failed(job, e)
+            else:
+                self._succeeded([job])
+
+    def _succeeded(self, jobs):
+        self.backend.ack([job.id for job in jobs])
+        with self._lock:
+            self.done += len(jobs)
+
+    def _failed(self, job, error):
+        log.exception("Job %s%r failed (attempt %d)", job.name,
+                      tuple(job.args), job.attempts + 1)
+        message = f"{type(error).__name__}: {error}"
+        if job.attempts + 1 >= self.app.config['JOB_MAX_ATTEMPTS']:
+            self.backend.bury(job, message)
+        else:
+            delay = self.app.config['JOB_RETRY_DELAY'] * 2**job.attempts
+            self.backend.retry(job, time.time() + delay, message)
+            with self._lock:
+                self.retried += 1
+
+    def work(self, burst=False, idle=1.0):
+        """Run jobs until stopped, or (if `burst`) until none are ready."""
+
+        while not self._stop.is_set():
+            try:
+                taken = self.run_once()
+            except Exception:
+                log.exception("Job worker error")
+                taken = 0
+            if not taken:
+                if burst:
+                    return
+                self.backend.wait(idle)
+
+    def _start_workers(self):
+        """Start JOB_WORKERS threads, the first time there's work."""
+
+        if self._threads or self.app.config['JOB_WORKERS'] < 1:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.app.config['JOB_WORKERS']):
+                thread = threading.Thread(
+                    target=self.work, name=f'jobs-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stop the worker threads after their current batch."""
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stop.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.backend.counts(), done=self.done,
+                        retried=self.retried,
+                        workers=len(self._threads))
@@ -0,0 +1,228 @@
+"""Versioned schema migrations.
+
+Each migration is a function of a connection, registered in order with
+`@migration(version, description)`. `upgrade()` runs the ones a database
+hasn't had yet, each in its own transaction together with its row in the
+`schema_migrations` table, so a failed migration leaves nothing half done.
+
+    flask migrate            apply pending migrations
+    flask migrate --status   list applied/pending ones
+
+A brand-new database gets the current schema from `db.create_all()` and is
+marked as fully migrated. Databases from before migrations existed (created
+by `db.create_all()` at some older revision) are treated as being at
+version 1, so migrations use the `*_if_missing` helpers and must be safe to
+re-run against a schema that already has their changes.
+
+With SHARD_URLS set, `flask migrate` also creates the messages, likes and
+flags tables on the other shards (see shards.py); a migration changing those
+tables has to be applied to every shard, not just this database.
+
+On a big Postgres table, create an index by hand first with
+`CREATE INDEX CONCURRENTLY` (same name) to avoid locking writes; the
+migration then finds it and skips it.
+"""
+
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, Table, Text,
+                        inspect)
+from sqlalchemy.schema import CreateColumn
+
+from models import (db, User, Message, FollowersFollowee, Like, Flag,
+                    Suggestion, IdCounter)
+import search
+
+Migration = namedtuple('Migration', ['version', 'description', 'upgrade'])
+
+MIGRATIONS = []
+
+migrations_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', migrations_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False))
+
+
+def migration(version, description):
+    """Register the decorated function as migration `version`."""
+
+    def decorator(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version
+        MIGRATIONS.append(Migration(version, description, fn))
+        return fn
+
+    return decorator
+
+
+##############################################################################
+# Helpers
+
+
+def add_column_if_missing(conn, column):
+    """Add model column `column` to its table unless it's there."""
+
+    table = column.table.name
+    existing = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column.name not in existing:
+        spec = CreateColumn(column).compile(dialect=conn.dialect)
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {spec}")
+
+
+def create_index_if_missing(conn, table, name):
+    """Create model index `name` of `table` unless it's there."""
+
+    existing = {index['name'] for index in inspect(conn).get_indexes(
+        table.name)}
+    if name not in existing:
+        index, = [index for index in table.indexes if index.name == name]
+        index.create(conn)
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, "Initial schema")
+def initial_schema(conn):
+    db.metadata.create_all(conn)
+
+
+@migration(2, "Follower/following/message/like counts on users")
+def user_counters(conn):
+    for column in ('messages_count', 'following_count', 'followers_count',
+                   'likes_count'):
+        add_column_if_missing(conn, User.__table__.c[column])
+
+    # like User.recompute_counts(), but on this connection -- and every
+    # message counted, as messages couldn't be hidden yet (see 5)
+    values = User.count_values()
+    values['messages_count'] = db.select([db.func.count()]).where(
+        Message.user_id == User.id).as_scalar()
+    conn.execute(User.__table__.update().values(values))
+
+
+@migration(3, "Indexes for feeds, profiles, followers, likes and flags")
+def hot_path_indexes(conn):
+    create_index_if_missing(conn, Message.__table__,
+                            'ix_messages_user_id_timestamp')
+    create_index_if_missing(conn, Message.__table__, 'ix_messages_timestamp')
+    create_index_if_missing(conn, FollowersFollowee.__table__,
+                            'ix_follows_follower_id')
+    create_index_if_missing(conn, Like.__table__, 'ix_likes_user_id')
+    create_index_if_missing(conn, Flag.__table__, 'ix_flags_user_id')
+
+
+@migration(4, "Like counts on messages")
+def message_like_counts(conn):
+    add_column_if_missing(conn, Message.__table__.c.likes_count)
+    conn.execute(Message.__table__.update().values(
+        likes_count=Message.count_values()['likes_count']))
+
+
+@migration(5, "Flag reasons, flag counts and hidden messages")
+def flag_moderation(conn):
+    add_column_if_missing(conn, Flag.__table__.c.reason)
+    add_column_if_missing(conn, Message.__table__.c.flags_count)
+    add_column_if_missing(conn, Message.__table__.c.hidden)
+    create_index_if_missing(conn, Message.__table__, 'ix_messages_flags_count')
+    conn.execute(Message.__table__.update().values(
+        flags_count=Message.count_values()['flags_count']))
+
+
+@migration(6, "Who-to-follow suggestions")
+def suggestions_table(conn):
+    Suggestion.__table__.create(conn, checkfirst=True)
+
+
+@migration(7, "Shard directory and message id counter")
+def shard_directory(conn):
+    add_column_if_missing(conn, User.__table__.c.shard)
+    IdCounter.__table__.create(conn, checkfirst=True)
+
+
+@migration(8, "Full-text search indexes (Postgres)")
+def search_indexes(conn):
+    search.create_indexes(conn)
+
+
+##############################################################################
+# Running them
+
+
+def applied_versions(conn):
+    return {
+        row[0]
+        for row in conn.execute(db.select([schema_migrations.c.version]))
+    }
+
+
+def _record(conn, mig):
+    conn.execute(schema_migrations.insert().values(
+        version=mig.version,
+        description=mig.description,
+        applied_at=datetime.datetime.utcnow()))
+
+
+def stamp(engine=None):
+    """Mark every migration as applied (for a schema just made current by
+    `db.create_all()`)."""
+
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        migrations_metadata.create_all(conn)
+        done = applied_versions(conn)
+        for mig in MIGRATIONS:
+            if mig.version not in done:
+                _record(conn, mig)
+
+
+def upgrade(engine=None, log=print):
+    """Apply pending migrations; returns the versions applied."""
+
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        tracked = engine.dialect.has_table(conn, 'schema_migrations')
+        has_tables = engine.dialect.has_table(conn, User.__tablename__)
+        migrations_metadata.create_all(conn)
+
+        if not tracked:
+            if not has_tables:
+                db.metadata.create_all(conn)
+                for mig in MIGRATIONS:
+                    _record(conn, mig)
+                log("Created the schema at version "
+                    f"{MIGRATIONS[-1].version}.")
+                return [mig.version for mig in MIGRATIONS]
+
+            # made by create_all() before migrations existed
+            _record(conn, MIGRATIONS[0])
+
+        done = applied_versions(conn)
+
+    applied = []
+    for mig in MIGRATIONS:
+        if mig.version in done:
+            continue
+        with engine.begin() as conn:
+            mig.upgrade(conn)
+            _record(conn, mig)
+        log(f"Applied {mig.version}: {mig.description}")
+        applied.append(mig.version)
+
+    return applied
+
+
+def status(engine=None):
+    """`(migration, applied?)` for every migration."""
+
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        done = set()
+        if engine.dialect.has_table(conn, 'schema_migrations'):
+            done = applied_versions(conn)
+    return [(mig, mig.version in done) for mig in MIGRATIONS]
@@ -2,18 +2,30 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import passwords
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class FollowersFollowee(db.Model):
-    """Connection of a follower <-> followee."""
+    """Connection of a follower <-> followee.
+
+    NB: the column names read backwards -- `User.following.append()` stores
+    the user doing the following in `followee_id` and the user being
+    followed in `follower_id`. Use the helpers below rather than the raw
+    columns.
+    """
 
     __tablename__ = 'follows'
 
+    # The primary key covers lookups by `followee_id` (who a user follows);
+    # this covers the reverse (a user's followers).
+    __table_args__ = (db.Index('ix_follows_follower_id', 'follower_id',
+                               'followee_id'), )
+
     followee_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,6 +38,55 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def follower_ids(cls, user_id):
+        """Query for the ids of users following `user_id`."""
+
+        return db.session.query(cls.followee_id).filter(
+            cls.follower_id == user_id)
+
+    @classmethod
+    def following_ids(cls, user_id):
+        """Query for the ids of users that `user_id` follows."""
+
+        return db.session.query(cls.follower_id).filter(
+            cls.followee_id == user_id)
+
+    @classmethod
+    def exists(cls, user_id, other_id):
+        """Does `user_id` follow `other_id`? A primary key lookup."""
+
+        return db.session.query(
+            cls.query.filter(cls.followee_id == user_id,
+                             cls.follower_id == other_id).exists()).scalar()
+
+    @classmethod
+    def following_among(cls, user_id, other_ids):
+        """Which of `other_ids` does `user_id` follow? Returns a set."""
+
+        if not other_ids:
+            return set()
+
+        return {
+            row[0]
+            for row in cls.following_ids(user_id).filter(
+                cls.follower_id.in_(other_ids))
+        }
+
+    @classmethod
+    def add(cls, user_id, other_id):
+        """Record that `user_id` now follows `other_id`."""
+
+        db.session.add(cls(followee_id=user_id, follower_id=other_id))
+
+    @classmethod
+    def remove(cls, user_id, other_id):
+        """Record that `user_id` no longer follows `other_id`."""
+
+        cls.query.filter(cls.followee_id == user_id,
+                         cls.follower_id == other_id).delete(
+                             synchronize_session=False)
+
 
 class User(db.Model):
     """User in the system."""
@@ -63,6 +124,24 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts shown on profiles, kept in step by the routes that
+    # change them (see `adjust_counts()`); `recompute_counts()` repairs them.
+    messages_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    following_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    followers_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    likes_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    # The database holding their messages; see shards.py
+    shard = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
     messages = db.relationship('Message', backref='user')
     flags = db.relationship('Flag', backref='user')
     liked_msgs = db.relationship(
@@ -81,18 +160,157 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user
-        ]
-        return len(found_user_list) == 1
+        return FollowersFollowee.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user
-        ]
-        return len(found_user_list) == 1
+        return FollowersFollowee.exists(self.id, other_user.id)
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set.
+
+        One query however many ids; use this rather than calling
+        `is_following()` in a loop.
+        """
+
+        return FollowersFollowee.following_among(self.id, user_ids)
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of `user_ids` (an id, list or query).
+
+        Done as a single UPDATE so concurrent requests can't lose updates;
+        it joins the caller's transaction, so commit along with the change
+        being counted:
+
+            User.adjust_counts(user.id, messages_count=1)
+        """
+
+        if isinstance(user_ids, int):
+            criterion = cls.id == user_ids
+        elif isinstance(user_ids, (list, tuple, set)) and not user_ids:
+            return
+        else:
+            criterion = cls.id.in_(user_ids)
+
+        cls.query.filter(criterion).update(
+            {
+                getattr(cls, name): getattr(cls, name) + delta
+                for name, delta in deltas.items()
+            },
+            synchronize_session=False)
+
+    @classmethod
+    def recompute_counts(cls):
+        """Recount every user's counters from the underlying tables."""
+
+        values = cls.count_values()
+        if not db.shards.sharded:
+            cls.query.update(values, synchronize_session=False)
+            return
+
+        # messages and likes are spread over the shards: count them on
+        # each, and add up here
+        cls.query.update(
+            {
+                'following_count': values['following_count'],
+                'followers_count': values['followers_count'],
+                'messages_count': 0,
+                'likes_count': 0,
+            },
+            synchronize_session=False)
+
+        counts = {}
+        for _ in db.shards.each():
+            for name, query in (
+                ('messages_count', db.session.query(
+                    Message.user_id, db.func.count()).filter(
+                        Message.hidden == db.false()).group_by(
+                            Message.user_id)),
+                ('likes_count', db.session.query(
+                    Like.user_id, db.func.count()).group_by(Like.user_id)),
+            ):
+                for user_id, count in query:
+                    row = counts.setdefault(user_id, dict(
+                        id=user_id, messages_count=0, likes_count=0))
+                    row[name] += count
+
+        db.session.bulk_update_mappings(cls, list(counts.values()))
+
+    @classmethod
+    def count_values(cls):
+        """`{counter column: correlated COUNT subquery}` for an UPDATE."""
+
+        def count(*criteria):
+            return db.select([db.func.count()]).where(
+                db.and_(*criteria)).as_scalar()
+
+        # (remember: follows.followee_id is the follower; see FollowersFollowee)
+        return {
+            'messages_count': count(Message.user_id == cls.id,
+                                    Message.hidden == db.false()),
+            'following_count': count(FollowersFollowee.followee_id == cls.id),
+            'followers_count': count(FollowersFollowee.follower_id == cls.id),
+            'likes_count': count(Like.user_id == cls.id),
+        }
+
+    @classmethod
+    def delete_account(cls, user_id):
+        """Delete user `user_id` with their messages, likes, flags and follows.
+
+        Everyone else's counters that referenced them are adjusted in the
+        same transaction (one per database, when sharded).
+        """
+
+        cls.adjust_counts(
+            FollowersFollowee.following_ids(user_id), followers_count=-1)
+        cls.adjust_counts(
+            FollowersFollowee.follower_ids(user_id), following_count=-1)
+
+        # their messages, and the likes and flags on them, are on their
+        # shard; others lose one like for each of these messages they liked
+        with db.shards.for_user(user_id):
+            own_msg_ids = db.session.query(Message.id).filter(
+                Message.user_id == user_id)
+            liked_here = (db.session.query(Like.user_id, db.func.count())
+                          .filter(Like.msg_id.in_(own_msg_ids),
+                                  Like.user_id != user_id)
+                          .group_by(Like.user_id).all())
+
+            for mark in (Like, Flag):
+                mark.query.filter(mark.msg_id.in_(own_msg_ids)).delete(
+                    synchronize_session=False)
+            Message.query.filter(Message.user_id == user_id).delete(
+                synchronize_session=False)
+
+        likers_by_count = {}
+        for liker_id, count in liked_here:
+            likers_by_count.setdefault(count, []).append(liker_id)
+        for count, liker_ids in likers_by_count.items():
+            cls.adjust_counts(liker_ids, likes_count=-count)
+
+        # their likes and flags can be on any shard; the messages they
+        # marked lose one
+        for _ in db.shards.each():
+            for mark, counter in ((Like, Message.likes_count),
+                                  (Flag, Message.flags_count)):
+                Message.query.filter(
+                    Message.id.in_(
+                        db.session.query(mark.msg_id).filter(
+                            mark.user_id == user_id))).update(
+                                {counter: counter - 1},
+                                synchronize_session=False)
+                mark.query.filter(mark.user_id == user_id).delete(
+                    synchronize_session=False)
+
+        Suggestion.query.filter(Suggestion.user_id == user_id).delete(
+            synchronize_session=False)
+        FollowersFollowee.query.filter(
+            db.or_(FollowersFollowee.followee_id == user_id,
+                   FollowersFollowee.follower_id == user_id)).delete(
+                       synchronize_session=False)
+        cls.query.filter(cls.id == user_id).delete(synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -101,13 +319,14 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
             email=email,
             password=hashed_pwd,
             image_url=image_url,
+            shard=db.shards.new_user_shard(),
         )
 
         db.session.add(user)
@@ -122,13 +341,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made with a different work factor than the configured one is
+        replaced (the caller commits).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash(password)
                 return user
 
         return False
@@ -139,6 +363,16 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Feeds and profiles filter on user_id and walk (timestamp, id) newest
+    # first; a B-tree serves that order by scanning backwards, so no DESC.
+    # The moderation queue walks (flags_count, id) the same way.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp',
+                 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp', 'id'),
+        db.Index('ix_messages_flags_count', 'flags_count', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -152,7 +386,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -161,30 +395,291 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step by `Like.apply()`, so showing it needn't load `users_like`
+    likes_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    # Kept in step by `Flag.apply()`; see `set_hidden()`
+    flags_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+
+    # Hidden messages are left out of feeds, profiles, likes pages and
+    # search, and don't count towards their author's messages_count
+    hidden = db.Column(
+        db.Boolean, nullable=False, default=False, server_default=db.false())
+
+    @classmethod
+    def visible(cls):
+        """Query for the messages that aren't hidden."""
+
+        return cls.query.filter(cls.hidden == db.false())
+
+    @classmethod
+    def by_author(cls, user_id):
+        """Query for `user_id`'s visible messages (all on their shard)."""
+
+        return cls.visible().filter(cls.user_id == user_id)
+
+    @classmethod
+    def liked_by(cls, user_id):
+        """Query for the visible messages `user_id` likes (on any shard)."""
+
+        return cls.visible().join(Like, Like.msg_id == cls.id).filter(
+            Like.user_id == user_id)
+
+    @classmethod
+    def set_hidden(cls, msg_id, hidden, min_flags=0):
+        """Hide (or show) message `msg_id`; when hiding, only if it has at
+        least `min_flags` flags.
+
+        A single conditional UPDATE, so of several concurrent requests only
+        one changes it -- and adjusts its author's messages_count. Returns
+        whether it changed; the caller commits.
+        """
+
+        query = cls.query.filter(cls.id == msg_id, cls.hidden == (not hidden))
+        if hidden and min_flags:
+            query = query.filter(cls.flags_count >= min_flags)
 
-class Like(db.Model):
+        if not query.update({cls.hidden: hidden}, synchronize_session=False):
+            return False
+
+        # (the author is looked up first: users may be on another database)
+        author_id = db.session.query(cls.user_id).filter(
+            cls.id == msg_id).scalar()
+        User.adjust_counts(author_id, messages_count=-1 if hidden else 1)
+        return True
+
+    @classmethod
+    def recompute_counts(cls):
+        """Recount every message's likes and flags from their tables."""
+
+        for _ in db.shards.each():
+            cls.query.update(cls.count_values(), synchronize_session=False)
+
+    @classmethod
+    def count_values(cls):
+        """`{counter column: correlated COUNT subquery}` for an UPDATE."""
+
+        def count(mark):
+            return db.select([db.func.count()]).where(
+                mark.msg_id == cls.id).as_scalar()
+
+        return {
+            'likes_count': count(Like),
+            'flags_count': count(Flag),
+        }
+
+
+class UserMessageMark:
+    """Shared helpers for the user -> message marks (likes, flags)."""
+
+    @classmethod
+    def add(cls, user_id, msg_id, **values):
+        """Record that `user_id` marked `msg_id` (with column `values`),
+        unless they already have or the message doesn't exist. One
+        statement; returns whether it added a mark."""
+
+        columns = [cls.msg_id, cls.user_id] + [
+            getattr(cls, name) for name in values
+        ]
+        source = db.select(
+            [Message.id, db.literal(user_id)] +
+            [db.literal(value) for value in values.values()]).where(
+                Message.id == msg_id)
+
+        dialect = db.session.get_bind(cls.__mapper__).dialect.name
+        if dialect == 'postgresql':
+            stmt = pg_insert(cls.__table__).from_select(
+                columns, source).on_conflict_do_nothing()
+        elif dialect == 'sqlite':
+            stmt = cls.__table__.insert().from_select(
+                columns, source).prefix_with('OR IGNORE')
+        else:
+            stmt = cls.__table__.insert().from_select(
+                columns,
+                source.where(~db.exists().where(
+                    db.and_(cls.msg_id == msg_id, cls.user_id == user_id))))
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, msg_id):
+        """Record that `user_id` hasn't marked `msg_id`; returns whether
+        they had."""
+
+        return cls.query.filter(cls.user_id == user_id,
+                                cls.msg_id == msg_id).delete(
+                                    synchronize_session=False) == 1
+
+    @classmethod
+    def msg_ids_among(cls, user_id, msg_ids):
+        """Which of `msg_ids` has `user_id` marked? Returns a set."""
+
+        if not msg_ids:
+            return set()
+
+        return {
+            row[0]
+            for row in db.session.query(cls.msg_id).filter(
+                cls.user_id == user_id, cls.msg_id.in_(msg_ids))
+        }
+
+
+class Like(UserMessageMark, db.Model):
     """Connection of msg <- users"""
 
     __tablename__ = 'likes'
 
+    # The primary key leads with msg_id; this serves a user's likes.
+    __table_args__ = (db.Index('ix_likes_user_id', 'user_id', 'msg_id'), )
+
     msg_id = db.Column(
         db.Integer, db.ForeignKey('messages.id'), primary_key=True)
 
     user_id = db.Column(
         db.Integer, db.ForeignKey('users.id'), primary_key=True)
 
+    @classmethod
+    def apply(cls, user_id, like=(), unlike=()):
+        """Make `user_id` like the messages `like` and not `unlike`.
+
+        Idempotent: messages already in the wanted state are left alone.
+        Adjusts the user's and the messages' counts for what changed, in
+        the caller's transaction. Returns `(liked, unliked)`, the ids that
+        changed.
+        """
 
-class Flag(db.Model):
+        # a like lives with its message, so on the message's shard
+        shards = db.shards.locate_messages(list(like) + list(unlike))
+
+        liked, unliked = [], []
+        for shard in db.shards.each(sorted(set(shards.values()))):
+            liked_here = [
+                msg_id for msg_id in like
+                if shards.get(msg_id) == shard and cls.add(user_id, msg_id)
+            ]
+            unliked_here = [
+                msg_id for msg_id in unlike
+                if shards.get(msg_id) == shard and cls.remove(user_id, msg_id)
+            ]
+
+            for msg_ids, delta in ((liked_here, 1), (unliked_here, -1)):
+                if msg_ids:
+                    Message.query.filter(Message.id.in_(msg_ids)).update(
+                        {Message.likes_count: Message.likes_count + delta},
+                        synchronize_session=False)
+
+            liked += liked_here
+            unliked += unliked_here
+
+        if len(liked) != len(unliked):
+            User.adjust_counts(user_id, likes_count=len(liked) - len(unliked))
+
+        return liked, unliked
+
+
+class Flag(UserMessageMark, db.Model):
     """Connection of flag <- users"""
 
     __tablename__ = 'flags'
 
+    __table_args__ = (db.Index('ix_flags_user_id', 'user_id', 'msg_id'), )
+
     msg_id = db.Column(
         db.Integer, db.ForeignKey('messages.id'), primary_key=True)
 
     user_id = db.Column(
         db.Integer, db.ForeignKey('users.id'), primary_key=True)
 
+    reason = db.Column(db.Text)
+
+    @classmethod
+    def apply(cls, user_id, msg_id, flagged, reason=None):
+        """Make `user_id`'s flag of `msg_id` match `flagged`.
+
+        Idempotent, like `Like.apply()`, keeping the message's flags_count
+        in step. Returns whether the flag changed; the caller commits.
+        Sharded, run it on the message's shard (as `clear()` and `reasons()`).
+        """
+
+        if flagged:
+            if not cls.add(user_id, msg_id, reason=reason):
+                return False
+            delta = 1
+        else:
+            if not cls.remove(user_id, msg_id):
+                return False
+            delta = -1
+
+        Message.query.filter(Message.id == msg_id).update(
+            {Message.flags_count: Message.flags_count + delta},
+            synchronize_session=False)
+        return True
+
+    @classmethod
+    def clear(cls, msg_id):
+        """Drop every flag on `msg_id` (a moderator has dealt with them)."""
+
+        cls.query.filter(cls.msg_id == msg_id).delete(
+            synchronize_session=False)
+        Message.query.filter(Message.id == msg_id).update(
+            {Message.flags_count: 0}, synchronize_session=False)
+
+    @classmethod
+    def reasons(cls, msg_ids):
+        """`{msg_id: [(reason, count), ...]}`, most given first."""
+
+        if not msg_ids:
+            return {}
+
+        reasons = {}
+        for msg_id, reason, count in (
+                db.session.query(cls.msg_id, cls.reason, db.func.count())
+                .filter(cls.msg_id.in_(msg_ids))
+                .group_by(cls.msg_id, cls.reason)
+                .order_by(cls.msg_id, db.func.count().desc(), cls.reason)):
+            reasons.setdefault(msg_id, []).append((reason, count))
+        return reasons
+
+
+class Suggestion(db.Model):
+    """A precomputed "who to follow" suggestion; see suggestions.py."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    rank = db.Column(db.Integer, primary_key=True)
+
+    # No foreign key: suggested users who've since been deleted drop out of
+    # the join in `for_user()`, and out of the table at the next batch run.
+    suggested_id = db.Column(db.Integer, nullable=False)
+
+    score = db.Column(db.Float, nullable=False)
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """The `limit` best suggested users for `user_id`, best first."""
+
+        return (User.query.join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user_id).order_by(cls.rank)
+                .limit(limit).all())
+
+
+class IdCounter(db.Model):
+    """Ids handed out across shards, a block at a time; see shards.py."""
+
+    __tablename__ = 'id_counters'
+
+    name = db.Column(db.Text, primary_key=True)
+
+    value = db.Column(db.Integer, nullable=False)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,145 @@
+"""Keyset ("cursor") pagination for Warbler's list views.
+
+Rather than OFFSET, each page asks for rows strictly *after* the last row of
+the previous page in the list's sort order, so fetching page 500 costs the
+same as page 1 -- an index range scan of `per_page` rows.
+
+Messages are ordered newest-first on `(timestamp, id)` (the moderation
+queue: most-flagged first on `(flags_count, id)`); users newest-first on
+`id`. The position is handed to the client as an opaque `?before=` token.
+"""
+
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import request, abort
+from sqlalchemy import tuple_
+
+from models import Message, User
+
+EPOCH = datetime(1970, 1, 1)
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def to_micros(dt):
+    """Naive UTC datetime -> integer microseconds since the epoch."""
+
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+
+def from_micros(micros):
+    """Inverse of `to_micros`."""
+
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def encode_cursor(*values):
+    """Pack `values` into an opaque, URL-safe token."""
+
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, arity):
+    """Unpack a token from `encode_cursor` holding `arity` integers.
+
+    Returns None for a missing cursor; raises ValueError for a bad one.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Bad cursor: {cursor!r}")
+
+    if (not isinstance(values, list) or len(values) != arity
+            or not all(isinstance(v, int) for v in values)):
+        raise ValueError(f"Bad cursor: {cursor!r}")
+
+    return tuple(values)
+
+
+def cursor_arg(arity, name='before'):
+    """Decode the cursor in query-string param `name`, 400 if it's bad."""
+
+    try:
+        return decode_cursor(request.args.get(name), arity)
+    except ValueError:
+        abort(400)
+
+
+def message_key(msg):
+    """Sort position of `msg`: `(timestamp in micros, id)`."""
+
+    return (to_micros(msg.timestamp), msg.id)
+
+
+def page_from(items, per_page, key):
+    """Trim the `per_page + 1` rows fetched into a Page.
+
+    `key` gives an item's sort position, which becomes the next cursor.
+    """
+
+    items = list(items)
+    if len(items) > per_page:
+        items = items[:per_page]
+        return Page(items, encode_cursor(*key(items[-1])))
+
+    return Page(items, None)
+
+
+def newest_messages(query, before, limit):
+    """`query` (over Message) narrowed to the `limit` newest messages older
+    than message cursor `before` (or the newest overall if it's None)."""
+
+    if before is not None:
+        query = query.filter(
+            tuple_(Message.timestamp, Message.id) < tuple_(
+                from_micros(before[0]), before[1]))
+
+    return (query.order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def paginate_messages(query, before, per_page):
+    """Page of `query` (over Message) older than message cursor `before`."""
+
+    items = newest_messages(query, before, per_page + 1).all()
+    return page_from(items, per_page, message_key)
+
+
+def flagged_key(msg):
+    """Moderation queue position of `msg`: `(flags_count, id)`."""
+
+    return (msg.flags_count, msg.id)
+
+
+def most_flagged(query, before, limit):
+    """`query` (over Message) narrowed to the `limit` most-flagged messages
+    after flag cursor `before`."""
+
+    if before is not None:
+        query = query.filter(
+            tuple_(Message.flags_count, Message.id) < tuple_(*before))
+
+    return (query.order_by(Message.flags_count.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def paginate_users(query, before, per_page):
+    """Page of `query` (over User) with ids below user cursor `before`."""
+
+    if before is not None:
+        query = query.filter(User.id < before[0])
+
+    items = query.order_by(User.id.desc()).limit(per_page + 1).all()
+    return page_from(items, per_page, lambda user: (user.id, ))
+
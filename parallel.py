@@ -0,0 +1,86 @@
+"""Run a request's independent queries at the same time.
+
+A page often needs several things from the database that don't depend on
+each other -- the home page's messages, which of them the user liked and
+flagged, and who to suggest. With PARALLEL_QUERIES on (the ASGI entry point
+turns it on; see asgi.py), `run()` starts all but the first on a pool of
+PARALLEL_WORKERS threads and does the first itself, so the page waits for
+the slowest rather than the sum:
+
+    msgs, liked = parallel.run(
+        lambda: load_messages(ids),
+        lambda: Like.msg_ids_among(user_id, ids))
+
+Each call on the pool gets its own app context and database session, closed
+when it returns -- so what it returns must not need lazy loading -- and the
+request's replica (see replicas.py) and query counters. With it off the
+calls simply run one after another.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, has_app_context
+
+import query_counter
+
+
+class Parallel:
+    """Pool for concurrent queries, wired up like `db`.
+
+        parallel = Parallel()
+        parallel.init_app(app)
+    """
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.calls = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PARALLEL_QUERIES', False)
+        app.config.setdefault('PARALLEL_WORKERS', 8)
+        self.app = app
+
+    def run(self, *calls):
+        """`[call() for call in calls]`, concurrently if PARALLEL_QUERIES."""
+
+        if not self.app.config['PARALLEL_QUERIES'] or len(calls) < 2:
+            return [call() for call in calls]
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.app.config['PARALLEL_WORKERS'],
+                        thread_name_prefix='parallel')
+
+        replica = g.get('db_replica') if has_app_context() else None
+        counters = query_counter.active()
+        futures = [
+            self._executor.submit(self._call, call, replica, counters)
+            for call in calls[1:]
+        ]
+        with self._lock:
+            self.batches += 1
+            self.calls += len(calls)
+
+        first = calls[0]()
+        return [first] + [future.result() for future in futures]
+
+    def _call(self, call, replica, counters):
+        with self.app.app_context():
+            if replica is not None:
+                g.db_replica = replica
+            with query_counter.adopt(counters):
+                return call()
+
+    def stats(self):
+        return dict(
+            enabled=self.app.config['PARALLEL_QUERIES'],
+            workers=self.app.config['PARALLEL_WORKERS'],
+            batches=self.batches,
+            calls=self.calls)
@@ -0,0 +1,535 @@
+"""Live home feeds: new messages pushed to connected clients.
+
+A client keeps `GET /api/v1/feed/stream` open (server-sent events; see
+app.py) and is sent each new message by someone it follows, or by itself,
+as the /api/v1/feed JSON of just that message:
+
+    id: <cursor>
+    event: messages
+    data: {"messages": [...], "users": [...]}
+
+so it needn't reload the feed to see it. Browsers' EventSource reconnects
+by itself, sending the last event's id; the stream then starts with what
+was missed, from the timeline -- or an `event: resync` if that's more than
+a page, meaning reload the feed.
+
+Posting publishes an event through a broker, picked with PUSH_BROKER_URL:
+
+    memory://               this process only (default; fine for one worker)
+    sqlite:////path/to.db   local file, shared by every worker on the box
+    postgresql://...        the database's LISTEN/NOTIFY, for workers on
+                            any box
+
+Every worker hears every event. It renders a message once (a couple of
+queries, and none if no one it serves follows the author) and queues it for
+each of its connections that want it. Connections don't hold the publisher
+up: one PUSH_QUEUE_SIZE events behind is closed, and catches up when it
+reconnects. A worker takes at most PUSH_MAX_CONNECTIONS streams; more get
+a 503. An idle stream is sent a comment every PUSH_HEARTBEAT seconds, which
+also notices clients that have gone.
+
+Under the ASGI entry point the streams are served from the event loop
+(see asgi.py); under threaded workers each one holds a thread. A
+single-threaded worker would be held by one stream, so takes just
+PUSH_SYNC_MAX_CONNECTIONS (default none).
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import select
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from pagination import encode_cursor
+
+log = logging.getLogger(__name__)
+
+# sent first: how long browsers wait before reconnecting, in milliseconds
+PRELUDE = b"retry: 2000\n\n"
+
+KEEPALIVE = b": keep-alive\n\n"
+
+RESYNC = b"event: resync\ndata: {}\n\n"
+
+
+class PushBusy(Exception):
+    """This worker has as many streams as it takes."""
+
+
+def sse(event, data, id=None):
+    """A server-sent event, as bytes."""
+
+    lines = [f"id: {id}"] if id is not None else []
+    lines += [f"event: {event}", f"data: {data}"]
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+##############################################################################
+# Brokers
+
+
+class Broker:
+    """Interface for pub/sub brokers: every listener, in every worker, gets
+    every event published."""
+
+    def publish(self, event):
+        """Send JSON-able `event` to all listeners."""
+
+        raise NotImplementedError
+
+    def listen(self, deliver):
+        """Call `deliver(event)` for each event from now on, on a thread of
+        the broker's."""
+
+        raise NotImplementedError
+
+    def close(self):
+        """Stop listening."""
+
+
+class MemoryBroker(Broker):
+    """Events for this process only."""
+
+    def __init__(self):
+        self._events = queue.Queue()
+        self._thread = None
+
+    def publish(self, event):
+        self._events.put(json.loads(json.dumps(event)))
+
+    def listen(self, deliver):
+        def run():
+            while True:
+                event = self._events.get()
+                if event is None:
+                    return
+                deliver(event)
+
+        self._thread = threading.Thread(
+            target=run, name='push-broker', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._events.put(None)
+
+
+class SQLiteBroker(Broker):
+    """Events in a local SQLite file, polled by every worker on the box."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS push_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+    """
+
+    # seconds between polls, and how long events are kept for the others
+    POLL = 0.2
+    KEEP = 60
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        with self._lock:
+            self._conn.executescript(self.SCHEMA)
+
+    def publish(self, event):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO push_events (event, at) VALUES (?, ?)",
+                (json.dumps(event), now))
+            self._conn.execute("DELETE FROM push_events WHERE at < ?",
+                               (now - self.KEEP, ))
+
+    def listen(self, deliver):
+        with self._lock:
+            last, = self._conn.execute(
+                "SELECT coalesce(max(id), 0) FROM push_events").fetchone()
+
+        def run():
+            nonlocal last
+            while not self._stop.wait(self.POLL):
+                with self._lock:
+                    rows = self._conn.execute(
+                        "SELECT id, event FROM push_events WHERE id > ? "
+                        "ORDER BY id", (last, )).fetchall()
+                for last, event in rows:
+                    deliver(json.loads(event))
+
+        threading.Thread(target=run, name='push-broker', daemon=True).start()
+
+    def close(self):
+        self._stop.set()
+
+
+class PostgresBroker(Broker):
+    """Events sent with the database's NOTIFY, heard with LISTEN."""
+
+    CHANNEL = 'warbler_push'
+
+    # seconds to wait before reconnecting after losing the connection
+    RECONNECT = 1.0
+
+    def __init__(self, url):
+        import psycopg2
+
+        self._connect = lambda: psycopg2.connect(url)
+        self._publisher = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def publish(self, event):
+        with self._lock:
+            try:
+                if self._publisher is None or self._publisher.closed:
+                    self._publisher = self._connect()
+                    self._publisher.autocommit = True
+                with self._publisher.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)",
+                                   (self.CHANNEL, json.dumps(event)))
+            except Exception:
+                self._publisher = None
+                raise
+
+    def listen(self, deliver):
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self._listen(deliver)
+                except Exception:
+                    log.exception("Push broker connection lost")
+                    self._stop.wait(self.RECONNECT)
+
+        threading.Thread(target=run, name='push-broker', daemon=True).start()
+
+    def _listen(self, deliver):
+        conn = self._connect()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.CHANNEL}")
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    deliver(json.loads(conn.notifies.pop(0).payload))
+        finally:
+            conn.close()
+
+    def close(self):
+        self._stop.set()
+
+
+def broker_from_url(url):
+    """Build the push broker named by `url`."""
+
+    if url == "memory://":
+        return MemoryBroker()
+
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+
+    if url.startswith(("postgresql://", "postgres://")):
+        return PostgresBroker(url)
+
+    raise ValueError(f"Unknown push broker: {url}")
+
+
+##############################################################################
+# Streams
+
+
+class Subscription:
+    """One client's stream: the events for it, waiting to be sent."""
+
+    def __init__(self, hub, user_id, author_ids):
+        self.hub = hub
+        self.user_id = user_id
+        self.author_ids = set(author_ids) | {user_id}
+        self.closed = False
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        self._wake = None
+
+    def put(self, chunk):
+        """Queue `chunk` to send; a stream too far behind is closed."""
+
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._chunks) >= self.hub.queue_size:
+                self.hub.overflowed += 1
+                self.closed = True
+            else:
+                self._chunks.append(chunk)
+            self._cond.notify()
+        if self._wake is not None:
+            self._wake()
+
+    def _take(self):
+        with self._cond:
+            chunks = b"".join(self._chunks)
+            self._chunks.clear()
+            return chunks, self.closed
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.hub.unsubscribe(self)
+
+    def chunks(self, first=b""):
+        """The stream's bytes, `first` first; blocks the thread between
+        events."""
+
+        try:
+            yield PRELUDE + first
+            while True:
+                with self._cond:
+                    if not self._chunks and not self.closed:
+                        self._cond.wait(self.hub.heartbeat)
+                chunks, closed = self._take()
+                if chunks:
+                    yield chunks
+                elif closed:
+                    return
+                else:
+                    yield KEEPALIVE
+        finally:
+            self.close()
+
+    def async_chunks(self, first=b""):
+        """`chunks()` for an event loop, waiting without a thread."""
+
+        return AsyncChunks(self, self._async_chunks(first))
+
+    async def _async_chunks(self, first):
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Event()
+        self._wake = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            yield PRELUDE + first
+            while True:
+                ready.clear()
+                chunks, closed = self._take()
+                if chunks:
+                    yield chunks
+                elif closed:
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(ready.wait(),
+                                               self.hub.heartbeat)
+                    except asyncio.TimeoutError:
+                        yield KEEPALIVE
+        finally:
+            self.close()
+
+
+class AsyncChunks:
+    """A subscription's async chunks, unsubscribing when closed -- even if
+    never iterated (a generator's `finally` wouldn't run)."""
+
+    def __init__(self, subscription, chunks):
+        self.subscription = subscription
+        self._chunks = chunks
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._chunks.__anext__()
+
+    async def aclose(self):
+        try:
+            await self._chunks.aclose()
+        finally:
+            self.subscription.close()
+
+
+class Push:
+    """Pushes new messages to open streams, wired up like `db`.
+
+        push = Push()
+        push.init_app(app)
+
+    The app registers how to render messages for the streams:
+
+        @push.renderer
+        def render(entries):
+            return JSON-able payload for timeline entries `entries`
+    """
+
+    def __init__(self, app=None):
+        self.broker = None
+        self.render = None
+        self._subscriptions = set()
+        self._by_author = {}
+        self._lock = threading.Lock()
+        self._listening = False
+        self.published = 0
+        self.delivered = 0
+        self.overflowed = 0
+        self.refused = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PUSH_BROKER_URL', 'memory://')
+        app.config.setdefault('PUSH_MAX_CONNECTIONS', 500)
+        app.config.setdefault('PUSH_SYNC_MAX_CONNECTIONS', 0)
+        app.config.setdefault('PUSH_QUEUE_SIZE', 64)
+        app.config.setdefault('PUSH_HEARTBEAT', 15.0)
+
+        self.app = app
+        self.broker = broker_from_url(app.config['PUSH_BROKER_URL'])
+
+    @property
+    def heartbeat(self):
+        return self.app.config['PUSH_HEARTBEAT']
+
+    @property
+    def queue_size(self):
+        return self.app.config['PUSH_QUEUE_SIZE']
+
+    def renderer(self, fn):
+        """Register `fn(entries)`, rendering new messages for the streams."""
+
+        self.render = fn
+        return fn
+
+    ##########################################################################
+    # Publishing
+
+    def message(self, entry):
+        """Tell every worker about new message `entry` (a timeline entry)."""
+
+        self._publish({'message': list(entry)})
+
+    def follow(self, user_id, followee_id):
+        """`user_id` started following `followee_id`: stream their posts."""
+
+        self._publish({'follow': [user_id, followee_id]})
+
+    def unfollow(self, user_id, followee_id):
+        """`user_id` stopped following `followee_id`."""
+
+        self._publish({'unfollow': [user_id, followee_id]})
+
+    def _publish(self, event):
+        try:
+            self.broker.publish(event)
+            self.published += 1
+        except Exception:
+            # a missed push is only a delay: the feed still has it
+            log.exception("Couldn't publish %r", event)
+
+    ##########################################################################
+    # Delivering
+
+    def _listen(self):
+        with self._lock:
+            if self._listening:
+                return
+            self._listening = True
+        self.broker.listen(self._deliver)
+
+    def _deliver(self, event):
+        try:
+            if 'message' in event:
+                self._deliver_message(tuple(event['message']))
+            elif 'follow' in event:
+                self._refollow(*event['follow'], True)
+            elif 'unfollow' in event:
+                self._refollow(*event['unfollow'], False)
+        except Exception:
+            log.exception("Couldn't deliver %r", event)
+
+    def _deliver_message(self, entry):
+        with self._lock:
+            subscriptions = list(self._by_author.get(entry[2], ()))
+        if not subscriptions:
+            return
+
+        with self.app.app_context():
+            payload = self.render([entry])
+        if not payload['messages']:
+            return  # deleted or hidden already
+
+        chunk = sse('messages', json.dumps(payload, separators=(',', ':')),
+                    id=cursor_for(entry))
+        for subscription in subscriptions:
+            subscription.put(chunk)
+        self.delivered += len(subscriptions)
+
+    def _refollow(self, user_id, followee_id, following):
+        with self._lock:
+            for subscription in self._subscriptions:
+                if subscription.user_id != user_id:
+                    continue
+                if following:
+                    subscription.author_ids.add(followee_id)
+                    self._by_author.setdefault(followee_id,
+                                               set()).add(subscription)
+                elif followee_id != user_id:
+                    subscription.author_ids.discard(followee_id)
+                    self._forget(subscription, followee_id)
+
+    ##########################################################################
+    # Connections
+
+    def subscribe(self, user_id, author_ids, limit=None):
+        """A Subscription to `user_id`'s and `author_ids`' new messages;
+        PushBusy if this worker has `limit` (by default,
+        PUSH_MAX_CONNECTIONS) already."""
+
+        if limit is None:
+            limit = self.app.config['PUSH_MAX_CONNECTIONS']
+        self._listen()
+        subscription = Subscription(self, user_id, author_ids)
+        with self._lock:
+            if len(self._subscriptions) >= limit:
+                self.refused += 1
+                raise PushBusy()
+            self._subscriptions.add(subscription)
+            for author_id in subscription.author_ids:
+                self._by_author.setdefault(author_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            for author_id in subscription.author_ids:
+                self._forget(subscription, author_id)
+
+    def _forget(self, subscription, author_id):
+        subscribers = self._by_author.get(author_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._by_author[author_id]
+
+    def stats(self):
+        return dict(
+            broker=type(self.broker).__name__,
+            connections=len(self._subscriptions),
+            max_connections=self.app.config['PUSH_MAX_CONNECTIONS'],
+            published=self.published,
+            delivered=self.delivered,
+            overflowed=self.overflowed,
+            refused=self.refused)
+
+
+def cursor_for(entry):
+    """The event id for timeline `entry`: its feed cursor."""
+
+    return encode_cursor(*entry[:2])
@@ -0,0 +1,150 @@
+"""Count the SQL statements run per request, and enforce per-route budgets.
+
+Every statement executed by any engine bumps the counters that are active on
+the current thread: one per request (`g.query_counter`) and any opened with
+`count_queries()` -- or carried over from another thread with `adopt()`, for
+work a request hands to a pool. Counters also time each statement.
+
+Routes declare how many statements they may run with `@query_budget(n)`.
+With ENFORCE_QUERY_BUDGETS on (the test suites turn it on), a request that
+goes over raises QueryBudgetExceeded; otherwise it is logged as a warning.
+"""
+
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A route ran more SQL statements than its `@query_budget`."""
+
+
+class count_queries:
+    """Count the statements run on this thread inside a `with` block.
+
+        with count_queries() as counter:
+            ...
+        counter.count, counter.statements, counter.seconds
+
+    `durations` holds the seconds each finished statement took, in the same
+    order as `statements`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self.durations = []
+        self.seconds = 0.0
+
+    def __enter__(self):
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters.remove(self)
+
+
+def active():
+    """The counters open on this thread, for `adopt()` on another."""
+
+    return list(getattr(_local, 'counters', ()))
+
+
+class adopt:
+    """Count this thread's statements in `counters` (from `active()` on
+    another thread) too, inside a `with` block."""
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def __enter__(self):
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.extend(self.counters)
+        return self
+
+    def __exit__(self, *exc_info):
+        for counter in self.counters:
+            _local.counters.remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    counters = getattr(_local, 'counters', ())
+    for counter in counters:
+        counter.count += 1
+        counter.statements.append(statement)
+
+    if counters and context is not None:
+        context._query_counter_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _time_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    started = getattr(context, '_query_counter_started', None)
+    if started is None:
+        return
+
+    elapsed = time.perf_counter() - started
+    for counter in getattr(_local, 'counters', ()):
+        counter.durations.append(elapsed)
+        counter.seconds += elapsed
+
+
+def query_budget(budget):
+    """Declare that a view may run at most `budget` SQL statements."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return view(*args, **kwargs)
+
+        wrapper.query_budget = budget
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    """Count queries on every request to `app` and check route budgets."""
+
+    app.config.setdefault('ENFORCE_QUERY_BUDGETS', False)
+
+    @app.before_request
+    def start_query_counter():
+        g.query_counter = count_queries().__enter__()
+
+    @app.after_request
+    def check_query_budget(response):
+        counter = g.pop('query_counter', None)
+        if counter is None:
+            return response
+        counter.__exit__(None, None, None)
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+
+        if budget is not None and counter.count > budget:
+            problem = (f"{request.endpoint} ran {counter.count} queries "
+                       f"(budget {budget}):\n" + "\n".join(counter.statements))
+            if app.config['ENFORCE_QUERY_BUDGETS']:
+                raise QueryBudgetExceeded(problem)
+            app.logger.warning(problem)
+
+        return response
+
+    @app.teardown_request
+    def stop_query_counter(exc):
+        counter = g.pop('query_counter', None)
+        if counter is not None:
+            counter.__exit__(None, None, None)
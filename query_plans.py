@@ -0,0 +1,158 @@
+"""Check that the hot queries are served by indexes.
+
+Runs EXPLAIN on the queries behind the feed, profiles, follower lists,
+like/flag lookups and (on Postgres) search, and reports any that would scan
+a whole table:
+
+    flask check-query-plans
+
+On Postgres, sequential scans are disabled for the check (`enable_seqscan`
+off), so a small test database -- where a scan really is cheapest -- still
+shows whether a usable index exists. Walking a whole index (an index scan
+with no condition, SQLite's `SCAN <table> USING INDEX`) reads every row
+just the same, so it counts as a table scan too.
+"""
+
+import json
+from datetime import datetime
+
+from sqlalchemy import func, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from models import db, User, Message, FollowersFollowee, Like, Flag
+from pagination import most_flagged, newest_messages, to_micros
+from search import MESSAGE_VECTOR_SQL, USER_VECTOR_SQL
+
+
+class Explain(Executable, ClauseElement):
+    """`EXPLAIN <statement>` (the query plan, as rows)."""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _explain_default(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'postgresql')
+def _explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(
+        element.statement, **kw)
+
+
+@compiles(Explain, 'sqlite')
+def _explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+def hot_queries():
+    """`{name: query}` for the queries that must use an index."""
+
+    ids = [1, 2, 3]
+    before = (to_micros(datetime(2018, 1, 1)), 1)
+
+    queries = {
+        'home feed':
+        newest_messages(Message.query.filter(Message.user_id.in_(ids)),
+                        None, 100),
+        'home feed, older page':
+        newest_messages(Message.query.filter(Message.user_id.in_(ids)),
+                        before, 100),
+        'profile messages':
+        newest_messages(Message.query.filter(Message.user_id == 1), before,
+                        100),
+        'following ids':
+        FollowersFollowee.following_ids(1),
+        'follower ids':
+        FollowersFollowee.follower_ids(1),
+        'liked messages':
+        newest_messages(
+            Message.query.join(Like, Like.msg_id == Message.id).filter(
+                Like.user_id == 1), None, 100),
+        'likes among':
+        db.session.query(Like.msg_id).filter(Like.user_id == 1,
+                                              Like.msg_id.in_(ids)),
+        'flags among':
+        db.session.query(Flag.msg_id).filter(Flag.user_id == 1,
+                                              Flag.msg_id.in_(ids)),
+        'message likers':
+        db.session.query(Like.user_id).filter(Like.msg_id == 1),
+        'moderation queue':
+        most_flagged(Message.query.filter(Message.flags_count > 0), (3, 1),
+                     100),
+    }
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # search.py's indexes are Postgres-only
+        queries.update({
+            'user search':
+            User.query.filter(text(
+                f"({USER_VECTOR_SQL}) @@ to_tsquery('simple', 'a:*')")),
+            'username prefix':
+            User.query.filter(func.lower(User.username).like('a%')),
+            'message search':
+            Message.query.filter(text(
+                f"({MESSAGE_VECTOR_SQL}) @@ to_tsquery('english', 'a:*')")),
+        })
+
+    return queries
+
+
+def _pg_scans(plan):
+    """Tables read in full anywhere in Postgres plan node `plan`."""
+
+    scans = []
+    node = plan.get('Node Type')
+    if node == 'Seq Scan' or (node in ('Index Scan', 'Index Only Scan')
+                              and 'Index Cond' not in plan):
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        scans.extend(_pg_scans(child))
+    return scans
+
+
+def table_scans(query):
+    """Names of tables `query` would read in full."""
+
+    bind = db.session.get_bind()
+    rows = db.session.execute(Explain(query.statement)).fetchall()
+
+    if bind.dialect.name == 'postgresql':
+        plan = rows[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return _pg_scans(plan[0]['Plan'])
+
+    if bind.dialect.name == 'sqlite':
+        scans = []
+        for row in rows:
+            detail = row[-1]
+            words = detail.split()
+            if words[:1] == ['SCAN']:
+                # "SCAN messages [USING INDEX ...]" / "SCAN TABLE messages"
+                # (older SQLite); a lookup is "SEARCH ..."
+                scans.append(words[2] if words[1] == 'TABLE' else words[1])
+        return scans
+
+    raise ValueError(f"Can't read {bind.dialect.name} query plans")
+
+
+def check():
+    """`{query name: [tables scanned]}` for the hot queries that scan."""
+
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    if postgres:
+        db.session.execute("SET LOCAL enable_seqscan = off")
+
+    try:
+        problems = {}
+        for name, query in hot_queries().items():
+            scans = table_scans(query)
+            if scans:
+                problems[name] = scans
+        return problems
+    finally:
+        db.session.rollback()
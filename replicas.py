@@ -0,0 +1,195 @@
+"""Read replicas and connection pools for the SQLAlchemy layer.
+
+`db` is a `RoutingSQLAlchemy`. With DATABASE_REPLICA_URLS set (a list of
+database URLs), GET requests to views marked `@read_replica` run their
+reads on one of the replicas, picked at random per request. Everything
+else stays on the primary:
+
+  - any write: flushes and INSERT/UPDATE/DELETE statements go to the
+    primary, and the rest of that request follows;
+  - read-after-write: once a request has written, the user's session is
+    pinned to the primary for DATABASE_REPLICA_LAG seconds, so they see
+    their own changes even if the replicas are behind;
+  - anything outside a request (jobs, CLI commands).
+
+Every engine gets DATABASE_POOL_SIZE connections (plus DATABASE_MAX_OVERFLOW
+more under load), pre-pinged before use and recycled after
+DATABASE_POOL_RECYCLE seconds. `stats()` reports each pool's use, for
+/metrics.
+
+Statements on the sharded tables go to the shard `db.shards` picks instead
+(see shards.py); shard 0 is the primary, and its reads can use the replicas
+like any other.
+"""
+
+import random
+import threading
+import time
+import weakref
+from collections import Counter
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+_peaks = weakref.WeakKeyDictionary()
+_overflowed = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _watch(pool):
+    """Keep `pool`'s peak use and overflow count for `stats()`."""
+
+    if pool in _peaks or not hasattr(pool, 'checkedout'):
+        return
+    _peaks[pool] = 0
+    _overflowed[pool] = 0
+
+    @event.listens_for(pool, 'checkout')
+    def track_checkout(dbapi_connection, connection_record,
+                       connection_proxy):
+        checked_out = pool.checkedout()
+        with _lock:
+            _peaks[pool] = max(_peaks[pool], checked_out)
+            if checked_out > pool.size():
+                _overflowed[pool] += 1
+
+
+def read_replica(view):
+    """Mark a view whose GET requests may read from a replica."""
+
+    view.read_replica = True
+    return view
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the current request's reads to its replica, and
+    statements on the sharded tables to their shard."""
+
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        shards = self._db.shards
+        shard = shards.route(self, mapper, clause) if shards else None
+        if shard:
+            return shards.engine(shard)
+
+        bind = super().get_bind(mapper, clause)
+        # (a request's `g` -- or a parallel query's, see parallel.py)
+        if not has_app_context():
+            return bind
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.db_wrote = True
+
+        replica = g.get('db_replica')
+        if replica is None or g.get('db_wrote'):
+            return bind
+        return self._db.get_engine(self.app, bind=replica)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """`SQLAlchemy` with replica routing and configurable pools."""
+
+    def __init__(self, *args, **kwargs):
+        self.shards = None  # set by `Shards.init_app()`
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        app.config.setdefault('DATABASE_REPLICA_LAG', 5)
+        app.config.setdefault('DATABASE_POOL_SIZE', 5)
+        app.config.setdefault('DATABASE_MAX_OVERFLOW', 10)
+        app.config.setdefault('DATABASE_POOL_TIMEOUT', 30)
+        app.config.setdefault('DATABASE_POOL_RECYCLE', 1800)
+        app.config.setdefault('DATABASE_POOL_PRE_PING', True)
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replicas = []
+        for n, url in enumerate(app.config['DATABASE_REPLICA_URLS']):
+            key = f'replica_{n}'
+            binds[key] = url
+            self.replicas.append(key)
+        if binds:
+            app.config['SQLALCHEMY_BINDS'] = binds
+        self.routed = Counter()
+
+        @app.before_request
+        def pick_database():
+            if not self.replicas or request.method not in ('GET', 'HEAD'):
+                return
+
+            view = app.view_functions.get(request.endpoint)
+            if not getattr(view, 'read_replica', False):
+                return
+
+            if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+                self.routed['primary (recent write)'] += 1
+                return
+
+            g.db_replica = random.choice(self.replicas)
+            self.routed[g.db_replica] += 1
+
+        @app.after_request
+        def pin_to_primary(response):
+            if self.replicas and g.get('db_wrote'):
+                session[PRIMARY_UNTIL_KEY] = (
+                    time.time() + app.config['DATABASE_REPLICA_LAG'])
+            return response
+
+        super().init_app(app)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        with _lock:
+            _watch(engine.pool)
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+
+        options['pool_pre_ping'] = app.config['DATABASE_POOL_PRE_PING']
+        # (SQLite gets a pool without these settings; see the parent class)
+        if sa_url.drivername != 'sqlite':
+            options.update(
+                pool_size=app.config['DATABASE_POOL_SIZE'],
+                max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+                pool_timeout=app.config['DATABASE_POOL_TIMEOUT'],
+                pool_recycle=app.config['DATABASE_POOL_RECYCLE'])
+        return result
+
+    def stats(self):
+        """Each engine's pool use, and how read requests were routed."""
+
+        engines = {'primary': self.get_engine()}
+        for key in self.replicas:
+            engines[key] = self.get_engine(bind=key)
+        for shard in range(1, self.shards.count if self.shards else 1):
+            engines[f'shard_{shard}'] = self.get_engine(bind=f'shard_{shard}')
+
+        pools = {}
+        for name, engine in engines.items():
+            pool = engine.pool
+            stats = dict(pool=type(pool).__name__)
+            if hasattr(pool, 'checkedout'):
+                checked_out = pool.checkedout()
+                capacity = pool.size() + max(pool._max_overflow, 0)
+                with _lock:
+                    stats.update(
+                        size=pool.size(),
+                        checked_out=checked_out,
+                        overflow=pool.overflow(),
+                        saturation=round(checked_out / capacity, 3),
+                        peak=_peaks.get(pool, 0),
+                        overflowed_checkouts=_overflowed.get(pool, 0))
+            pools[name] = stats
+
+        return dict(pools=pools, routed=dict(self.routed))
@@ -0,0 +1,461 @@
+"""Full-text search over users and messages.
+
+Users are searched on username, location and bio (in that order of weight),
+messages on their text. Results are ranked, and the last word of a query
+matches as a prefix so partly-typed queries work. User results page on a
+`(rank, id)` cursor, the rank scaled to an integer (RANK_SCALE) so both
+engines can compare it exactly.
+
+Two engines, picked by SEARCH_ENGINE ('auto' chooses by database):
+
+- PostgresSearch: tsvector expression indexes (GIN) created with the tables.
+  Postgres keeps them up to date itself, so the `index_*`/`remove_*` hooks
+  are no-ops.
+- MemorySearch: an in-process inverted index, built from the database on
+  first use and updated by the hooks. For SQLite test runs and development;
+  each worker keeps its own copy.
+"""
+
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import BigInteger, DDL, cast, event, func, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Message
+from pagination import page_from
+from shards import merge
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# tsvector expressions; queries must use exactly the SQL the indexes below
+# are built on for Postgres to use them.
+USER_VECTOR_SQL = (
+    "setweight(to_tsvector('simple', coalesce(username, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(location, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(bio, '')), 'C')")
+
+MESSAGE_VECTOR_SQL = "to_tsvector('english', text)"
+
+USER_FIELD_WEIGHTS = [('username', 3.0), ('location', 1.5), ('bio', 1.0)]
+
+# ranks are kept as int(rank * RANK_SCALE) in user search cursors
+RANK_SCALE = 10**6
+
+# Postgres-only indexes: (table, name, definition). Made with the tables,
+# and by a migration (see migrations.py) on databases that predate them.
+SEARCH_INDEXES = [
+    (User.__table__, 'ix_users_search', f"USING gin (({USER_VECTOR_SQL}))"),
+    (User.__table__, 'ix_users_username_prefix',
+     "(lower(username) text_pattern_ops)"),
+    (Message.__table__, 'ix_messages_search',
+     f"USING gin (({MESSAGE_VECTOR_SQL}))"),
+]
+
+for _table, _name, _definition in SEARCH_INDEXES:
+    event.listen(
+        _table, 'after_create',
+        DDL(f"CREATE INDEX {_name} ON {_table.name} {_definition}")
+        .execute_if(dialect='postgresql'))
+
+
+def create_indexes(conn):
+    """Create any missing SEARCH_INDEXES (on Postgres; a no-op elsewhere)."""
+
+    if conn.dialect.name != 'postgresql':
+        return
+    for table, name, definition in SEARCH_INDEXES:
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table.name} {definition}")
+
+
+def tokenize(value):
+    """Lower-cased words in `value`."""
+
+    return WORD_RE.findall((value or "").lower())
+
+
+def _by_ids(model, ids, *options):
+    """Load `model` rows for `ids`, in that order."""
+
+    if not ids:
+        return []
+
+    by_id = {
+        obj.id: obj
+        for obj in model.query.options(*options).filter(model.id.in_(ids))
+    }
+    return [by_id[id] for id in ids if id in by_id]
+
+
+class SearchEngine:
+    """Interface for search engines.
+
+    The `search_*` methods return ranked model instances; `suggest_users`
+    returns users whose username starts with `prefix`, for typeahead.
+    """
+
+    def ranked_users(self, query, before, limit):
+        """`[(user, scaled rank)]`, best first, after `(rank, id)` cursor
+        `before` (or from the top if it's None)."""
+
+        raise NotImplementedError
+
+    def search_users(self, query, limit):
+        return [user for user, _ in self.ranked_users(query, None, limit)]
+
+    def paginate_users(self, query, before, per_page):
+        """Page of users matching `query` after `(rank, id)` cursor
+        `before`."""
+
+        page = page_from(self.ranked_users(query, before, per_page + 1),
+                         per_page, lambda row: (row[1], row[0].id))
+        return page._replace(items=[user for user, _ in page.items])
+
+    def search_messages(self, query, limit):
+        raise NotImplementedError
+
+    def suggest_users(self, prefix, limit):
+        raise NotImplementedError
+
+    def index_user(self, user):
+        """`user` was created or edited."""
+
+    def remove_user(self, user_id):
+        """User `user_id` and all their messages were deleted."""
+
+    def index_message(self, msg):
+        """`msg` was posted."""
+
+    def remove_message(self, msg_id):
+        """Message `msg_id` was deleted."""
+
+    def reset(self):
+        """Forget any in-process state (the next search rebuilds it)."""
+
+
+##############################################################################
+# Postgres
+
+
+class PostgresSearch(SearchEngine):
+    """Search with Postgres full-text indexes."""
+
+    @staticmethod
+    def _tsquery(query):
+        """`a & b & c:*` for "a b c" -- words are \\w+, so this is safe."""
+
+        words = tokenize(query)
+        if not words:
+            return None
+        words[-1] += ":*"
+        return " & ".join(words)
+
+    def _search(self, query_from, vector_sql, config, query, limit,
+                *options):
+        tsquery = self._tsquery(query)
+        if tsquery is None:
+            return []
+
+        model = query_from.column_descriptions[0]['entity']
+        match = f"to_tsquery('{config}', :tsquery)"
+        return (query_from.filter(text(f"({vector_sql}) @@ {match}"))
+                .order_by(
+                    text(f"ts_rank({vector_sql}, {match}) DESC"),
+                    model.id.desc())
+                .options(*options).params(tsquery=tsquery).limit(limit)
+                .all())
+
+    def ranked_users(self, query, before, limit):
+        tsquery = self._tsquery(query)
+        if tsquery is None:
+            return []
+
+        rank = cast(
+            func.round(
+                func.ts_rank(text(f"({USER_VECTOR_SQL})"),
+                             func.to_tsquery('simple', tsquery))
+                * RANK_SCALE), BigInteger)
+        found = User.query.add_columns(rank).filter(
+            text(f"({USER_VECTOR_SQL}) @@ to_tsquery('simple', :tsquery)"))
+        if before is not None:
+            found = found.filter(tuple_(rank, User.id) < tuple_(*before))
+        return (found.order_by(rank.desc(), User.id.desc())
+                .params(tsquery=tsquery).limit(limit).all())
+
+    def search_messages(self, query, limit):
+        tsquery = self._tsquery(query)
+        if tsquery is None or not db.shards.sharded:
+            return self._search(Message.visible(), MESSAGE_VECTOR_SQL,
+                                'english', query, limit,
+                                joinedload(Message.user))
+
+        # the best `limit` on each shard, merged on rank
+        rank = func.ts_rank(
+            text(MESSAGE_VECTOR_SQL), func.to_tsquery('english', tsquery))
+        ranked = []
+        for _ in db.shards.each():
+            ranked.append(
+                self._search(Message.visible().add_columns(rank),
+                             MESSAGE_VECTOR_SQL, 'english', query, limit))
+        msgs = [
+            msg for msg, _ in merge(ranked, lambda row: (row[1], row[0].id),
+                                    limit)
+        ]
+        db.shards.attach_authors(msgs)
+        return msgs
+
+    def suggest_users(self, prefix, limit):
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        escaped = re.sub(r"([\\%_])", r"\\\1", prefix)
+        return (User.query.filter(
+            func.lower(User.username).like(escaped + "%", escape="\\"))
+                .order_by(func.lower(User.username)).limit(limit).all())
+
+
+##############################################################################
+# In-process fallback
+
+
+class InvertedIndex:
+    """Term -> {doc_id: weight} postings, with a sorted vocabulary for
+    prefix expansion and tf-idf scoring."""
+
+    MAX_PREFIX_TERMS = 50
+
+    def __init__(self):
+        self.postings = {}
+        self.vocabulary = []
+        self.doc_terms = {}
+
+    def add(self, doc_id, weighted_terms):
+        """Index `doc_id` with `{term: weight}`, replacing any old entry."""
+
+        self.remove(doc_id)
+        self.doc_terms[doc_id] = weighted_terms
+
+        for term, weight in weighted_terms.items():
+            docs = self.postings.get(term)
+            if docs is None:
+                docs = self.postings[term] = {}
+                insort(self.vocabulary, term)
+            docs[doc_id] = weight
+
+    def remove(self, doc_id):
+        for term in self.doc_terms.pop(doc_id, {}):
+            docs = self.postings[term]
+            del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+                del self.vocabulary[bisect_left(self.vocabulary, term)]
+
+    def expand(self, prefix):
+        """Vocabulary terms starting with `prefix`."""
+
+        start = bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in self.vocabulary[start:start + self.MAX_PREFIX_TERMS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, words, limit):
+        """Doc ids matching every word (the last as a prefix), best first."""
+
+        scores = self.scores(words)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [doc_id for doc_id, score in ranked[:limit]]
+
+    def scores(self, words):
+        """`{doc_id: score}` of the docs matching every word (the last as a
+        prefix)."""
+
+        if not words:
+            return {}
+
+        total = len(self.doc_terms) or 1
+        scores = None
+
+        for i, word in enumerate(words):
+            terms = self.expand(word) if i == len(words) - 1 else [word]
+            word_scores = {}
+
+            for term in terms:
+                docs = self.postings.get(term, {})
+                idf = math.log(1 + total / len(docs)) if docs else 0
+                for doc_id, weight in docs.items():
+                    word_scores[doc_id] = (
+                        word_scores.get(doc_id, 0) + weight * idf)
+
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {
+                    doc_id: score + word_scores[doc_id]
+                    for doc_id, score in scores.items()
+                    if doc_id in word_scores
+                }
+
+            if not scores:
+                return {}
+
+        return scores
+
+
+class MemorySearch(SearchEngine):
+    """In-process inverted indexes over users and messages."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._users = None
+            self._messages = None
+            self._usernames = []
+            self._message_authors = {}
+
+    def _load(self):
+        """Build the indexes from the database if not done yet."""
+
+        if self._users is not None:
+            return
+
+        self._users = InvertedIndex()
+        self._messages = InvertedIndex()
+        for user in User.query:
+            self._add_user(user)
+        for _ in db.shards.each():
+            for msg in Message.visible():
+                self._add_message(msg)
+
+    @staticmethod
+    def _user_terms(user):
+        terms = {}
+        for field, weight in USER_FIELD_WEIGHTS:
+            for word in tokenize(getattr(user, field)):
+                terms[word] = terms.get(word, 0) + weight
+        return terms
+
+    @staticmethod
+    def _message_terms(msg):
+        terms = {}
+        for word in tokenize(msg.text):
+            terms[word] = terms.get(word, 0) + 1
+        return terms
+
+    def _add_user(self, user):
+        self._remove_username(user.id)
+        self._users.add(user.id, self._user_terms(user))
+        insort(self._usernames, ((user.username or "").lower(), user.id))
+
+    def _remove_username(self, user_id):
+        self._usernames = [e for e in self._usernames if e[1] != user_id]
+
+    def _add_message(self, msg):
+        self._messages.add(msg.id, self._message_terms(msg))
+        self._message_authors[msg.id] = msg.user_id
+
+    def ranked_users(self, query, before, limit):
+        with self._lock:
+            self._load()
+            keys = [(round(score * RANK_SCALE), doc_id) for doc_id, score
+                    in self._users.scores(tokenize(query)).items()]
+        if before is not None:
+            keys = [key for key in keys if key < tuple(before)]
+        keys = sorted(keys, reverse=True)[:limit]
+
+        users = _by_ids(User, [doc_id for _, doc_id in keys])
+        ranks = dict((doc_id, rank) for rank, doc_id in keys)
+        return [(user, ranks[user.id]) for user in users]
+
+    def search_messages(self, query, limit):
+        with self._lock:
+            self._load()
+            ids = self._messages.search(tokenize(query), limit)
+            author_ids = {self._message_authors[id] for id in ids}
+        found = db.shards.load_messages(ids, author_ids=author_ids)
+        return [found[id] for id in ids if id in found]
+
+    def suggest_users(self, prefix, limit):
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        with self._lock:
+            self._load()
+            start = bisect_left(self._usernames, (prefix, ))
+            ids = []
+            for username, user_id in self._usernames[start:]:
+                if not username.startswith(prefix) or len(ids) == limit:
+                    break
+                ids.append(user_id)
+        return _by_ids(User, ids)
+
+    def index_user(self, user):
+        with self._lock:
+            if self._users is not None:
+                self._add_user(user)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            if self._users is None:
+                return
+            self._users.remove(user_id)
+            self._remove_username(user_id)
+            for msg_id, author_id in list(self._message_authors.items()):
+                if author_id == user_id:
+                    self.remove_message(msg_id)
+
+    def index_message(self, msg):
+        with self._lock:
+            if self._messages is not None:
+                self._add_message(msg)
+
+    def remove_message(self, msg_id):
+        with self._lock:
+            if self._messages is not None:
+                self._messages.remove(msg_id)
+                self._message_authors.pop(msg_id, None)
+
+
+##############################################################################
+# Wiring
+
+
+class Search:
+    """Picks the engine for the app's database; wired up like `db`.
+
+    Routes call the engine's methods through this object, e.g.
+    `search.search_users(q, 20)`.
+    """
+
+    def __init__(self, app=None):
+        self.engine = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_ENGINE', 'auto')
+
+        name = app.config['SEARCH_ENGINE']
+        if name == 'auto':
+            uri = app.config['SQLALCHEMY_DATABASE_URI']
+            name = 'postgres' if uri.startswith('postgres') else 'memory'
+
+        if name == 'postgres':
+            self.engine = PostgresSearch()
+        elif name == 'memory':
+            self.engine = MemorySearch()
+        else:
+            raise ValueError(f"Unknown search engine: {name}")
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
@@ -1,19 +1,17 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
 from app import db
-from models import User, Message, FollowersFollowee, Like, Flag
+from importer import Importer, progress_metadata
+from migrations import migrations_metadata, stamp
 
 db.drop_all()
+progress_metadata.drop_all(db.engine)
+migrations_metadata.drop_all(db.engine)
 db.create_all()
+stamp()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
-
-db.session.commit()
+Importer().run({
+    'users': 'generator/users.csv',
+    'messages': 'generator/messages.csv',
+    'follows': 'generator/follows.csv',
+})
@@ -0,0 +1,636 @@
+"""Messages, likes and flags sharded across databases by user id.
+
+With SHARD_URLS unset everything lives in the one database, as before.
+List more databases there and each user's messages live on their shard --
+with the likes and flags on those messages, so liking, flagging and
+counting a message stay on one database. Shard 0 is the main database,
+which keeps everything else (users, follows, ...).
+
+A user's shard is `users.shard`: new users go to a random shard, and
+`move_user()` (`flask move-user`, `flask rebalance-shards`) moves one with
+their messages. Workers cache the directory for SHARD_DIRECTORY_TTL
+seconds, which is how long a move waits before deleting the old copy.
+
+The session sends statements on the sharded tables to the shard selected
+with `using(shard)` or `for_user(user_id)`. When sharded, a statement on
+them with no shard selected, or mixing them with other tables, raises
+ShardError rather than quietly reading one shard. Reads across shards go
+through the helpers here:
+
+    gather(fn, shards)       fn(shard) for each shard, in parallel threads
+    each(shards)             select each shard in turn, in this session
+    merge(lists, key, n)     k-way merge of newest-first lists
+    load_messages(ids)       messages by id, with their authors
+    locate_messages(ids)     {msg id: shard}
+
+Message ids come from a counter on the main database (`id_counters`), a
+block at a time, so they stay unique across shards.
+"""
+
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.util import find_tables
+
+from models import db, Flag, IdCounter, Like, Message, User
+from pagination import message_key, newest_messages, page_from
+
+SHARDED_TABLES = frozenset(['messages', 'likes', 'flags'])
+
+# forget the cached directory when it holds more users than this
+DIRECTORY_SIZE = 100000
+
+
+class ShardError(RuntimeError):
+    """A statement on the sharded tables that can't go to one shard."""
+
+
+def merge(lists, key, limit):
+    """The first `limit` of newest-first `lists`, merged on `key`.
+
+    A message mid-move can be on two shards; repeats (by the last element
+    of the key, the id) are skipped.
+    """
+
+    merged = []
+    seen = set()
+    for item in heapq.merge(*lists, key=key, reverse=True):
+        ident = key(item)[-1]
+        if ident not in seen:
+            seen.add(ident)
+            merged.append(item)
+            if len(merged) == limit:
+                break
+    return merged
+
+
+def plan_moves(loads, tolerance=0.1):
+    """`[(user_id, from_shard, to_shard)]` evening out `loads`.
+
+    `loads` is `{shard: {user_id: rows}}`. Greedily moves, from the fullest
+    shard to the emptiest, the user closest to half the gap between them,
+    until the gap is within `tolerance` of the average shard.
+    """
+
+    users = {shard: dict(counts) for shard, counts in loads.items()}
+    totals = {shard: sum(counts.values()) for shard, counts in users.items()}
+    if not totals:
+        return []
+    average = sum(totals.values()) / len(totals)
+
+    moves = []
+    while True:
+        full = max(totals, key=lambda shard: (totals[shard], -shard))
+        empty = min(totals, key=lambda shard: (totals[shard], shard))
+        gap = totals[full] - totals[empty]
+        if gap <= tolerance * average:
+            break
+
+        candidates = [(abs(rows - gap / 2), user_id, rows)
+                      for user_id, rows in users[full].items()
+                      if 0 < rows < gap]
+        if not candidates:
+            break
+        _, user_id, rows = min(candidates)
+
+        moves.append((user_id, full, empty))
+        users[empty][user_id] = users[full].pop(user_id)
+        totals[full] -= rows
+        totals[empty] += rows
+
+    return moves
+
+
+def _shard_table(table, metadata):
+    """Copy of `table` for a shard: without foreign keys to tables that
+    stay on the main database, but with its DDL (e.g. search indexes)."""
+
+    copy = table.tometadata(metadata)
+    for ddl in table.dispatch.after_create:
+        event.listen(copy, 'after_create', ddl)
+    for constraint in list(copy.foreign_key_constraints):
+        target = constraint.elements[0].target_fullname.split('.')[0]
+        if target not in SHARDED_TABLES:
+            copy.constraints.discard(constraint)
+            for fk in constraint.elements:
+                fk.parent.foreign_keys.discard(fk)
+                copy.foreign_keys.discard(fk)
+    return copy
+
+
+def _key(table, row):
+    """Primary key of `table` row `row`, as a tuple."""
+
+    return tuple(row[column.name] for column in table.primary_key.columns)
+
+
+def _key_is(table, key):
+    """Condition matching the `table` row with primary key tuple `key`."""
+
+    return db.and_(*(column == value for column, value in zip(
+        table.primary_key.columns, key)))
+
+
+class Shards:
+    """The shard layout, wired up like `db`.
+
+        shards = Shards()
+        shards.init_app(app)
+    """
+
+    def __init__(self, app=None):
+        self.count = 1
+        self._directory = {}
+        self._lock = threading.Lock()
+        self._next_id = self._id_limit = 0
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SHARD_URLS', [])
+        app.config.setdefault('SHARD_DIRECTORY_TTL', 60)
+        app.config.setdefault('SHARD_WORKERS', 8)
+        app.config.setdefault('SHARD_ID_BLOCK', 100)
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for shard, url in enumerate(app.config['SHARD_URLS'], 1):
+            binds[f'shard_{shard}'] = url
+        if binds:
+            app.config['SQLALCHEMY_BINDS'] = binds
+
+        self.app = app
+        self.count = 1 + len(app.config['SHARD_URLS'])
+        db.shards = self
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def engine(self, shard):
+        if shard == 0:
+            return db.get_engine(self.app)
+        return db.get_engine(self.app, bind=f'shard_{shard}')
+
+    ##########################################################################
+    # Routing
+
+    @contextmanager
+    def using(self, shard):
+        """Send this session's statements on the sharded tables to `shard`."""
+
+        session = db.session()
+        previous = session.info.get('shard')
+        session.info['shard'] = shard
+        try:
+            yield shard
+        finally:
+            session.info['shard'] = previous
+
+    def for_user(self, user_id):
+        """`using()` the shard holding `user_id`'s messages."""
+
+        return self.using(self.shard_for(user_id))
+
+    def for_message(self, msg_id):
+        """`using()` the shard holding message `msg_id` (the main database
+        if there's no such message)."""
+
+        return self.using(self.locate_messages([msg_id]).get(msg_id, 0))
+
+    def route(self, session, mapper, clause):
+        """The shard `session` should run a statement on; None if it isn't
+        on the sharded tables (or nothing is sharded)."""
+
+        if not self.sharded:
+            return None
+
+        tables = set()
+        if mapper is not None:
+            table = getattr(mapper, 'persist_selectable', None)
+            if table is None:
+                table = mapper.mapped_table
+            tables.add(getattr(table, 'name', None))
+        if clause is not None:
+            tables.update(
+                table.name for table in find_tables(clause, include_crud=True))
+
+        sharded = tables & SHARDED_TABLES
+        if not sharded:
+            return None
+        if sharded != tables:
+            raise ShardError(f"Can't join {sorted(sharded)} with "
+                             f"{sorted(tables - sharded)} across shards")
+
+        shard = session.info.get('shard')
+        if shard is None:
+            raise ShardError(f"No shard selected for {sorted(sharded)}")
+        return shard
+
+    ##########################################################################
+    # Directory
+
+    def shard_for(self, user_id):
+        return self.shards_for([user_id]).get(user_id, 0)
+
+    def shards_for(self, user_ids):
+        """`{user_id: shard}` for those of `user_ids` that exist."""
+
+        if not self.sharded:
+            return dict.fromkeys(user_ids, 0)
+
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for user_id in user_ids:
+                cached = self._directory.get(user_id)
+                if cached and cached[1] > now:
+                    found[user_id] = cached[0]
+                else:
+                    missing.append(user_id)
+
+        if missing:
+            rows = db.session.query(User.id, User.shard).filter(
+                User.id.in_(missing)).all()
+            expires = now + self.app.config['SHARD_DIRECTORY_TTL']
+            with self._lock:
+                if len(self._directory) > DIRECTORY_SIZE:
+                    self._directory.clear()
+                for user_id, shard in rows:
+                    found[user_id] = shard
+                    self._directory[user_id] = (shard, expires)
+
+        return found
+
+    def forget(self, *user_ids):
+        """Drop `user_ids` from this worker's directory cache."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._directory.pop(user_id, None)
+
+    def new_user_shard(self):
+        return random.randrange(self.count)
+
+    def new_message_id(self):
+        """A fresh message id, unique across shards; None when not sharded
+        (the messages table numbers its own rows)."""
+
+        if not self.sharded:
+            return None
+
+        with self._lock:
+            if self._next_id >= self._id_limit:
+                self._id_limit = self._reserve_ids(
+                    self.app.config['SHARD_ID_BLOCK'])
+                self._next_id = self._id_limit - self.app.config[
+                    'SHARD_ID_BLOCK']
+            self._next_id += 1
+            return self._next_id
+
+    def _reserve_ids(self, block):
+        """Take `block` more ids from the counter; returns the new top."""
+
+        counter = IdCounter.__table__
+        where = counter.c.name == 'messages'
+        with self.engine(0).begin() as conn:
+            if not conn.execute(counter.update().where(where).values(
+                    value=counter.c.value + block)).rowcount:
+                conn.execute(counter.insert().values(name='messages',
+                                                     value=block))
+            top = conn.execute(db.select([counter.c.value]).where(
+                where)).scalar()
+
+            # messages from before sharding were numbered by the table
+            floor = conn.execute(db.select(
+                [db.func.max(Message.id)])).scalar() or 0
+            if top - block < floor:
+                top = floor + block
+                conn.execute(counter.update().where(where).values(value=top))
+        return top
+
+    def message_id_high_water(self):
+        """No message on any shard has an id above this."""
+
+        if not self.sharded:
+            return 0
+        with self.engine(0).connect() as conn:
+            return conn.execute(
+                db.select([IdCounter.value]).where(
+                    IdCounter.name == 'messages')).scalar() or 0
+
+    ##########################################################################
+    # Reading across shards
+
+    def each(self, shards=None):
+        """Select each of `shards` (default: all) in turn, in this session."""
+
+        for shard in (range(self.count) if shards is None else shards):
+            with self.using(shard):
+                yield shard
+
+    def gather(self, fn, shards):
+        """`[fn(shard) for shard in shards]`, in parallel on SHARD_WORKERS
+        threads when there's more than one shard.
+
+        Each call has its own session with `shard` selected, closed when it
+        returns -- so `fn` should return plain rows, not model instances.
+        """
+
+        shards = list(shards)
+        if len(shards) < 2:
+            results = []
+            for shard in self.each(shards):
+                results.append(fn(shard))
+            return results
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.app.config['SHARD_WORKERS'],
+                        thread_name_prefix='shards')
+        return list(
+            self._executor.map(lambda shard: self._run_on(fn, shard), shards))
+
+    def _run_on(self, fn, shard):
+        with self.app.app_context():
+            with self.using(shard):
+                return fn(shard)
+
+    def attach_authors(self, msgs):
+        """Load the authors of `msgs` in one query and set `msg.user`."""
+
+        user_ids = {msg.user_id for msg in msgs}
+        if not user_ids:
+            return
+        users = {
+            user.id: user
+            for user in User.query.filter(User.id.in_(user_ids))
+        }
+        for msg in msgs:
+            set_committed_value(msg, 'user', users.get(msg.user_id))
+
+    def load_messages(self, ids, query=None, author_ids=None, authors=True):
+        """`{id: message}` for those of `ids` that `query` (default: all
+        messages) finds, with their authors loaded unless not `authors`.
+
+        Unsharded that's one query joining the authors; sharded, one per
+        shard that may hold them -- just the shards of `author_ids`, if
+        given -- and one for the authors.
+        """
+
+        if not ids:
+            return {}
+        if query is None:
+            query = Message.query
+        query = query.filter(Message.id.in_(ids))
+
+        if not self.sharded:
+            if authors:
+                query = query.options(joinedload(Message.user))
+            return {msg.id: msg for msg in query}
+
+        shards = None
+        if author_ids is not None:
+            shards = sorted(set(self.shards_for(author_ids).values()))
+
+        found = {}
+        for _ in self.each(shards):
+            for msg in query:
+                found[msg.id] = msg
+        if authors:
+            self.attach_authors(found.values())
+        return found
+
+    def paginate(self, query, before, per_page, order=newest_messages,
+                 key=message_key, authors=True):
+        """Page of messages `query` after cursor `before`, with authors
+        unless not `authors` (say, for a query of just some columns).
+
+        `order` narrows a query to a page's worth in order and `key` gives a
+        message's position in it (see pagination.py); sharded, each shard's
+        page is fetched and the pages merged.
+        """
+
+        if not self.sharded:
+            if authors:
+                query = query.options(joinedload(Message.user))
+            items = order(query, before, per_page + 1).all()
+        else:
+            pages = []
+            for _ in self.each():
+                pages.append(order(query, before, per_page + 1).all())
+            items = merge(pages, key, per_page + 1)
+            if authors:
+                self.attach_authors(items)
+
+        return page_from(items, per_page, key)
+
+    def marked(self, mark, user_id, authors):
+        """Which of the messages `authors` (`{msg_id: author_id}`) has
+        `user_id` marked with `mark` (Like or Flag)? Returns a set of ids,
+        like `mark.msg_ids_among()`."""
+
+        shards = self.shards_for(set(authors.values()))
+        by_shard = {}
+        for msg_id, author_id in authors.items():
+            by_shard.setdefault(shards.get(author_id, 0), []).append(msg_id)
+
+        found = set()
+        for shard in self.each(sorted(by_shard)):
+            found |= mark.msg_ids_among(user_id, by_shard[shard])
+        return found
+
+    def locate_messages(self, ids):
+        """`{msg_id: shard}` for those of `ids` that exist.
+
+        Unsharded this doesn't check they exist.
+        """
+
+        if not self.sharded:
+            return dict.fromkeys(ids, 0)
+
+        found = {}
+        for shard in self.each():
+            for msg_id, in db.session.query(Message.id).filter(
+                    Message.id.in_(ids)):
+                found[msg_id] = shard
+        return found
+
+    def group(self, msgs):
+        """`{shard: [msg, ...]}` for messages `msgs`, by their authors."""
+
+        shards = self.shards_for({msg.user_id for msg in msgs})
+        groups = {}
+        for msg in msgs:
+            groups.setdefault(shards.get(msg.user_id, 0), []).append(msg)
+        return groups
+
+    ##########################################################################
+    # Schema and moving users
+
+    def create_tables(self):
+        """Create the sharded tables on every shard but the main database
+        (which already has them)."""
+
+        metadata = db.MetaData()
+        for table in (Message.__table__, Like.__table__, Flag.__table__):
+            _shard_table(table, metadata)
+        for shard in range(1, self.count):
+            metadata.create_all(self.engine(shard), checkfirst=True)
+
+    def loads(self):
+        """`{shard: {user_id: messages}}`, counted on every shard at once."""
+
+        def count(shard):
+            return dict(
+                db.session.query(Message.user_id, db.func.count()).group_by(
+                    Message.user_id).all())
+
+        return dict(enumerate(self.gather(count, range(self.count))))
+
+    def move_user(self, user_id, shard, wait=None, log=print):
+        """Move `user_id` and their messages, with those messages' likes
+        and flags, to `shard`. Returns the number of messages moved.
+
+        The rows are copied, the directory switched, and -- once every
+        worker has had SHARD_DIRECTORY_TTL seconds to notice -- caught up
+        (see `_catch_up()`: anything written to the old shard meanwhile)
+        and deleted from the old shard.
+        """
+
+        source = db.session.query(User.shard).filter(
+            User.id == user_id).scalar()
+        if source is None:
+            raise ValueError(f"No user {user_id}")
+        if not 0 <= shard < self.count:
+            raise ValueError(f"No shard {shard}")
+        if source == shard:
+            return 0
+
+        copied = self._copy_user(user_id, source, shard)
+        User.query.filter(User.id == user_id).update(
+            {User.shard: shard}, synchronize_session=False)
+        db.session.commit()
+        self.forget(user_id)
+
+        if wait is None:
+            wait = self.app.config['SHARD_DIRECTORY_TTL']
+        log(f"User {user_id} now on shard {shard}; waiting {wait}s for "
+            f"workers to notice...")
+        time.sleep(wait)
+
+        moved = self._catch_up(user_id, source, shard, copied)
+        with self.engine(source).begin() as conn:
+            self._delete_user_rows(conn, user_id)
+        log(f"Moved user {user_id}'s {moved} messages from shard {source} "
+            f"to {shard}.")
+        return moved
+
+    def _user_rows(self, user_id):
+        """`(table, where)` for a user's rows on their shard."""
+
+        messages = Message.__table__
+        own = db.select([messages.c.id]).where(messages.c.user_id == user_id)
+        return [(messages, messages.c.user_id == user_id)] + [
+            (mark.__table__, mark.__table__.c.msg_id.in_(own))
+            for mark in (Like, Flag)
+        ]
+
+    def _delete_user_rows(self, conn, user_id):
+        for table, where in reversed(self._user_rows(user_id)):
+            conn.execute(table.delete().where(where))
+
+    def _copy_user(self, user_id, source, shard, chunk=1000):
+        """Replace `user_id`'s rows on `shard` with those on `source`.
+
+        Returns `{table name: {key: hash}}` of the rows copied.
+        """
+
+        copied = {}
+        with self.engine(source).connect() as src, \
+                self.engine(shard).begin() as dest:
+            self._delete_user_rows(dest, user_id)
+            for table, where in self._user_rows(user_id):
+                hashes = copied[table.name] = {}
+                result = src.execute(table.select().where(where))
+                while True:
+                    rows = result.fetchmany(chunk)
+                    if not rows:
+                        break
+                    dest.execute(table.insert(), [dict(row) for row in rows])
+                    hashes.update(
+                        (_key(table, row), hash(tuple(row))) for row in rows)
+        return copied
+
+    def _catch_up(self, user_id, source, shard, copied, chunk=1000):
+        """Bring `user_id`'s rows on `shard` up to date with `source`: rows
+        new on `source` are inserted, those changed on `source` since
+        they were `copied` are updated, and those `copied` but deleted from
+        `source` since are deleted (with any likes and flags of such
+        messages).
+
+        Rows only on `shard` -- written there since the directory switched
+        -- are kept. Returns the number of messages on `source`.
+        """
+
+        messages = 0
+        gone = {}
+        with self.engine(source).connect() as src, \
+                self.engine(shard).begin() as dest:
+            for table, where in self._user_rows(user_id):
+                hashes = copied[table.name]
+                present = {
+                    tuple(row) for row in dest.execute(
+                        db.select(list(table.primary_key.columns)).where(
+                            where))
+                }
+                on_source = set()
+                result = src.execute(table.select().where(where))
+                while True:
+                    rows = result.fetchmany(chunk)
+                    if not rows:
+                        break
+                    if table.name == 'messages':
+                        messages += len(rows)
+
+                    # (rows `copied` but not `present` were deleted from
+                    # `shard` since)
+                    missing = [
+                        dict(row) for row in rows
+                        if _key(table, row) not in present
+                        and _key(table, row) not in hashes
+                    ]
+                    if missing:
+                        dest.execute(table.insert(), missing)
+                    for row in rows:
+                        key = _key(table, row)
+                        on_source.add(key)
+                        if (key in present
+                                and hashes.get(key) != hash(tuple(row))):
+                            dest.execute(table.update().where(
+                                _key_is(table, key)).values(dict(row)))
+
+                gone[table.name] = [
+                    key for key in hashes
+                    if key not in on_source and key in present
+                ]
+
+            # marks first: they refer to the messages
+            gone_msg_ids = [msg_id for msg_id, in gone['messages']]
+            for table, _ in reversed(self._user_rows(user_id)):
+                for key in gone[table.name]:
+                    dest.execute(table.delete().where(_key_is(table, key)))
+                if table.name != 'messages' and gone_msg_ids:
+                    dest.execute(table.delete().where(
+                        table.c.msg_id.in_(gone_msg_ids)))
+        return messages
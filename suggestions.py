@@ -0,0 +1,187 @@
+"""Who-to-follow suggestions, precomputed from the follow graph.
+
+An offline batch (`flask compute-suggestions`) loads the whole `follows`
+graph as a sparse matrix F, with F[a, b] = 1 when a follows b, and scores
+every account c that user a doesn't follow yet:
+
+    friends of friends   (F F)[a, c]: how many of a's followees follow c
+    co-follows           (F F' F)[a, c]: how many follows c gets from users
+                         who follow the same accounts as a
+
+Celebrities' followers are left out of the co-follow product (following
+one would make you "similar" to everyone), using the timelines'
+CELEBRITY_FOLLOWER_THRESHOLD. Users are scored a block of rows at a time,
+so memory stays bounded, and each user's top SUGGESTIONS_PER_USER are
+written to the `suggestions` table. The home page reads them with one
+primary-key range query.
+
+Between runs, a new follow updates the follower's list incrementally, in a
+background job (`add_follow()`). The followee's own followees become
+friend-of-friend candidates, and the route drops the followee from the
+list straight away.
+
+The batch needs numpy and scipy; serving suggestions doesn't.
+"""
+
+import time
+
+from models import db, FollowersFollowee, Suggestion, User
+
+FRIEND_OF_FRIEND_WEIGHT = 1.0
+CO_FOLLOW_WEIGHT = 0.1
+
+# the most of a new followee's followees `add_follow()` considers
+INCREMENTAL_CANDIDATES = 1000
+
+
+def load_graph(chunk=100000):
+    """The follow graph as a CSR matrix indexed by user id."""
+
+    import numpy as np
+    from scipy import sparse
+
+    n = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    # (remember: follows.followee_id is the follower; see FollowersFollowee)
+    result = db.session.execute(
+        db.select([
+            FollowersFollowee.followee_id, FollowersFollowee.follower_id
+        ]))
+    parts = []
+    while True:
+        rows = result.fetchmany(chunk)
+        if not rows:
+            break
+        parts.append(np.array(rows, dtype=np.int64).reshape(-1, 2))
+    edges = (np.concatenate(parts) if parts else np.zeros(
+        (0, 2), dtype=np.int64))
+
+    return sparse.csr_matrix(
+        (np.ones(len(edges), dtype=np.float32), (edges[:, 0], edges[:, 1])),
+        shape=(n, n))
+
+
+def score_block(graph, co_graph, start, stop):
+    """Sparse scores of every candidate for users `start` to `stop`."""
+
+    from scipy import sparse
+
+    rows = graph[start:stop]
+    own = sparse.csr_matrix(
+        ([1.0] * (stop - start), (range(stop - start), range(start, stop))),
+        shape=rows.shape)
+
+    friends_of_friends = rows.dot(graph)
+
+    similar = rows.dot(co_graph.T)
+    similar = similar - similar.multiply(own)
+    co_follows = similar.dot(graph)
+
+    scores = (FRIEND_OF_FRIEND_WEIGHT * friends_of_friends +
+              CO_FOLLOW_WEIGHT * co_follows)
+
+    # not yourself, nor anyone you already follow
+    seen = ((rows + own) > 0).astype(scores.dtype)
+    scores = (scores - scores.multiply(seen)).tocsr()
+    scores.eliminate_zeros()
+    return scores
+
+
+def top_rows(scores, start, top_n):
+    """`(user_id, rank, suggested_id, score)` rows for a scored block."""
+
+    import numpy as np
+
+    for i in range(scores.shape[0]):
+        lo, hi = scores.indptr[i], scores.indptr[i + 1]
+        if lo == hi:
+            continue
+
+        data = scores.data[lo:hi]
+        cols = scores.indices[lo:hi]
+        if hi - lo > top_n:
+            keep = np.argpartition(-data, top_n - 1)[:top_n]
+            data, cols = data[keep], cols[keep]
+
+        # best first, ties to the older account
+        for rank, j in enumerate(np.lexsort((cols, -data))):
+            yield (start + i, rank, int(cols[j]), float(data[j]))
+
+
+def compute(top_n, celebrity_threshold, block_rows=2000, log=print):
+    """Recompute everyone's suggestions; returns how many were stored.
+
+    The old suggestions are replaced in one transaction, so readers see
+    either all old or all new ones.
+    """
+
+    from scipy import sparse
+
+    started = time.monotonic()
+    graph = load_graph()
+    n = graph.shape[0]
+    log(f"Loaded {graph.nnz} follows between {n - 1} user ids in "
+        f"{time.monotonic() - started:.1f}s.")
+
+    followers = graph.getnnz(axis=0)
+    ordinary = (followers < celebrity_threshold).astype(graph.dtype)
+    co_graph = graph.dot(sparse.diags(ordinary)).tocsr()
+
+    table = Suggestion.__table__
+    db.session.execute(table.delete())
+
+    stored = 0
+    for start in range(0, n, block_rows):
+        stop = min(n, start + block_rows)
+        rows = [
+            dict(user_id=user_id, rank=rank, suggested_id=suggested_id,
+                 score=score)
+            for user_id, rank, suggested_id, score in top_rows(
+                score_block(graph, co_graph, start, stop), start, top_n)
+        ]
+        if rows:
+            db.session.execute(table.insert(), rows)
+            stored += len(rows)
+
+    db.session.commit()
+    log(f"Stored {stored} suggestions in "
+        f"{time.monotonic() - started:.1f}s.")
+    return stored
+
+
+def add_follow(user_id, followee_id, top_n):
+    """Fold `user_id`'s new follow of `followee_id` into their suggestions.
+
+    The followee's followees each gain a friend-of-friend's worth of score;
+    the caller commits.
+    """
+
+    scores = {
+        suggestion.suggested_id: suggestion.score
+        for suggestion in Suggestion.query.filter(
+            Suggestion.user_id == user_id)
+    }
+    scores.pop(followee_id, None)
+
+    candidates = [
+        row[0] for row in FollowersFollowee.following_ids(followee_id)
+        .order_by(FollowersFollowee.follower_id)
+        .limit(INCREMENTAL_CANDIDATES)
+    ]
+    skip = FollowersFollowee.following_among(user_id, candidates)
+    skip.add(user_id)
+
+    for candidate in candidates:
+        if candidate not in skip:
+            scores[candidate] = (
+                scores.get(candidate, 0) + FRIEND_OF_FRIEND_WEIGHT)
+
+    best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    Suggestion.query.filter(Suggestion.user_id == user_id).delete(
+        synchronize_session=False)
+    if best:
+        db.session.execute(Suggestion.__table__.insert(), [
+            dict(user_id=user_id, rank=rank, suggested_id=suggested_id,
+                 score=score)
+            for rank, (suggested_id, score) in enumerate(best[:top_n])
+        ])
@@ -0,0 +1,208 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import gzip
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, session_users, timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+
+class ApiTestCase(TestCase):
+    """reader follows writer, who has three messages; reader likes one."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        self.client = app.test_client()
+
+        reader = User(username="reader", email="reader@test.com",
+                      password="HASHED_PASSWORD")
+        writer = User(username="writer", email="writer@test.com",
+                      password="HASHED_PASSWORD", bio="writes things")
+        db.session.add_all([reader, writer])
+        db.session.commit()
+        self.reader_id, self.writer_id = reader.id, writer.id
+
+        FollowersFollowee.add(self.reader_id, self.writer_id)
+        msgs = [
+            Message(text=f"message {day}", user_id=self.writer_id,
+                    timestamp=datetime(2020, 1, day)) for day in (1, 2, 3)
+        ]
+        db.session.add_all(msgs)
+        db.session.commit()
+        self.msg_ids = [msg.id for msg in msgs]
+        Like.apply(self.reader_id, like=[self.msg_ids[1]])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url, **kwargs):
+        """GET `url` logged in as reader."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            return c.get(url, **kwargs)
+
+    def test_feed(self):
+        resp = self.get('/api/v1/feed')
+
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        self.assertEqual([msg['text'] for msg in data['messages']],
+                         ["message 3", "message 2", "message 1"])
+        self.assertEqual(data['messages'][0], {
+            'id': self.msg_ids[2],
+            'text': "message 3",
+            'timestamp': "2020-01-03T00:00:00Z",
+            'user_id': self.writer_id,
+            'likes_count': 0,
+            'liked': False,
+        })
+        self.assertTrue(data['messages'][1]['liked'])
+        # the author, once
+        self.assertEqual([user['username'] for user in data['users']],
+                         ["writer"])
+        self.assertNotIn('email', data['users'][0])
+        self.assertIsNone(data['next'])
+
+    def test_feed_pages(self):
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            first = self.get('/api/v1/feed').get_json()
+            second = self.get('/api/v1/feed',
+                              query_string={'before': first['next']})
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertEqual(len(first['messages']), 2)
+        self.assertEqual(
+            [msg['text'] for msg in second.get_json()['messages']],
+            ["message 1"])
+
+    def test_feed_pages_past_stale_entries(self):
+        """A message hidden since it was fanned out doesn't end the feed."""
+
+        self.get('/api/v1/feed')
+        Message.set_hidden(self.msg_ids[2], True)
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            first = self.get('/api/v1/feed').get_json()
+            second = self.get('/api/v1/feed',
+                              query_string={'before': first['next']})
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertEqual([msg['text'] for msg in first['messages']],
+                         ["message 2"])
+        self.assertEqual(
+            [msg['text'] for msg in second.get_json()['messages']],
+            ["message 1"])
+
+    def test_feed_needs_login(self):
+        resp = self.client.get('/api/v1/feed')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {'error': "Access unauthorized."})
+
+    def test_sparse_fieldsets(self):
+        resp = self.get(f'/api/v1/users/{self.writer_id}/messages',
+                        query_string={'fields[messages]': 'text,liked',
+                                      'fields[users]': 'username'})
+
+        data = resp.get_json()
+        self.assertEqual(data['messages'][1],
+                         {'text': "message 2", 'liked': True})
+        self.assertEqual(data['users'], [{'username': "writer"}])
+
+        resp = self.get('/api/v1/feed',
+                        query_string={'fields[messages]': 'text,password'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("password", resp.get_json()['error'])
+
+    def test_user(self):
+        resp = self.client.get(f'/api/v1/users/{self.writer_id}')
+
+        user = resp.get_json()['user']
+        self.assertEqual(user['bio'], "writes things")
+        self.assertEqual(user['messages_count'], 0)
+        self.assertNotIn('password', user)
+
+        resp = self.client.get(
+            f'/api/v1/users/{self.writer_id}',
+            headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_not_found(self):
+        for url in ('/api/v1/users/0', '/api/v1/messages/0', '/api/v1/nope'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn('error', resp.get_json())
+
+    def test_message(self):
+        resp = self.client.get(f'/api/v1/messages/{self.msg_ids[1]}')
+
+        data = resp.get_json()
+        self.assertEqual(data['message']['likes_count'], 1)
+        self.assertNotIn('liked', data['message'])
+        self.assertEqual(data['users'][0]['id'], self.writer_id)
+
+        Message.set_hidden(self.msg_ids[1], True)
+        db.session.commit()
+        resp = self.client.get(f'/api/v1/messages/{self.msg_ids[1]}')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_likes_and_follows(self):
+        data = self.get(f'/api/v1/users/{self.reader_id}/likes').get_json()
+        self.assertEqual([msg['id'] for msg in data['messages']],
+                         [self.msg_ids[1]])
+        self.assertEqual(data['users'][0]['username'], "writer")
+
+        data = self.get(f'/api/v1/users/{self.reader_id}/following').get_json()
+        self.assertEqual([user['username'] for user in data['users']],
+                         ["writer"])
+        data = self.get(f'/api/v1/users/{self.reader_id}/followers').get_json()
+        self.assertEqual(data['users'], [])
+        data = self.get(f'/api/v1/users/{self.writer_id}/followers').get_json()
+        self.assertEqual([user['username'] for user in data['users']],
+                         ["reader"])
+
+    def test_gzip(self):
+        resp = self.get('/api/v1/feed', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        app.config['API_GZIP_MIN_BYTES'] = 10
+        try:
+            resp = self.get('/api/v1/feed',
+                            headers={'Accept-Encoding': 'gzip'})
+        finally:
+            app.config['API_GZIP_MIN_BYTES'] = 1024
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        data = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(len(data['messages']), 3)
@@ -0,0 +1,177 @@
+"""ASGI entry point and parallel query tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+import asyncio
+import os
+import threading
+from unittest import TestCase
+from urllib.parse import urlencode
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, parallel, session_users, timelines
+from asgi import AsgiApp, request
+import asgi
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+def get(*args, **kwargs):
+    return asyncio.run(request(asgi.app, *args, **kwargs))
+
+
+class AsgiTestCase(TestCase):
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        reader = User(username="reader", email="reader@test.com",
+                      password="HASHED_PASSWORD")
+        author = User(username="author", email="author@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([reader, author])
+        db.session.commit()
+        self.reader_id, self.author_id = reader.id, author.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def cookie(self, user_id):
+        session = app.session_interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: user_id})
+        name = app.config['SESSION_COOKIE_NAME']
+        return (b'cookie', f"{name}={session}".encode())
+
+    def test_parallel_queries_on(self):
+        self.assertTrue(app.config['PARALLEL_QUERIES'])
+
+    def test_same_response_as_wsgi(self):
+        status, headers, body = get('GET', '/login')
+
+        resp = app.test_client().get('/login')
+        self.assertEqual(status, resp.status_code)
+        self.assertIn((b'content-type', resp.content_type.encode()), headers)
+        self.assertEqual(body, resp.data)
+
+    def test_home_page(self):
+        """The home page's queries run at once, within its query budget."""
+
+        FollowersFollowee.add(self.reader_id, self.author_id)
+        msg = Message(text="from the author", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        Like.apply(self.reader_id, like=[msg.id])
+        db.session.commit()
+        timelines.store.clear()
+        batches = parallel.batches
+
+        status, _, body = get('GET', '/',
+                              headers=[self.cookie(self.reader_id)])
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"from the author", body)
+        self.assertIn(b"@author", body)
+        self.assertEqual(parallel.batches, batches + 1)
+
+    def test_form_post(self):
+        status, _, _ = get(
+            'POST', '/messages/new',
+            headers=[self.cookie(self.author_id),
+                     (b'content-type', b'application/x-www-form-urlencoded')],
+            body=urlencode({'text': "posted over asgi"}).encode())
+
+        self.assertEqual(status, 302)
+        self.assertEqual(
+            Message.query.filter_by(user_id=self.author_id).one().text,
+            "posted over asgi")
+
+    def test_lifespan(self):
+        asgi_app = AsgiApp(app, threads=1)
+        incoming = [{'type': 'lifespan.shutdown'},
+                    {'type': 'lifespan.startup'}]
+        sent = []
+
+        async def receive():
+            return incoming.pop()
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(
+            sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+    def test_disconnect_stops_response(self):
+        produced = []
+
+        def endless(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            while len(produced) < 1000:
+                produced.append(1)
+                yield b"more"
+
+        asgi_app = AsgiApp(endless, threads=1)
+        incoming = [{'type': 'http.request', 'body': b''}]
+        gone = None
+
+        async def receive():
+            if incoming:
+                return incoming.pop()
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                gone.set()
+
+        async def serve():
+            # made here, so on 3.7 it belongs to asyncio.run's loop
+            nonlocal gone
+            gone = asyncio.Event()
+            await asgi_app({'type': 'http', 'method': 'GET', 'path': '/'},
+                           receive, send)
+
+        asyncio.run(serve())
+        self.assertLess(len(produced), 1000)
+
+
+class ParallelTestCase(TestCase):
+
+    def test_runs_at_once(self):
+        """Each call waits for the other, so only passes if concurrent."""
+
+        barrier = threading.Barrier(2, timeout=5)
+
+        def call(value):
+            barrier.wait()
+            return value
+
+        with app.app_context():
+            self.assertEqual(
+                parallel.run(lambda: call(1), lambda: call(2)), [1, 2])
+
+    def test_off_runs_in_order(self):
+        app.config['PARALLEL_QUERIES'] = False
+        try:
+            order = []
+            parallel.run(lambda: order.append(1), lambda: order.append(2))
+            self.assertEqual(order, [1, 2])
+        finally:
+            app.config['PARALLEL_QUERIES'] = True
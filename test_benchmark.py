@@ -0,0 +1,79 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, session_users, timelines
+from benchmark import MIX, percentile, regressions, run, summarize
+
+db.create_all()
+
+
+class BenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        for i in range(3):
+            user = User.signup(f"bench{i}", f"bench{i}@test.com", "password",
+                               None)
+            db.session.commit()
+            db.session.add(Message(text=f"benchmark message {i}",
+                                   user_id=user.id))
+        db.session.commit()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertIsNone(percentile([], 50))
+
+    def test_regressions(self):
+        baseline = {'routes': {'home': {'p95_ms': 10, 'queries': 4}}}
+
+        fine = {'routes': {'home': {'p95_ms': 11, 'queries': 4}}}
+        self.assertEqual(regressions(fine, baseline, 0.2), [])
+
+        slower = {'routes': {'home': {'p95_ms': 13, 'queries': 4}}}
+        self.assertEqual(len(regressions(slower, baseline, 0.2)), 1)
+
+        chattier = {'routes': {'home': {'p95_ms': 10, 'queries': 6}}}
+        self.assertEqual(len(regressions(chattier, baseline, 0.2)), 1)
+
+    def test_run(self):
+        """Does a short run exercise the routes without errors?"""
+
+        results, elapsed = run(clients=2, duration=30, max_requests=30,
+                               seed=0)
+        summary = summarize(results, elapsed)
+
+        self.assertEqual(summary['requests'], 60)
+        self.assertLessEqual(set(summary['routes']), {name for name, _ in MIX})
+        for stats in summary['routes'].values():
+            self.assertEqual(stats['errors'], 0)
+            self.assertGreater(stats['queries'], 0)
+
+    def test_run_asgi(self):
+        results, elapsed = run(clients=2, duration=30, max_requests=10,
+                               seed=0, asgi=True)
+        summary = summarize(results, elapsed, mode='asgi')
+
+        self.assertEqual(summary['requests'], 20)
+        self.assertEqual(summary['mode'], 'asgi')
+        for stats in summary['routes'].values():
+            self.assertEqual(stats['errors'], 0)
+            self.assertGreater(stats['queries'], 0)
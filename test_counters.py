@@ -0,0 +1,124 @@
+"""Denormalized user counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class CounterTestCase(TestCase):
+    """Counters follow the routes that change them."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def counts(self, user_id):
+        user = User.query.get(user_id)
+        db.session.refresh(user)
+        return (user.messages_count, user.following_count,
+                user.followers_count, user.likes_count)
+
+    def as_user(self, user_id, method, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return getattr(c, method)(url, **kwargs)
+
+    def test_follow_unfollow(self):
+        """Do follow counts go up and back down?"""
+
+        self.as_user(self.u1_id, "post", f"/users/follow/{self.u2_id}")
+        # following twice doesn't double-count
+        self.as_user(self.u1_id, "post", f"/users/follow/{self.u2_id}")
+
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 1, 0))
+
+        self.as_user(self.u1_id, "post",
+                     f"/users/stop-following/{self.u2_id}")
+
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 0, 0))
+
+    def test_messages_and_likes(self):
+        """Do message and like counts track posting, liking and deleting?"""
+
+        self.as_user(self.u2_id, "post", "/messages/new",
+                     data={"text": "hi"})
+        msg_id = Message.query.one().id
+        self.assertEqual(self.counts(self.u2_id), (1, 0, 0, 0))
+
+        self.as_user(self.u1_id, "post", f"/messages/{msg_id}/like")
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 1))
+
+        self.as_user(self.u2_id, "post", f"/messages/{msg_id}/delete")
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+
+    def test_delete_user(self):
+        """Does deleting a user fix up everyone else's counts?"""
+
+        self.as_user(self.u1_id, "post", f"/users/follow/{self.u2_id}")
+        self.as_user(self.u2_id, "post", f"/users/follow/{self.u1_id}")
+        self.as_user(self.u2_id, "post", "/messages/new",
+                     data={"text": "hi"})
+        msg_id = Message.query.one().id
+        self.as_user(self.u1_id, "post", f"/messages/{msg_id}/like")
+
+        self.as_user(self.u2_id, "post", "/users/delete")
+
+        self.assertIsNone(User.query.get(self.u2_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+
+    def test_recompute_counts(self):
+        """Does the repair command recount from the tables?"""
+
+        db.session.add(FollowersFollowee(
+            followee_id=self.u1_id, follower_id=self.u2_id))
+        db.session.add(Message(text="hi", user_id=self.u2_id))
+        db.session.commit()
+        db.session.add(Like(msg_id=Message.query.one().id,
+                            user_id=self.u1_id))
+        User.query.filter_by(id=self.u1_id).update({"messages_count": 99})
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["repair-counters"])
+        self.assertEqual(result.exit_code, 0)
+
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 0, 1))
+        self.assertEqual(self.counts(self.u2_id), (1, 0, 1, 0))
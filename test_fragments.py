@@ -0,0 +1,107 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import (app, CURR_USER_KEY, fragment_cache, session_users,
+                 timelines)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class FragmentCacheTestCase(TestCase):
+    """Message cards and profile headers are rendered once and reused."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup("carder", "carder@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="cache me", user_id=user.id)
+        db.session.add(msg)
+        User.adjust_counts(user.id, messages_count=1)
+        db.session.commit()
+        self.user_id = user.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_card_reused(self):
+        """Is a card rendered once and then served from the cache?"""
+
+        with self.client as c:
+            c.get(f"/users/{self.user_id}")
+            misses = fragment_cache.stats()["misses"]
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+
+        stats = fragment_cache.stats()
+        self.assertIn("cache me", html)
+        self.assertEqual(stats["misses"], misses)
+        self.assertGreater(stats["hits"], 0)
+
+    def test_profile_edit_refreshes(self):
+        """Does a profile edit show up in cached cards and headers?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get(f"/users/{self.user_id}")
+
+            c.post(f"/users/{self.user_id}/edit", data={
+                "username": "recarded",
+                "email": "carder@test.com",
+                "image_url": "/static/images/new.png",
+                "password": "password",
+            })
+            html = c.get(f"/users/{self.user_id}").get_data(as_text=True)
+
+        self.assertIn("@recarded", html)
+        self.assertIn("/static/images/new.png", html)
+        self.assertNotIn("@carder", html)
+
+    def test_version_in_key(self):
+        """Is a changed author re-rendered even without invalidation?"""
+
+        with app.test_request_context():
+            msg = Message.query.get(self.msg_id)
+            self.assertIn("@carder", fragment_cache.message_card(msg))
+
+            msg.user.username = "sneaky"
+            self.assertIn("@sneaky", fragment_cache.message_card(msg))
+
+    def test_delete_drops_card(self):
+        """Does deleting a message drop its card?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get(f"/users/{self.user_id}")
+            size = fragment_cache.stats()["size"]
+
+            c.post(f"/messages/{self.msg_id}/delete")
+
+        self.assertEqual(fragment_cache.stats()["size"], size - 1)
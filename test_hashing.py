@@ -0,0 +1,111 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashing.py
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, session_users, timelines
+from hashing import HashingBusy, PasswordHasher, hash_rounds, passwords
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHasherTestCase(TestCase):
+
+    def setUp(self):
+        self.hasher = PasswordHasher()
+        self.hasher.rounds = 4
+
+    def test_hash_and_check(self):
+        hashed = self.hasher.hash("secret")
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(self.hasher.check(hashed, "secret"))
+        self.assertFalse(self.hasher.check(hashed, "wrong"))
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
+
+    def test_admission_control(self):
+        """Is work past the queue limit turned away at once?"""
+
+        self.hasher._configure(workers=1, queue=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "done"
+
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.hasher._run(slow)))
+        thread.start()
+        started.wait(5)
+
+        with self.assertRaises(HashingBusy):
+            self.hasher.hash("secret")
+
+        release.set()
+        thread.join()
+        self.assertEqual(results, ["done"])
+        self.assertEqual(self.hasher.stats()['rejected'], 1)
+
+
+class RehashOnLoginTestCase(TestCase):
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+        self.rounds = passwords.rounds
+
+        passwords.rounds = 4
+        user = User.signup("hashed", "hashed@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        passwords.rounds = self.rounds
+        db.session.rollback()
+
+    def test_rehash_on_login(self):
+        passwords.rounds = 5
+
+        with app.test_client() as c:
+            resp = c.post("/login", data={
+                "username": "hashed",
+                "password": "password"
+            })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(hash_rounds(User.query.get(self.user_id).password), 5)
+
+    def test_busy_is_503(self):
+        passwords._configure(workers=1, queue=0)
+        try:
+            with app.test_client() as c:
+                resp = c.post("/login", data={
+                    "username": "hashed",
+                    "password": "password"
+                })
+        finally:
+            passwords.init_app(app)
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
@@ -0,0 +1,136 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import (app, CURR_USER_KEY, fragment_cache, session_users,
+                 timelines)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ConditionalPageTestCase(TestCase):
+    """Profile and message pages answer repeat visits with 304s."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup("tagged", "tagged@test.com", "password", None)
+        other = User.signup("viewer", "viewer@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="first", user_id=user.id)
+        db.session.add(msg)
+        User.adjust_counts(user.id, messages_count=1)
+        db.session.commit()
+        self.user_id = user.id
+        self.other_id = other.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def revisit(self, c, url):
+        """Status of a second GET of `url` sending the first one's ETag."""
+
+        resp = c.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('private', resp.headers['Cache-Control'])
+
+        etag = resp.headers['ETag']
+        return c.get(url, headers={'If-None-Match': etag}).status_code
+
+    def test_profile_not_modified(self):
+        with self.client as c:
+            self.assertEqual(self.revisit(c, f"/users/{self.user_id}"), 304)
+
+    def test_new_message_changes_profile(self):
+        with self.client as c:
+            url = f"/users/{self.user_id}"
+            etag = c.get(url).headers['ETag']
+
+            db.session.add(Message(text="second", user_id=self.user_id))
+            User.adjust_counts(self.user_id, messages_count=1)
+            db.session.commit()
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("second", resp.get_data(as_text=True))
+
+    def test_follow_changes_profile(self):
+        """Is the viewer's follow button part of the ETag?"""
+
+        with self.client as c:
+            self.login(c, self.other_id)
+            url = f"/users/{self.user_id}"
+            etag = c.get(url).headers['ETag']
+
+            c.post(f"/users/follow/{self.user_id}")
+            resp = c.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_message_not_modified(self):
+        with self.client as c:
+            self.login(c, self.other_id)
+            self.assertEqual(self.revisit(c, f"/messages/{self.msg_id}"), 304)
+
+    def test_viewer_in_etag(self):
+        """Does each viewer get their own ETag?"""
+
+        url = f"/messages/{self.msg_id}"
+        with self.client as c:
+            anon = c.get(url).headers['ETag']
+            self.login(c, self.other_id)
+            viewer = c.get(url).headers['ETag']
+
+        self.assertNotEqual(anon, viewer)
+
+    def test_other_pages_not_stored(self):
+        with self.client as c:
+            resp = c.get("/signup")
+
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', resp.headers)
+
+
+class StaticCacheTestCase(TestCase):
+    """Fingerprinted static URLs are cached for a long time."""
+
+    def test_fingerprinted(self):
+        with app.test_request_context():
+            url = app.jinja_env.globals['static_url']('stylesheets/style.css')
+
+        self.assertIn("?v=", url)
+
+        with app.test_client() as c:
+            resp = c.get(url)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            resp.close()
+
+            resp = c.get("/static/stylesheets/style.css")
+            self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+            resp.close()
@@ -0,0 +1,131 @@
+"""CSV importer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_importer.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like, Flag
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from importer import Importer, progress_metadata
+
+db.create_all()
+
+
+def write_csv(folder, name, lines):
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+class ImporterTestCase(TestCase):
+    """Streaming, resumable, appendable imports."""
+
+    def setUp(self):
+        Like.query.delete()
+        Flag.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        progress_metadata.drop_all(db.engine)
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = {
+            'users': write_csv(self.tmp.name, "users.csv", [
+                "email,username,image_url,password,bio,header_image_url,location"
+            ] + [f"u{i}@test.com,u{i},,pw,,,here" for i in range(1, 6)]),
+            'messages': write_csv(self.tmp.name, "messages.csv", [
+                "text,timestamp,user_id",
+                "one,2017-01-21 11:04:53.522807,1",
+                "two,2017-01-22 11:04:53,1",
+                "three,2017-01-23 11:04:53,2",
+            ]),
+            'follows': write_csv(self.tmp.name, "follows.csv", [
+                "followee_id,follower_id", "1,2", "2,1", "3,1"
+            ]),
+            'likes': write_csv(self.tmp.name, "likes.csv", [
+                "user_id,msg_id", "2,1", "3,1"
+            ]),
+        }
+        self.log = []
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def importer(self, **kwargs):
+        return Importer(batch_size=2, log=self.log.append, **kwargs)
+
+    def test_import(self):
+        counts = self.importer().run(self.paths)
+
+        self.assertEqual(counts, dict(users=5, messages=3, follows=3, likes=2))
+        user = User.query.filter_by(username="u1").one()
+        self.assertEqual(user.messages_count, 2)
+        self.assertEqual(user.following_count, 1)
+        self.assertEqual(
+            User.query.filter_by(username="u2").one().likes_count, 1)
+        self.assertIn("rows/s", self.log[-1])
+
+    def test_not_empty_needs_append(self):
+        self.importer().run(self.paths)
+
+        with self.assertRaises(ValueError):
+            self.importer().run(self.paths, name="again")
+
+    def test_append_shifts_ids(self):
+        self.importer().run(self.paths)
+
+        users = write_csv(self.tmp.name, "more.csv", [
+            "email,username,image_url,password,bio,header_image_url,location",
+            "v1@test.com,v1,,pw,,,there",
+        ])
+        messages = write_csv(self.tmp.name, "more-messages.csv", [
+            "text,timestamp,user_id", "new,2018-01-01 00:00:00,1"
+        ])
+        self.importer().run(
+            dict(users=users, messages=messages), name="more", append=True)
+
+        msg = Message.query.filter_by(text="new").one()
+        self.assertEqual(msg.id, 4)
+        self.assertEqual(msg.user.username, "v1")
+
+    def test_resume(self):
+        """Does a re-run after a failure skip the batches already in?"""
+
+        importer = self.importer()
+        insert = importer._insert
+        calls = []
+
+        def flaky_insert(table, columns, rows):
+            calls.append(table.name)
+            if table.name == 'messages' and calls.count('messages') == 2:
+                raise RuntimeError("connection lost")
+            insert(table, columns, rows)
+
+        importer._insert = flaky_insert
+        with self.assertRaises(RuntimeError):
+            importer.run(self.paths)
+        db.session.rollback()
+
+        self.assertEqual(Message.query.count(), 2)
+
+        with self.assertRaises(ValueError):
+            self.importer().run(self.paths)
+
+        counts = self.importer().run(self.paths, resume=True)
+
+        self.assertEqual(counts, dict(users=0, messages=1, follows=3, likes=2))
+        self.assertEqual(
+            sorted(msg.text for msg in Message.query),
+            ["one", "three", "two"])
+        self.assertEqual(User.query.filter_by(username="u1").one()
+                         .messages_count, 2)
@@ -0,0 +1,93 @@
+"""Request metrics and profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, metrics, session_users, timelines
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+        metrics.reset()
+
+        user = User.signup("measured", "measured@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.client = app.test_client()
+        # without a METRICS_TOKEN, metrics are only for local development
+        app.testing = True
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+        app.testing = False
+
+    def test_route_metrics(self):
+        """Are wall/SQL/render time, queries and statements recorded?"""
+
+        with self.client as c:
+            c.get(f"/users/{self.user_id}")
+            c.get(f"/users/{self.user_id}")
+            data = c.get("/metrics").get_json()
+
+        route = data['routes']['users_show']
+        self.assertEqual(route['requests'], 2)
+        self.assertGreater(route['queries'], 0)
+        self.assertGreater(route['wall_ms']['p50'], 0)
+        self.assertGreaterEqual(route['wall_ms']['mean'], route['sql_ms'])
+        self.assertGreater(route['render_ms'], 0)
+        self.assertTrue(route['slowest_statements'])
+        self.assertIn('fragment_cache', data)
+
+    def test_profile_header(self):
+        """Does X-Profile store a profile of that request?"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user_id}", headers={'X-Profile': '1'})
+            profile_id = resp.headers['X-Profile-Id']
+
+            self.assertNotIn('X-Profile-Id',
+                             c.get(f"/users/{self.user_id}").headers)
+
+            listing = c.get("/metrics/profiles").get_json()
+            stats = c.get(f"/metrics/profiles/{profile_id}")
+
+        self.assertEqual(listing['profiles'][0]['endpoint'], 'users_show')
+        self.assertIn("function calls", stats.get_data(as_text=True))
+
+    def test_token_required(self):
+        app.config['METRICS_TOKEN'] = "sekrit"
+
+        with self.client as c:
+            self.assertEqual(c.get("/metrics").status_code, 404)
+            resp = c.get(f"/users/{self.user_id}", headers={'X-Profile': '1'})
+            self.assertNotIn('X-Profile-Id', resp.headers)
+
+            resp = c.get("/metrics", headers={'X-Metrics-Token': "sekrit"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_no_token_only_local(self):
+        with self.client as c:
+            resp = c.get("/metrics",
+                         headers={'X-Forwarded-For': "203.0.113.9"})
+            self.assertEqual(resp.status_code, 404)
+
+            app.testing = False
+            self.assertEqual(c.get("/metrics").status_code, 404)
@@ -0,0 +1,165 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, jobs, timelines
+from jobs import MemoryJobBackend, SQLiteJobBackend
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run queued jobs by hand, not on threads
+app.config['JOB_WORKERS'] = 0
+app.config['JOB_RETRY_DELAY'] = 0
+app.config['JOB_MAX_ATTEMPTS'] = 2
+
+calls = []
+
+
+@jobs.handler('test_record')
+def record(*args):
+    calls.append(('record', args))
+
+
+@jobs.handler('test_batch', batched=True)
+def batch(arg_lists):
+    if ['bad'] in arg_lists:
+        raise ValueError("bad job")
+    calls.append(('batch', arg_lists))
+
+
+class JobBackendTestCase(TestCase):
+    """Behaviour shared by every job queue backend."""
+
+    def check_backend(self, backend):
+        backend.put([('a', [1]), ('b', [2, 'x'])])
+        self.assertEqual(backend.counts()['ready'], 2)
+
+        first, second = backend.take(10, 60)
+        self.assertEqual((first.name, first.args), ('a', [1]))
+        self.assertEqual((second.name, second.args), ('b', [2, 'x']))
+        self.assertEqual(backend.take(10, 60), [])
+
+        backend.ack([first.id])
+        backend.retry(second, time.time() + 60, "later")
+        self.assertEqual(backend.take(10, 60), [])
+        self.assertEqual(backend.counts()['ready'], 1)
+
+        backend.put([('c', [])])
+        job, = backend.take(10, 0)
+        backend.bury(job, "broken")
+        self.assertEqual(backend.counts(),
+                         {'ready': 1, 'running': 0, 'failed': 1})
+
+        # a job whose lease ran out goes to the next taker
+        backend.put([('d', [])])
+        job, = backend.take(10, 0)
+        time.sleep(0.01)
+        again, = backend.take(10, 60)
+        self.assertEqual(again.id, job.id)
+
+        backend.clear()
+        self.assertEqual(backend.counts(),
+                         {'ready': 0, 'running': 0, 'failed': 0})
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryJobBackend())
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_backend(SQLiteJobBackend(os.path.join(tmp, "jobs.db")))
+
+
+class JobsTestCase(TestCase):
+    """Running, batching and retrying jobs."""
+
+    def setUp(self):
+        jobs.backend.clear()
+        del calls[:]
+
+    def test_run_and_batch(self):
+        jobs.enqueue('test_batch', 1)
+        jobs.enqueue('test_record', 'x', 2)
+        jobs.enqueue('test_batch', 3)
+
+        self.assertEqual(jobs.run_once(), 3)
+        self.assertEqual(calls, [('batch', [[1], [3]]),
+                                 ('record', ('x', 2))])
+        self.assertEqual(jobs.backend.counts()['ready'], 0)
+
+    def test_failed_batch_retries_the_culprit(self):
+        jobs.enqueue('test_batch', 1)
+        jobs.enqueue('test_batch', 'bad')
+
+        jobs.run_once()
+        self.assertEqual(calls, [('batch', [[1]])])
+        self.assertEqual(jobs.backend.counts()['ready'], 1)
+
+        # retried once more, then given up on
+        jobs.run_once()
+        self.assertEqual(jobs.backend.counts(),
+                         {'ready': 0, 'running': 0, 'failed': 1})
+
+    def test_request_jobs_wait_for_success(self):
+        with app.test_request_context():
+            jobs.enqueue('test_record', 1)
+            self.assertEqual(jobs.backend.counts()['ready'], 0)
+            app.process_response(app.response_class())
+        self.assertEqual(jobs.backend.counts()['ready'], 1)
+
+
+class PostJobsTestCase(TestCase):
+    """Posting hands the fan-out to the queue."""
+
+    def setUp(self):
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        jobs.backend.clear()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        reader.following.append(author)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        # materialize both timelines, so pushes land
+        timelines.feed(self.author_id)
+        timelines.feed(self.reader_id)
+
+    def tearDown(self):
+        timelines.store.clear()
+        db.session.rollback()
+
+    def test_post_fans_out_later(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            c.post("/messages/new", data={"text": "hello"})
+
+        msg_id = Message.query.one().id
+        self.assertEqual([e[1] for e in timelines.store.get(self.author_id)],
+                         [msg_id])
+        self.assertEqual(timelines.store.get(self.reader_id), [])
+
+        self.assertEqual(jobs.run_once(), 1)
+        self.assertEqual([e[1] for e in timelines.store.get(self.reader_id)],
+                         [msg_id])
@@ -0,0 +1,127 @@
+"""Like/unlike route tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, session_users
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeViewTestCase(TestCase):
+    """Idempotent likes, singly and in bulk."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        session_users.cache.clear()
+
+        self.client = app.test_client()
+
+        u1 = User(username="u1", email="u1@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="u2", email="u2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        msgs = [Message(text=f"m{n}", user_id=u2.id) for n in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.msg_ids = [msg.id for msg in msgs]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            return c.post(url, **kwargs)
+
+    def state(self):
+        """(u1's likes_count, [likes_count of each message], liked ids)"""
+
+        db.session.expire_all()
+        return (User.query.get(self.u1_id).likes_count,
+                [Message.query.get(id).likes_count for id in self.msg_ids],
+                {like.msg_id for like in Like.query})
+
+    def test_like_is_idempotent(self):
+        msg_id = self.msg_ids[0]
+
+        for _ in range(2):
+            resp = self.post(f"/messages/{msg_id}/like")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.state(), (1, [1, 0, 0], {msg_id}))
+
+        for _ in range(2):
+            self.post(f"/messages/{msg_id}/unlike")
+            self.assertEqual(self.state(), (0, [0, 0, 0], set()))
+
+    def test_like_json(self):
+        resp = self.post(f"/messages/{self.msg_ids[1]}/like",
+                         headers={'Accept': 'application/json'})
+        self.assertEqual(resp.get_json(),
+                         {'msg_id': self.msg_ids[1], 'liked': True})
+
+    def test_like_missing_message(self):
+        resp = self.post("/messages/999999/like")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.state(), (0, [0, 0, 0], set()))
+
+    def test_get_doesnt_like(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = c.get(f"/messages/{self.msg_ids[0]}/like")
+        self.assertEqual(resp.status_code, 405)
+        self.assertEqual(self.state(), (0, [0, 0, 0], set()))
+
+    def test_bulk(self):
+        a, b, c = self.msg_ids
+        self.post(f"/messages/{a}/like")
+
+        resp = self.post("/likes", json={'like': [a, b, c], 'unlike': []})
+        self.assertEqual(resp.get_json(), {'liked': [b, c], 'unliked': []})
+        self.assertEqual(self.state(), (3, [1, 1, 1], {a, b, c}))
+
+        resp = self.post("/likes", json={'like': [b], 'unlike': [a, 999999]})
+        self.assertEqual(resp.get_json(), {'liked': [], 'unliked': [a]})
+        self.assertEqual(self.state(), (2, [0, 1, 1], {b, c}))
+
+    def test_bulk_rejects_bad_requests(self):
+        a = self.msg_ids[0]
+        for body in ({'like': [a], 'unlike': [a]}, {'like': "1"},
+                     {'like': [True]}, [a]):
+            resp = self.post("/likes", json=body)
+            self.assertEqual(resp.status_code, 400)
+
+        app.config['LIKES_BULK_MAX'] = 2
+        try:
+            resp = self.post("/likes", json={'like': self.msg_ids})
+        finally:
+            app.config['LIKES_BULK_MAX'] = 500
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.state(), (0, [0, 0, 0], set()))
+
+    def test_repair_counts(self):
+        db.session.add(Like(msg_id=self.msg_ids[2], user_id=self.u1_id))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["repair-counters"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(self.state(), (1, [0, 0, 1], {self.msg_ids[2]}))
@@ -32,6 +32,9 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -0,0 +1,123 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+from models import db, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrations
+import query_plans
+import search
+
+db.create_all()
+
+LEGACY_SCHEMA = """
+    CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE, image_url TEXT, header_image_url TEXT,
+        bio TEXT, location TEXT, password TEXT NOT NULL);
+    CREATE TABLE follows (followee_id INTEGER, follower_id INTEGER,
+        PRIMARY KEY (followee_id, follower_id));
+    CREATE TABLE messages (id INTEGER PRIMARY KEY, text VARCHAR(140) NOT NULL,
+        timestamp DATETIME NOT NULL, user_id INTEGER NOT NULL);
+    CREATE TABLE likes (msg_id INTEGER, user_id INTEGER,
+        PRIMARY KEY (msg_id, user_id));
+    CREATE TABLE flags (msg_id INTEGER, user_id INTEGER,
+        PRIMARY KEY (msg_id, user_id));
+    INSERT INTO users (email, username, password) VALUES ('a', 'a', 'x');
+    INSERT INTO messages (text, timestamp, user_id)
+        VALUES ('hi', '2018-01-01 00:00:00', 1);
+"""
+
+
+class MigrationTestCase(TestCase):
+    """Migrations on scratch SQLite databases."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmp.name, 'schema.db')}")
+        self.log = []
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def index_names(self, table):
+        return {index['name'] for index in inspect(self.engine).get_indexes(
+            table)}
+
+    def test_fresh_database(self):
+        applied = migrations.upgrade(self.engine, log=self.log.append)
+
+        self.assertEqual(applied, [mig.version for mig in migrations.MIGRATIONS])
+        self.assertIn('ix_messages_user_id_timestamp',
+                      self.index_names('messages'))
+        self.assertEqual(migrations.upgrade(self.engine, log=self.log.append),
+                         [])
+
+    def test_legacy_database(self):
+        """Is a pre-migrations schema brought up to date, data intact?"""
+
+        raw = self.engine.raw_connection()
+        raw.executescript(LEGACY_SCHEMA)
+        raw.close()
+
+        applied = migrations.upgrade(self.engine, log=self.log.append)
+
+        self.assertEqual(applied,
+                         [mig.version for mig in migrations.MIGRATIONS[1:]])
+        self.assertIn('ix_follows_follower_id', self.index_names('follows'))
+        self.assertIn('ix_likes_user_id', self.index_names('likes'))
+        self.assertEqual(
+            self.engine.execute(
+                "SELECT username, messages_count FROM users").fetchall(),
+            [('a', 1)])
+        self.assertTrue(all(
+            applied for mig, applied in migrations.status(self.engine)))
+
+
+class QueryPlanTestCase(TestCase):
+    """The hot queries use indexes."""
+
+    def test_no_table_scans(self):
+        self.assertEqual(query_plans.check(), {})
+
+    def test_missing_index_found(self):
+        index = 'ix_follows_follower_id'
+        db.session.execute(f"DROP INDEX {index}")
+        db.session.commit()
+        try:
+            problems = query_plans.check()
+        finally:
+            with db.engine.begin() as conn:
+                migrations.create_index_if_missing(
+                    conn, FollowersFollowee.__table__, index)
+
+        self.assertEqual(problems, {'follower ids': ['follows']})
+
+    def test_search_index_migrated(self):
+        """Does the migration make the search indexes create_all() didn't?"""
+
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("search indexes are Postgres-only")
+
+        db.session.execute("DROP INDEX ix_messages_search")
+        db.session.commit()
+        try:
+            self.assertEqual(query_plans.check(),
+                             {'message search': ['messages']})
+        finally:
+            with db.engine.begin() as conn:
+                migrations.search_indexes(conn)
+
+        self.assertEqual(query_plans.check(), {})
@@ -0,0 +1,192 @@
+"""Flagging and moderation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_moderation.py
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like, Flag
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, push, session_users, timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class ModerationTestCase(TestCase):
+    """Flags, the hide threshold and the moderation queue."""
+
+    def setUp(self):
+        Flag.query.delete()
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        self.client = app.test_client()
+
+        users = [
+            User(username=name, email=f"{name}@test.com",
+                 password="HASHED_PASSWORD")
+            for name in ("author", "reader1", "reader2", "mod")
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        self.author_id, self.r1_id, self.r2_id, self.mod_id = [
+            user.id for user in users
+        ]
+
+        users[1].following.append(users[0])
+        msgs = [Message(text=f"m{n}", user_id=self.author_id)
+                for n in range(3)]
+        db.session.add_all(msgs)
+        User.recompute_counts()
+        db.session.commit()
+        self.msg_ids = [msg.id for msg in msgs]
+
+        app.config['FLAG_HIDE_THRESHOLD'] = 2
+        app.config['MODERATORS'] = {"mod"}
+
+    def tearDown(self):
+        app.config['FLAG_HIDE_THRESHOLD'] = 5
+        app.config['MODERATORS'] = set()
+        db.session.rollback()
+
+    def as_user(self, user_id, method, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return getattr(c, method)(url, **kwargs)
+
+    def flag(self, user_id, msg_id, reason="spam"):
+        return self.as_user(user_id, "post", f"/messages/{msg_id}/flag",
+                            data={"text": reason})
+
+    def message(self, msg_id):
+        db.session.expire_all()
+        return Message.query.get(msg_id)
+
+    def test_flag_keeps_reason(self):
+        """Is a flag stored with its reason, without posting a message?"""
+
+        resp = self.flag(self.r1_id, self.msg_ids[0], "rude")
+        self.flag(self.r1_id, self.msg_ids[0], "rude again")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(
+            [(f.user_id, f.reason) for f in Flag.query],
+            [(self.r1_id, "rude")])
+        self.assertEqual(self.message(self.msg_ids[0]).flags_count, 1)
+
+        self.as_user(self.r1_id, "post", f"/messages/{self.msg_ids[0]}/unflag")
+        self.assertEqual(Flag.query.count(), 0)
+        self.assertEqual(self.message(self.msg_ids[0]).flags_count, 0)
+
+    def test_threshold_hides(self):
+        """Is a message hidden once it reaches the threshold?"""
+
+        msg_id = self.msg_ids[1]
+        self.assertEqual(len(timelines.feed(self.r1_id)), 3)
+
+        self.flag(self.r1_id, msg_id)
+        self.assertFalse(self.message(msg_id).hidden)
+
+        self.flag(self.r2_id, msg_id)
+        self.flag(self.mod_id, msg_id)
+        self.assertTrue(self.message(msg_id).hidden)
+        self.assertEqual(User.query.get(self.author_id).messages_count, 2)
+
+        self.assertNotIn(msg_id, [m.id for m in timelines.feed(self.r1_id)])
+        resp = self.as_user(self.r1_id, "get", f"/users/{self.author_id}")
+        self.assertNotIn(b"<p>m1</p>", resp.data)
+        self.assertEqual(
+            self.as_user(self.r1_id, "get", f"/messages/{msg_id}")
+            .status_code, 404)
+        self.assertEqual(
+            self.as_user(self.author_id, "get", f"/messages/{msg_id}")
+            .status_code, 200)
+
+    def test_queue(self):
+        """Most flagged first, a page at a time, for moderators only."""
+
+        a, b, c = self.msg_ids
+        self.flag(self.r1_id, a, "spam")
+        for user_id in (self.r1_id, self.r2_id):
+            self.flag(user_id, b, "spam")
+
+        resp = self.as_user(self.r1_id, "get", "/moderation")
+        self.assertEqual(resp.status_code, 302)
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            first = self.as_user(self.mod_id, "get", "/moderation")
+            self.assertIn(b"<p>m1</p>", first.data)
+            self.assertIn(b"spam &times; 2", first.data)
+            self.assertIn(b"hidden", first.data)
+            self.assertNotIn(b"<p>m0</p>", first.data)
+
+            cursor = first.data.split(b"before=")[1].split(b'"')[0]
+            second = self.as_user(self.mod_id, "get",
+                                  f"/moderation?before={cursor.decode()}")
+            self.assertIn(b"<p>m0</p>", second.data)
+            self.assertNotIn(b"<p>m2</p>", second.data)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_restore_not_pushed(self):
+        """A restored message isn't sent to live feeds as if new."""
+
+        msg_id = self.msg_ids[2]
+        for user_id in (self.r1_id, self.r2_id):
+            self.flag(user_id, msg_id)
+        subscription = push.subscribe(self.r1_id, [self.author_id])
+        chunks = subscription.chunks()
+        next(chunks)
+
+        self.as_user(self.mod_id, "post", f"/moderation/{msg_id}/restore")
+        self.as_user(self.author_id, "post", "/messages/new",
+                     data={"text": "brand new"})
+
+        data = b""
+        deadline = time.monotonic() + 5
+        while b"brand new" not in data:
+            self.assertLess(time.monotonic(), deadline)
+            data += next(chunks)
+        chunks.close()
+        self.assertNotIn(b'"m2"', data)
+
+    def test_restore_and_hide(self):
+        msg_id = self.msg_ids[2]
+        for user_id in (self.r1_id, self.r2_id):
+            self.flag(user_id, msg_id)
+        self.assertTrue(self.message(msg_id).hidden)
+
+        self.as_user(self.mod_id, "post", f"/moderation/{msg_id}/restore")
+        msg = self.message(msg_id)
+        self.assertEqual((msg.hidden, msg.flags_count), (False, 0))
+        self.assertEqual(Flag.query.count(), 0)
+        self.assertEqual(User.query.get(self.author_id).messages_count, 3)
+        self.assertIn(msg_id, [m.id for m in timelines.feed(self.r1_id)])
+
+        self.as_user(self.mod_id, "post", f"/moderation/{msg_id}/hide")
+        self.assertTrue(self.message(msg_id).hidden)
+        self.assertEqual(User.query.get(self.author_id).messages_count, 2)
+
+        # deleting a hidden, flagged message doesn't count it twice
+        self.flag(self.r1_id, msg_id)
+        self.as_user(self.author_id, "post", f"/messages/{msg_id}/delete")
+        self.assertEqual(User.query.get(self.author_id).messages_count, 2)
+        self.assertEqual(Flag.query.count(), 0)
@@ -0,0 +1,169 @@
+"""Cursor pagination tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagination.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, timelines
+from pagination import (encode_cursor, decode_cursor, message_key,
+                        paginate_messages, to_micros, from_micros)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CursorTestCase(TestCase):
+    """Cursor encoding."""
+
+    def test_round_trip(self):
+        cursor = encode_cursor(1546300800123456, 42)
+        self.assertEqual(decode_cursor(cursor, 2), (1546300800123456, 42))
+        self.assertIsNone(decode_cursor(None, 2))
+
+    def test_bad_cursors(self):
+        for bad in ["!!!", encode_cursor(1), encode_cursor("a", 2), "e30"]:
+            with self.assertRaises(ValueError):
+                decode_cursor(bad, 2)
+
+    def test_micros(self):
+        dt = datetime(2019, 1, 2, 3, 4, 5, 678901)
+        self.assertEqual(from_micros(to_micros(dt)), dt)
+
+
+class PaginationViewTestCase(TestCase):
+    """Walking list views page by page."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup("pager", "pager@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # Two messages share each timestamp so ties are broken by id.
+        base = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"msg {i}", user_id=user.id,
+                    timestamp=base + timedelta(minutes=i // 2))
+            for i in range(7)
+        ])
+        db.session.commit()
+
+        self.expected = [
+            m.id for m in Message.query.order_by(
+                Message.timestamp.desc(), Message.id.desc())
+        ]
+
+        app.config['MESSAGES_PER_PAGE'] = 3
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+        app.config['TIMELINE_LENGTH'] = 800
+        timelines.init_app(app)
+        db.session.rollback()
+
+    def walk(self, per_page=3):
+        """Every message id, fetching one page at a time."""
+
+        query = Message.query.filter(Message.user_id == self.user_id)
+        ids, before = [], None
+
+        while True:
+            page = paginate_messages(query, before, per_page)
+            ids.extend(m.id for m in page.items)
+            if not page.next_cursor:
+                return ids
+            before = decode_cursor(page.next_cursor, 2)
+
+    def test_paginate_messages(self):
+        """Do pages cover every message once, in order?"""
+
+        self.assertEqual(self.walk(), self.expected)
+        self.assertEqual(self.walk(per_page=7), self.expected)
+
+    def test_feed_past_timeline_length(self):
+        """Does the feed carry on past a trimmed timeline?"""
+
+        app.config['TIMELINE_LENGTH'] = 4
+        timelines.init_app(app)
+
+        ids, before = [], None
+        while True:
+            entries = timelines.entries(self.user_id, 3, before)
+            if not entries:
+                break
+            ids.extend(e[1] for e in entries)
+            before = entries[-1][:2]
+
+        self.assertEqual(ids, self.expected)
+
+    def test_profile_load_more(self):
+        """Does the profile page link to the next page?"""
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Load more", html)
+        self.assertIn("msg 6", html)
+        self.assertNotIn("msg 1<", html)
+
+        msg = Message.query.get(self.expected[2])
+        cursor = encode_cursor(*message_key(msg))
+        html = self.client.get(
+            f"/users/{self.user_id}?before={cursor}").get_data(as_text=True)
+        self.assertIn("msg 2", html)
+        self.assertNotIn("msg 6", html)
+
+    def test_bad_cursor(self):
+        """Is a garbage cursor a 400 rather than a 500?"""
+
+        resp = self.client.get(f"/users/{self.user_id}?before=nonsense")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_home_feed_pages(self):
+        """Does the home feed paginate?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Load more", html)
+        self.assertIn("msg 6", html)
+        self.assertNotIn("msg 3", html)
+
+    def test_list_users(self):
+        """Does the users listing page by id?"""
+
+        app.config['USERS_PER_PAGE'] = 1
+        try:
+            other = User.signup("other", "other@test.com", "password", None)
+            db.session.commit()
+
+            html = self.client.get("/users").get_data(as_text=True)
+            self.assertIn("@other", html)
+            self.assertNotIn("@pager", html)
+
+            cursor = encode_cursor(other.id)
+            html = self.client.get(
+                f"/users?before={cursor}").get_data(as_text=True)
+            self.assertIn("@pager", html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
@@ -0,0 +1,252 @@
+"""Live feed stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_push.py
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, push, session_users, timelines
+from asgi import AsgiApp
+from push import SQLiteBroker, cursor_for
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+app.config['PUSH_HEARTBEAT'] = 0.1
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+def events(data):
+    """`[(event, data)]` of the server-sent events in `data`."""
+
+    found = []
+    for block in data.decode().split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.split("\n")
+            if ": " in line and not line.startswith(":"))
+        if 'event' in fields:
+            found.append((fields['event'], json.loads(fields['data'])))
+    return found
+
+
+class PushTestCase(TestCase):
+    """reader follows writer; other is followed by no one."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        users = [
+            User(username=name, email=f"{name}@test.com",
+                 password="HASHED_PASSWORD")
+            for name in ("reader", "writer", "other")
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+        FollowersFollowee.add(self.ids["reader"], self.ids["writer"])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PUSH_MAX_CONNECTIONS'] = 500
+        app.config['PUSH_QUEUE_SIZE'] = 64
+        app.config['PUSH_SYNC_MAX_CONNECTIONS'] = 0
+
+    def client(self, name):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[name]
+        return client
+
+    def stream(self, name, **kwargs):
+        """`name`'s feed stream, as served by a threaded server."""
+
+        # environ_base can't set this; the builder overwrites it
+        return self.client(name).get(
+            "/api/v1/feed/stream",
+            environ_overrides={'wsgi.multithread': True}, **kwargs)
+
+    def post(self, name, text):
+        self.client(name).post("/messages/new", data={"text": text})
+
+    def read_until(self, chunks, text, timeout=5):
+        """Chunks of stream `chunks` up to one containing `text`."""
+
+        data = b""
+        deadline = time.monotonic() + timeout
+        while text.encode() not in data:
+            self.assertLess(time.monotonic(), deadline)
+            data += next(chunks)
+        return data
+
+    def test_pushes_followed_messages(self):
+        resp = self.stream("reader")
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        chunks = iter(resp.response)
+
+        self.post("other", "not for reader")
+        self.post("writer", "for reader")
+        data = self.read_until(chunks, "for reader")
+
+        (event, payload), = events(data)
+        self.assertEqual(event, "messages")
+        self.assertEqual(payload['messages'][0]['text'], "for reader")
+        self.assertEqual(payload['users'][0]['username'], "writer")
+        self.assertNotIn(b"not for reader", data)
+
+        # following someone while connected
+        self.client("reader").post(f"/users/follow/{self.ids['other']}")
+        self.post("other", "followed now")
+        self.read_until(chunks, "followed now")
+
+        resp.close()
+        self.assertEqual(push.stats()['connections'], 0)
+
+    def test_resumes_after_last_event(self):
+        self.post("writer", "seen")
+        self.post("writer", "missed")
+        seen, missed = timelines.entries(self.ids["reader"], 2)[::-1]
+
+        resp = self.stream(
+            "reader", headers={'Last-Event-ID': cursor_for(seen)})
+        data = next(iter(resp.response))
+        resp.close()
+
+        (event, payload), = events(data)
+        self.assertEqual([msg['text'] for msg in payload['messages']],
+                         ["missed"])
+
+    def test_needs_login(self):
+        resp = app.test_client().get("/api/v1/feed/stream")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_released_unread(self):
+        """Streams closed before they start don't keep their place."""
+
+        client = self.client("reader")
+        self.assertEqual(client.head("/api/v1/feed/stream").status_code, 405)
+        self.stream("reader").close()
+
+        subscription = push.subscribe(self.ids["reader"], [])
+        asyncio.run(subscription.async_chunks().aclose())
+
+        self.assertEqual(push.stats()['connections'], 0)
+
+    def test_connection_cap(self):
+        app.config['PUSH_MAX_CONNECTIONS'] = 1
+
+        first = self.stream("reader")
+        second = self.stream("writer")
+        first.close()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 503)
+        self.assertIn('Retry-After', second.headers)
+
+    def test_single_threaded_server(self):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids["reader"]
+
+        self.assertEqual(client.get("/api/v1/feed/stream").status_code, 503)
+
+        app.config['PUSH_SYNC_MAX_CONNECTIONS'] = 1
+        first = client.get("/api/v1/feed/stream")
+        second = client.get("/api/v1/feed/stream")
+        first.close()
+        self.assertEqual((first.status_code, second.status_code), (200, 503))
+
+    def test_slow_stream_is_closed(self):
+        app.config['PUSH_QUEUE_SIZE'] = 2
+        subscription = push.subscribe(self.ids["reader"], [])
+        for n in range(3):
+            subscription.put(f"event {n}\n\n".encode())
+
+        data = b"".join(subscription.chunks())
+
+        self.assertIn(b"event 1", data)
+        self.assertNotIn(b"event 2", data)
+        self.assertEqual(push.stats()['connections'], 0)
+
+    def test_asgi_stream(self):
+        """Served from the event loop, ending when the client leaves."""
+
+        asgi_app = AsgiApp(app, threads=2)
+        cookie = app.session_interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: self.ids["reader"]})
+        name = app.config['SESSION_COOKIE_NAME']
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/api/v1/feed/stream',
+            'headers': [(b'cookie', f"{name}={cookie}".encode())],
+        }
+        received = []
+
+        async def run():
+            requested = []
+            left = asyncio.Event()
+
+            async def receive():
+                if not requested:
+                    requested.append(True)
+                    return {'type': 'http.request', 'body': b''}
+                await left.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                received.append(message)
+                if b"over asgi" in message.get('body', b''):
+                    left.set()
+                elif message.get('body', b'').startswith(b"retry"):
+                    # connected: post from elsewhere
+                    threading.Thread(
+                        target=self.post, args=("writer", "over asgi")).start()
+
+            await asyncio.wait_for(asgi_app(scope, receive, send), 10)
+
+        asyncio.run(run())
+
+        self.assertEqual(received[0]['status'], 200)
+        self.assertIn(b"over asgi", b"".join(
+            message.get('body', b'') for message in received))
+        self.assertEqual(push.stats()['connections'], 0)
+
+
+class BrokerTestCase(TestCase):
+
+    def test_sqlite_broker_reaches_other_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "push.db")
+            publisher, listener = SQLiteBroker(path), SQLiteBroker(path)
+            heard = []
+            done = threading.Event()
+
+            def deliver(event):
+                heard.append(event)
+                done.set()
+
+            listener.listen(deliver)
+            publisher.publish({'message': [1, 2, 3]})
+
+            self.assertTrue(done.wait(5))
+            listener.close()
+            self.assertEqual(heard, [{'message': [1, 2, 3]}])
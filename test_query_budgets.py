@@ -0,0 +1,132 @@
+"""Query budget tests: list views shouldn't run a query per row."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budgets.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, timelines
+from query_counter import count_queries, query_budget, QueryBudgetExceeded
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+
+class QueryBudgetTestCase(TestCase):
+    """Routes stay within their query budgets however many rows they show."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+
+        self.client = app.test_client()
+
+        viewer = User(username="viewer", email="viewer@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add(viewer)
+        db.session.commit()
+        self.viewer_id = viewer.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add_authors(self, count, start=0):
+        """`count` followed authors, each with one message the viewer likes."""
+
+        viewer = User.query.get(self.viewer_id)
+        for i in range(start, start + count):
+            author = User(username=f"author{i}", email=f"a{i}@test.com",
+                          password="HASHED_PASSWORD")
+            author.messages.append(Message(text=f"hello {i}"))
+            viewer.following.append(author)
+            db.session.add(author)
+            db.session.flush()
+            viewer.liked_msgs.append(author.messages[0])
+        db.session.commit()
+        timelines.store.clear()
+
+    def queries_for(self, url):
+        """Number of queries a repeat logged-in GET of `url` runs."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            # warm the caches; we're after the steady-state cost
+            c.get(url)
+
+            with count_queries() as counter:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return counter.count
+
+    def test_home_constant_queries(self):
+        """Does the feed cost the same for 3 authors as for 15?"""
+
+        self.add_authors(3)
+        few = self.queries_for("/")
+
+        self.add_authors(12, start=3)
+        many = self.queries_for("/")
+
+        self.assertEqual(few, many)
+
+    def test_likes_constant_queries(self):
+        """Does the likes page cost the same for 3 likes as for 15?"""
+
+        self.add_authors(3)
+        few = self.queries_for(f"/users/{self.viewer_id}/likes")
+
+        self.add_authors(12, start=3)
+        many = self.queries_for(f"/users/{self.viewer_id}/likes")
+
+        self.assertEqual(few, many)
+
+    def test_message_show(self):
+        """Does the single message page load its author up front?"""
+
+        self.add_authors(1)
+        msg_id = Message.query.one().id
+        self.assertLessEqual(self.queries_for(f"/messages/{msg_id}"), 4)
+
+    def test_budget_enforced(self):
+        """Does going over budget fail the request?"""
+
+        @app.route('/test-over-budget')
+        @query_budget(1)
+        def over_budget():
+            User.query.all()
+            User.query.all()
+            return "done"
+
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/test-over-budget')
+        finally:
+            app.config['PROPAGATE_EXCEPTIONS'] = None
+
+    def test_follow_lists_constant_queries(self):
+        """Do the following/users pages cost the same for 3 users as 15?"""
+
+        self.add_authors(3)
+        few = [self.queries_for(f"/users/{self.viewer_id}/following"),
+               self.queries_for("/users")]
+
+        self.add_authors(12, start=3)
+        many = [self.queries_for(f"/users/{self.viewer_id}/following"),
+                self.queries_for("/users")]
+
+        self.assertEqual(few, many)
@@ -0,0 +1,95 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# with a second database standing in for the replica:
+#
+#    createdb warbler-test-replica
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['DATABASE_REPLICA_URLS'] = "postgresql:///warbler-test-replica"
+
+from app import app, CURR_USER_KEY, session_users, timelines, fragment_cache
+from replicas import PRIMARY_UNTIL_KEY
+
+db.create_all()
+replica = db.get_engine(app, bind='replica_0')
+db.Model.metadata.create_all(bind=replica)
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class ReplicaTestCase(TestCase):
+    """The replica has the user under an old name, as if it lagged."""
+
+    def setUp(self):
+        for engine in (db.engine, replica):
+            engine.execute(Message.__table__.delete())
+            engine.execute(User.__table__.delete())
+        timelines.store.clear()
+        session_users.cache.clear()
+        fragment_cache.clear()
+        db.routed.clear()
+
+        self.client = app.test_client()
+
+        user = User(username="testuser", email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        replica.execute(User.__table__.insert(), dict(
+            id=user.id, username="lagging", email="test@test.com",
+            password="HASHED_PASSWORD"))
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_reads_from_replica(self):
+        resp = self.client.get(f"/users/{self.user_id}")
+
+        self.assertIn(b"@lagging", resp.data)
+        self.assertEqual(db.routed, {'replica_0': 1})
+
+    def test_read_after_write(self):
+        """After writing, the user reads from the primary for a while."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "fresh"})
+            with c.session_transaction() as sess:
+                self.assertIn(PRIMARY_UNTIL_KEY, sess)
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertIn(b"@testuser", resp.data)
+            self.assertIn(b"fresh", resp.data)
+            self.assertEqual(db.routed, {'primary (recent write)': 1})
+
+            with c.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = 0
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertNotIn(b"fresh", resp.data)
+
+    def test_outside_requests_use_primary(self):
+        self.assertEqual(User.query.get(self.user_id).username, "testuser")
+
+    def test_pool_stats(self):
+        self.client.get(f"/users/{self.user_id}")
+
+        stats = db.stats()
+        self.assertEqual(set(stats['pools']), {'primary', 'replica_0'})
+        self.assertEqual(stats['routed'], {'replica_0': 1})
@@ -0,0 +1,146 @@
+"""Search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, search_index, session_users, timelines
+from search import InvertedIndex, tokenize
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class InvertedIndexTestCase(TestCase):
+    """The in-process index used when Postgres isn't available."""
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, {"bird": 1, "song": 1})
+        self.index.add(2, {"bird": 3})
+        self.index.add(3, {"birch": 1, "tree": 1})
+
+    def test_ranked(self):
+        self.assertEqual(self.index.search(["bird"], 10), [2, 1])
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.index.search(["bird", "song"], 10), [1])
+
+    def test_last_word_is_prefix(self):
+        self.assertEqual(sorted(self.index.search(["bir"], 10)), [1, 2, 3])
+        self.assertEqual(self.index.search(["bir", "song"], 10), [])
+
+    def test_remove(self):
+        self.index.remove(2)
+        self.assertEqual(self.index.search(["bird"], 10), [1])
+        self.index.add(1, {"tree": 1})
+        self.assertEqual(self.index.search(["bird"], 10), [])
+        self.assertNotIn("bird", self.index.vocabulary)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Hello, World! 2x"), ["hello", "world", "2x"])
+        self.assertEqual(tokenize(None), [])
+
+
+class SearchViewTestCase(TestCase):
+    """Searching through the routes, on whichever engine is configured."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        timelines.store.clear()
+        session_users.cache.clear()
+        search_index.reset()
+
+        self.client = app.test_client()
+
+        robin = User(username="robin", email="robin@test.com",
+                     password="HASHED_PASSWORD", bio="sings at dawn",
+                     location="Sherwood")
+        wren = User(username="wren", email="wren@test.com",
+                    password="HASHED_PASSWORD", bio="friend of robin",
+                    location="Nottingham")
+        db.session.add_all([robin, wren])
+        db.session.commit()
+        self.robin_id = robin.id
+        self.wren_id = wren.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_user_search_ranked(self):
+        """Does a username match outrank a bio match?"""
+
+        html = self.client.get("/users?q=robin").get_data(as_text=True)
+        self.assertLess(html.index("@robin"), html.index("@wren"))
+
+        html = self.client.get("/users?q=notting").get_data(as_text=True)
+        self.assertIn("@wren", html)
+        self.assertNotIn("@robin", html)
+
+    def test_user_search_pages(self):
+        """Do search results page on, best first, without repeats?"""
+
+        app.config['USERS_PER_PAGE'] = 1
+        try:
+            resp = self.client.get("/users?q=robin")
+            first = resp.get_data(as_text=True)
+            self.assertIn("@robin", first)
+            self.assertNotIn("@wren", first)
+            self.assertIn("Load more", first)
+
+            page = search_index.paginate_users("robin", None, 1)
+            html = self.client.get(
+                f"/users?q=robin&before={page.next_cursor}").get_data(
+                    as_text=True)
+            self.assertIn("@wren", html)
+            self.assertNotIn("@robin", html)
+            self.assertNotIn("Load more", html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
+    def test_typeahead(self):
+        """Does typeahead complete usernames?"""
+
+        resp = self.client.get("/search/typeahead?q=Wr")
+        self.assertEqual([u["id"] for u in resp.get_json()], [self.wren_id])
+
+        resp = self.client.get("/search/typeahead?q=%25")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_message_index_follows_posts(self):
+        """Are messages searchable once posted, and gone once deleted?"""
+
+        # build the index before posting so the update is incremental
+        self.client.get("/search?q=anything")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.robin_id
+            c.post("/messages/new", data={"text": "Dawn chorus tomorrow"})
+
+        html = self.client.get("/search?q=chorus").get_data(as_text=True)
+        self.assertIn("Dawn chorus tomorrow", html)
+
+        msg_id = Message.query.one().id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.robin_id
+            c.post(f"/messages/{msg_id}/delete")
+
+        html = self.client.get("/search?q=chorus").get_data(as_text=True)
+        self.assertNotIn("Dawn chorus tomorrow", html)
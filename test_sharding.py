@@ -0,0 +1,260 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+#
+# with a second database as shard 1:
+#
+#    createdb warbler-test-shards
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like, Flag
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SHARD_URLS'] = "postgresql:///warbler-test-shards"
+
+from app import app, CURR_USER_KEY, session_users, shards, timelines
+from shards import ShardError, plan_moves
+
+db.create_all()
+shards.create_tables()
+shard_1 = shards.engine(1)
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class ShardingTestCase(TestCase):
+    """a and c on the main database (shard 0), b on shard 1."""
+
+    def setUp(self):
+        for engine in (db.engine, shard_1):
+            for model in (Like, Flag, Message):
+                engine.execute(model.__table__.delete())
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        timelines.store.clear()
+        session_users.cache.clear()
+        shards.forget(*range(1000))
+
+        self.client = app.test_client()
+
+        users = [
+            User(username=name, email=f"{name}@test.com",
+                 password="HASHED_PASSWORD", shard=shard)
+            for name, shard in (("a", 0), ("b", 1), ("c", 0))
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, name, text, timestamp):
+        msg = Message(id=shards.new_message_id(), text=text,
+                      user_id=self.ids[name], timestamp=timestamp)
+        with shards.for_user(msg.user_id):
+            db.session.add(msg)
+            db.session.commit()
+            return msg.id
+
+    def rows(self, engine, model):
+        return engine.execute(model.__table__.select()).fetchall()
+
+    def as_user(self, name, method, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[name]
+            return getattr(c, method)(url, **kwargs)
+
+    def test_post_goes_to_authors_shard(self):
+        self.as_user("b", "post", "/messages/new", data={"text": "from b"})
+
+        self.assertEqual(self.rows(db.engine, Message), [])
+        msg, = self.rows(shard_1, Message)
+        self.assertEqual(msg.text, "from b")
+
+        resp = self.client.get(f"/users/{self.ids['b']}")
+        self.assertIn(b"from b", resp.data)
+        resp = self.client.get(f"/messages/{msg.id}")
+        self.assertIn(b"from b", resp.data)
+
+    def test_ids_unique_across_shards(self):
+        ids = [
+            self.post(name, "hi", datetime(2020, 1, 1))
+            for name in "abcb"
+        ]
+        self.assertEqual(len(set(ids)), 4)
+
+    def test_feed_merges_shards_in_order(self):
+        for name in "bc":
+            FollowersFollowee.add(self.ids["a"], self.ids[name])
+        db.session.commit()
+        for day, name in enumerate("bcbac", 1):
+            self.post(name, f"{name} on day {day}", datetime(2020, 1, day))
+
+        feed = timelines.feed(self.ids["a"])
+
+        self.assertEqual([msg.text for msg in feed], [
+            "c on day 5", "a on day 4", "b on day 3", "c on day 2",
+            "b on day 1"
+        ])
+        self.assertEqual(feed[0].user.username, "c")
+        self.assertEqual(feed[2].user.username, "b")
+
+        resp = self.as_user("a", "get", "/")
+        self.assertIn(b"b on day 3", resp.data)
+
+    def test_likes_live_with_the_message(self):
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        c_msg = self.post("c", "by c", datetime(2020, 1, 2))
+
+        resp = self.as_user("a", "post", "/likes",
+                            json={"like": [b_msg, c_msg, 999999]})
+        self.assertEqual(sorted(resp.get_json()["liked"]),
+                         sorted([b_msg, c_msg]))
+
+        self.assertEqual([row.msg_id for row in self.rows(shard_1, Like)],
+                         [b_msg])
+        self.assertEqual([row.msg_id for row in self.rows(db.engine, Like)],
+                         [c_msg])
+        self.assertEqual(User.query.get(self.ids["a"]).likes_count, 2)
+
+        resp = self.client.get(f"/users/{self.ids['a']}/likes")
+        self.assertLess(resp.data.index(b"by c"), resp.data.index(b"by b"))
+
+        self.as_user("a", "post", f"/messages/{b_msg}/unlike")
+        self.assertEqual(self.rows(shard_1, Like), [])
+
+    def test_api_rows_across_shards(self):
+        FollowersFollowee.add(self.ids["a"], self.ids["b"])
+        db.session.commit()
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        self.post("a", "by a", datetime(2020, 1, 2))
+        Like.apply(self.ids["a"], like=[b_msg])
+        db.session.commit()
+
+        data = self.as_user("a", "get", "/api/v1/feed").get_json()
+        self.assertEqual([msg['text'] for msg in data['messages']],
+                         ["by a", "by b"])
+        self.assertEqual([msg['liked'] for msg in data['messages']],
+                         [False, True])
+        self.assertEqual({user['username'] for user in data['users']},
+                         {"a", "b"})
+
+        data = self.client.get(
+            f"/api/v1/users/{self.ids['b']}/messages").get_json()
+        self.assertEqual([msg['id'] for msg in data['messages']], [b_msg])
+        data = self.as_user(
+            "a", "get", f"/api/v1/users/{self.ids['a']}/likes").get_json()
+        self.assertEqual(data['users'][0]['username'], "b")
+
+    def test_unroutable_queries_raise(self):
+        with self.assertRaises(ShardError):
+            Message.query.all()
+        with shards.using(1):
+            with self.assertRaises(ShardError):
+                db.session.query(Message, User).join(User).all()
+            self.assertEqual(Message.query.all(), [])
+
+    def test_delete_account_across_shards(self):
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        a_msg = self.post("a", "by a", datetime(2020, 1, 2))
+        Like.apply(self.ids["a"], like=[b_msg])
+        Like.apply(self.ids["b"], like=[a_msg])
+        db.session.commit()
+
+        User.delete_account(self.ids["a"])
+        db.session.commit()
+
+        self.assertEqual(self.rows(db.engine, Message), [])
+        self.assertEqual(self.rows(db.engine, Like), [])
+        self.assertEqual(self.rows(shard_1, Like), [])
+        self.assertEqual(self.rows(shard_1, Message)[0].likes_count, 0)
+        self.assertEqual(User.query.get(self.ids["b"]).likes_count, 0)
+
+    def test_recompute_counts(self):
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        self.post("b", "more by b", datetime(2020, 1, 2))
+        Like.apply(self.ids["a"], like=[b_msg])
+        db.session.commit()
+        shard_1.execute(Message.__table__.update().values(likes_count=7))
+        User.query.update({User.messages_count: 0, User.likes_count: 0})
+
+        User.recompute_counts()
+        Message.recompute_counts()
+        db.session.commit()
+
+        self.assertEqual(User.query.get(self.ids["b"]).messages_count, 2)
+        self.assertEqual(User.query.get(self.ids["a"]).likes_count, 1)
+        self.assertEqual(
+            sorted(row.likes_count for row in self.rows(shard_1, Message)),
+            [0, 1])
+
+    def test_move_user(self):
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        Like.apply(self.ids["a"], like=[b_msg])
+        db.session.commit()
+
+        moved = shards.move_user(self.ids["b"], 0, wait=0, log=lambda m: None)
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(self.rows(shard_1, Message), [])
+        self.assertEqual(self.rows(shard_1, Like), [])
+        self.assertEqual([row.id for row in self.rows(db.engine, Message)],
+                         [b_msg])
+        self.assertEqual(self.rows(db.engine, Like)[0].msg_id, b_msg)
+        self.assertEqual(shards.shard_for(self.ids["b"]), 0)
+
+        resp = self.client.get(f"/users/{self.ids['b']}")
+        self.assertIn(b"by b", resp.data)
+
+    def test_move_user_keeps_writes_to_new_shard(self):
+        """Writes to either shard while workers notice the move survive."""
+
+        b_msg = self.post("b", "by b", datetime(2020, 1, 1))
+        doomed = self.post("b", "deleted meanwhile", datetime(2019, 1, 1))
+        Like.apply(self.ids["a"], like=[b_msg, doomed])
+        db.session.commit()
+        messages, likes = Message.__table__, Like.__table__
+
+        def meanwhile(line):
+            if "waiting" not in line:
+                return
+            # workers that have noticed write to the new shard...
+            self.post("b", "on new shard", datetime(2020, 1, 2))
+            Like.apply(self.ids["c"], like=[b_msg, doomed])
+            db.session.commit()
+            # ...and those that haven't, to the old one
+            shard_1.execute(likes.delete().where(likes.c.msg_id == doomed))
+            shard_1.execute(messages.delete().where(messages.c.id == doomed))
+            shard_1.execute(messages.update().values(text="edited"))
+            shard_1.execute(messages.insert().values(
+                id=shards.new_message_id(), text="on old shard",
+                user_id=self.ids["b"], timestamp=datetime(2020, 1, 3)))
+
+        shards.move_user(self.ids["b"], 0, wait=0, log=meanwhile)
+
+        self.assertEqual(
+            sorted(row.text for row in self.rows(db.engine, Message)),
+            ["edited", "on new shard", "on old shard"])
+        self.assertEqual(
+            sorted((row.msg_id, row.user_id)
+                   for row in self.rows(db.engine, Like)),
+            [(b_msg, self.ids["a"]), (b_msg, self.ids["c"])])
+        self.assertEqual(self.rows(shard_1, Message), [])
+
+    def test_plan_moves(self):
+        loads = {0: {1: 50, 2: 30, 3: 20}, 1: {4: 10}}
+
+        # 50 is nearest half the 90 gap; after it, 60 to 50 is close enough
+        self.assertEqual(plan_moves(loads), [(1, 0, 1)])
+        self.assertEqual(plan_moves({0: {1: 5}, 1: {2: 5}}), [])
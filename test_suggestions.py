@@ -0,0 +1,118 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Suggestion
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, session_users, timelines
+import suggestions
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class SuggestionTestCase(TestCase):
+    """Batch scoring, serving and incremental updates."""
+
+    def setUp(self):
+        Suggestion.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        self.client = app.test_client()
+
+        users = [
+            User(username=name, email=f"{name}@test.com",
+                 password="HASHED_PASSWORD")
+            for name in "abcdef"
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+
+        for follower, followee in ("ab", "bc", "bd", "eb", "ed"):
+            FollowersFollowee.add(self.ids[follower], self.ids[followee])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def suggested(self, name):
+        return [
+            user.username
+            for user in Suggestion.for_user(self.ids[name], 10)
+        ]
+
+    def compute(self, **kwargs):
+        kwargs.setdefault('top_n', 10)
+        kwargs.setdefault('celebrity_threshold', 100)
+        return suggestions.compute(log=lambda msg: None, **kwargs)
+
+    def as_user(self, name, method, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[name]
+            return getattr(c, method)(url)
+
+    def test_batch(self):
+        """Friends of friends first, co-follows adding to them."""
+
+        self.compute()
+
+        # d: followed by a's followee b, and by e, who also follows b
+        self.assertEqual(self.suggested("a"), ["d", "c"])
+        # e follows b too, so b's followee c; d's already followed
+        self.assertEqual(self.suggested("e"), ["c"])
+        self.assertEqual(self.suggested("f"), [])
+
+    def test_batch_blocks_and_top_n(self):
+        """Scoring in small blocks gives the same, trimmed, answer."""
+
+        self.compute(top_n=1, block_rows=2)
+
+        self.assertEqual(self.suggested("a"), ["d"])
+        self.assertEqual(Suggestion.query.filter_by(
+            user_id=self.ids["a"]).count(), 1)
+
+    def test_celebrities_skipped_for_co_follows(self):
+        self.compute(celebrity_threshold=2)
+
+        # b has two followers, so sharing b doesn't make a and e alike
+        a_scores = {
+            s.suggested_id: s.score
+            for s in Suggestion.query.filter_by(user_id=self.ids["a"])
+        }
+        self.assertEqual(a_scores, {self.ids["c"]: 1.0, self.ids["d"]: 1.0})
+
+    def test_follow_updates_incrementally(self):
+        self.compute()
+
+        self.as_user("f", "post", f"/users/follow/{self.ids['b']}")
+        self.assertEqual(self.suggested("f"), ["c", "d"])
+
+        self.as_user("a", "post", f"/users/follow/{self.ids['d']}")
+        self.assertEqual(self.suggested("a"), ["c"])
+
+    def test_home_aside(self):
+        self.compute()
+
+        resp = self.as_user("a", "get", "/")
+        self.assertIn(b"Who to follow", resp.data)
+        self.assertIn(b"@d", resp.data)
+        self.assertIn(f'action="/users/follow/{self.ids["c"]}"'.encode(),
+                      resp.data)
@@ -0,0 +1,238 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, timelines
+from timeline import MemoryTimelineStore, SQLiteTimelineStore
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class TimelineStoreTestCase(TestCase):
+    """Behaviour shared by every timeline store."""
+
+    def check_store(self, store):
+        self.assertIsNone(store.get(1))
+
+        # pushes skip timelines that haven't been materialized
+        store.push([1], (10.0, 100, 7), 3)
+        self.assertIsNone(store.get(1))
+
+        store.put(1, [(10.0, 100, 7), (30.0, 300, 8)])
+        store.push([1], (20.0, 200, 7), 3)
+        store.push([1], (40.0, 400, 8), 3)
+
+        self.assertEqual([e[1] for e in store.get(1)], [400, 300, 200])
+
+        store.remove([1], 300)
+        self.assertEqual([e[1] for e in store.get(1)], [400, 200])
+
+        store.remove_author(1, 8)
+        self.assertEqual([e[1] for e in store.get(1)], [200])
+
+        store.add_celebrity(5)
+        self.assertEqual(store.celebrities(), {5})
+
+        store.drop(1)
+        self.assertIsNone(store.get(1))
+
+        # removing from a full (maybe trimmed) timeline drops it...
+        store.put(1, [(10, 100, 7), (20, 200, 8)])
+        store.remove([1], 300, 2)
+        store.remove_author(1, 9, 2)
+        self.assertEqual(len(store.get(1)), 2)
+        store.remove_author(1, 8, 2)
+        self.assertIsNone(store.get(1))
+        # ...but not from a shorter one
+        store.put(1, [(10, 100, 7), (20, 200, 8)])
+        store.remove([1], 200, 3)
+        self.assertEqual(store.get(1), [(10, 100, 7)])
+
+    def test_memory_store(self):
+        self.check_store(MemoryTimelineStore())
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_store(
+                SQLiteTimelineStore(os.path.join(tmp, "timelines.db")))
+
+    def test_sqlite_store_old_format(self):
+        """A store from before integer timestamps is emptied, not misread."""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "timelines.db")
+            store = SQLiteTimelineStore(path)
+            store.put(1, [(10.0, 100, 7)])
+            store._conn.execute("PRAGMA user_version = 1")
+
+            store = SQLiteTimelineStore(path)
+            self.assertIsNone(store.get(1))
+
+            store.put(1, [(10, 100, 7)])
+            self.assertEqual(SQLiteTimelineStore(path).get(1), [(10, 100, 7)])
+
+
+class TimelineViewTestCase(TestCase):
+    """Fan-out and pruning through the routes."""
+
+    def setUp(self):
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        reader.following.append(author)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+    def tearDown(self):
+        timelines.store.clear()
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 10000
+        app.config['TIMELINE_LENGTH'] = 800
+        timelines.init_app(app)
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def feed_texts(self):
+        return [msg.text for msg in timelines.feed(self.reader_id)]
+
+    def test_post_fans_out(self):
+        """Does a new message land on the follower's timeline?"""
+
+        self.assertEqual(self.feed_texts(), [])
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "first"})
+            c.post("/messages/new", data={"text": "second"})
+
+        self.assertEqual(
+            [e[1] for e in timelines.store.get(self.reader_id)],
+            [m.id for m in Message.query.order_by(Message.id.desc())])
+        self.assertEqual(self.feed_texts(), ["second", "first"])
+
+    def test_delete_prunes(self):
+        """Does deleting a message remove it from follower timelines?"""
+
+        self.feed_texts()
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "oops"})
+            msg_id = Message.query.one().id
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(timelines.store.get(self.reader_id), [])
+
+    def test_unfollow_prunes(self):
+        """Does unfollowing remove that author's messages?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "hello"})
+
+        self.assertEqual(self.feed_texts(), ["hello"])
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/stop-following/{self.author_id}")
+
+        self.assertEqual(timelines.store.get(self.reader_id), [])
+
+    def test_delete_account_prunes(self):
+        """Does deleting an account remove its messages from followers'?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "hello"})
+
+        self.assertEqual(self.feed_texts(), ["hello"])
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/users/delete")
+
+        self.assertEqual(timelines.store.get(self.reader_id), [])
+        self.assertIsNone(timelines.store.get(self.author_id))
+
+    def test_unfollow_trimmed_timeline(self):
+        """Older messages trimmed off a full timeline still show once the
+        newer ones are pruned."""
+
+        app.config['TIMELINE_LENGTH'] = 10
+        timelines.init_app(app)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        other_id = other.id
+        FollowersFollowee.add(self.reader_id, other_id)
+
+        base = datetime(2020, 1, 1)
+        db.session.add_all(
+            [Message(text=f"old {n}", user_id=other_id,
+                     timestamp=base + timedelta(minutes=n))
+             for n in range(20)] +
+            [Message(text=f"new {n}", user_id=self.author_id,
+                     timestamp=base + timedelta(days=1, minutes=n))
+             for n in range(10)])
+        db.session.commit()
+        self.assertEqual(len(timelines.entries(self.reader_id, 30)), 30)
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/stop-following/{self.author_id}")
+
+        self.assertEqual(
+            [e[2] for e in timelines.entries(self.reader_id, 30)],
+            [other_id] * 20)
+
+    def test_celebrity_merged_at_read(self):
+        """Are celebrity messages merged in rather than fanned out?"""
+
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 1
+        timelines.init_app(app)
+        self.feed_texts()
+
+        base = datetime(2020, 1, 1)
+        own = Message(text="mine", user_id=self.reader_id, timestamp=base)
+        db.session.add(own)
+        db.session.commit()
+        timelines.fan_out(own)
+
+        famous = Message(
+            text="famous",
+            user_id=self.author_id,
+            timestamp=base + timedelta(minutes=1))
+        db.session.add(famous)
+        db.session.commit()
+        timelines.fan_out(famous)
+
+        self.assertIn(self.author_id, timelines.store.celebrities())
+        self.assertEqual(
+            [e[1] for e in timelines.store.get(self.reader_id)], [own.id])
+        self.assertEqual(self.feed_texts(), ["famous", "mine"])
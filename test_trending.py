@@ -0,0 +1,175 @@
+"""Trending hashtag and message tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, session_users, timelines, trending
+from trending import SlidingCounter, Trending, hashtags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['ENFORCE_QUERY_BUDGETS'] = True
+
+
+class SlidingCounterTestCase(TestCase):
+    """The windowed counts on their own."""
+
+    def test_hashtags(self):
+        self.assertEqual(
+            hashtags("#Flask and #flask, #py3 but not a#b or ##x"),
+            ["flask", "py3"])
+        self.assertEqual(hashtags(None), [])
+
+    def test_window_slides(self):
+        counter = SlidingCounter(width=10, size=3)
+        counter.add("a", 1, now=0)
+        counter.add("a", 1, now=15)
+        counter.add("b", 3, now=25)
+
+        self.assertEqual(counter.top(5, now=29), [("b", 3), ("a", 2)])
+        # the first bucket (0-10s) has left the window
+        self.assertEqual(counter.top(5, now=30), [("b", 3), ("a", 1)])
+        self.assertEqual(counter.top(5, now=60), [])
+        self.assertEqual(len(counter), 0)
+
+    def test_checkpoint_round_trip(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "trending.json")
+        other = Flask(__name__)
+        other.config['TRENDING_CHECKPOINT'] = path
+
+        before = Trending(other)
+        msg = Message(id=1, text="#a #b")
+        before.record_post(msg)
+        before.record_likes([msg])
+        before.checkpoint()
+
+        after = Trending(other)
+        self.assertEqual(after.snapshot.hashtags[0], ("a", 2))
+        self.assertEqual(after.snapshot.messages, [(1, 1)])
+
+        # restored later than the window, there's nothing left
+        self.assertTrue(after.restore(now=time.time() + 3600))
+        self.assertEqual(after.snapshot.hashtags, [])
+
+    def test_checkpoint_per_process(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        other = Flask(__name__)
+        other.config['TRENDING_CHECKPOINT'] = os.path.join(
+            directory, "trending.json")
+        own = os.path.join(directory, f"trending-{os.getpid()}.json")
+
+        worker = Trending(other)
+        worker.record_post(Message(id=1, text="#a"))
+        worker.checkpoint()
+        # as if saved by two other workers instead
+        for pid in (1, 2):
+            shutil.copy(own, os.path.join(directory, f"trending-{pid}.json"))
+        os.unlink(own)
+
+        restarted = Trending(other)
+        self.assertEqual(restarted.snapshot.hashtags, [("a", 2)])
+
+        # what's saved is just this process's own
+        restarted.record_post(Message(id=2, text="#b"))
+        restarted.checkpoint()
+        with open(own) as f:
+            self.assertEqual(
+                [counts for _, counts in json.load(f)['tags']], [[["b", 1]]])
+
+        # files with nothing left in the window are cleared up
+        restarted.restore(now=time.time() + 3600)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_checkpoint_relative_path(self):
+        """Restarted with the same pid, a process's own file is its own."""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            other = Flask(__name__)
+            other.config['TRENDING_CHECKPOINT'] = "trending.json"
+            for tag in "abc":
+                worker = Trending(other)
+                worker.record_post(Message(id=1, text=f"#{tag}"))
+                worker.checkpoint()
+        finally:
+            os.chdir(cwd)
+
+        with open(os.path.join(directory,
+                               f"trending-{os.getpid()}.json")) as f:
+            counts = [count for _, counts in json.load(f)['tags']
+                      for count in counts]
+        self.assertEqual(sorted(counts), [["a", 1], ["b", 1], ["c", 1]])
+
+
+class TrendingViewsTestCase(TestCase):
+    """Posting and liking feed the trending page."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+        trending.clear()
+
+        self.client = app.test_client()
+
+        user = User(username="testuser", email="test@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def as_user(self, method, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            return getattr(c, method)(url, **kwargs)
+
+    def test_posts_and_likes(self):
+        for text in ("#warble on", "more #Warble #news", "#news"):
+            self.as_user("post", "/messages/new", data={"text": text})
+        msg_ids = [msg.id for msg in Message.query.order_by(Message.id)]
+
+        self.as_user("post", f"/messages/{msg_ids[2]}/like")
+        self.as_user("post", "/likes", json={"like": msg_ids[:2]})
+        self.as_user("post", "/likes", json={"unlike": msg_ids[:1]})
+
+        snapshot = trending.refresh()
+        self.assertEqual(snapshot.hashtags, [("news", 4), ("warble", 3)])
+        self.assertEqual(
+            sorted(snapshot.messages), [(msg_ids[1], 1), (msg_ids[2], 1)])
+
+        resp = self.as_user("get", "/trending")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"#news", resp.data)
+        self.assertIn(b"<p>more #Warble #news</p>", resp.data)
+        self.assertNotIn(b"<p>#warble on</p>", resp.data)
+
+        resp = self.as_user("get", "/")
+        self.assertIn(b"Trending now", resp.data)
+        self.assertIn(b'href="/search?q=warble"', resp.data)
@@ -0,0 +1,144 @@
+"""Session user cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, session_users, timelines
+from query_counter import count_queries
+from user_cache import MemoryUserCache, SQLiteUserCache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Run background jobs at the end of each request, so their effects show
+app.config['JOBS_INLINE'] = True
+
+
+class UserCacheBackendTestCase(TestCase):
+    """Snapshot cache backends."""
+
+    def check_cache(self, cache):
+        self.assertIsNone(cache.get(1))
+
+        cache.set(1, {"id": 1})
+        cache.set(2, {"id": 2})
+        self.assertEqual(cache.get(1), {"id": 1})
+
+        # 2 is now least recently used / first to expire
+        cache.set(3, {"id": 3})
+        self.assertEqual(cache.get(3), {"id": 3})
+
+        cache.delete([3])
+        self.assertIsNone(cache.get(3))
+
+    def test_memory_lru(self):
+        cache = MemoryUserCache(max_size=2, ttl=60)
+        self.check_cache(cache)
+        self.assertIsNone(cache.get(2))
+
+    def test_memory_ttl(self):
+        cache = MemoryUserCache(max_size=2, ttl=0.01)
+        cache.set(1, {"id": 1})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLiteUserCache(
+                os.path.join(tmp, "users.db"), max_size=2, ttl=60)
+            self.check_cache(cache)
+
+
+class SessionUserTestCase(TestCase):
+    """`g.user` comes from the cache and is invalidated on change."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        timelines.store.clear()
+        session_users.cache.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_no_query_on_cache_hit(self):
+        """Does a cached user skip the database on a redirect?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get("/logout")
+            self.login(c)
+
+            with count_queries() as counter:
+                resp = c.get("/logout")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(counter.count, 0)
+
+    def test_edit_invalidates(self):
+        """Does editing the profile refresh the snapshot?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get("/")
+            self.assertEqual(
+                session_users.cache.get(self.user_id)["username"], "cached")
+
+            c.post(f"/users/{self.user_id}/edit", data={
+                "username": "renamed",
+                "email": "cached@test.com",
+                "password": "password",
+            })
+            self.assertIsNone(session_users.cache.get(self.user_id))
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("@renamed", html)
+
+    def test_follow_invalidates(self):
+        """Do follow changes refresh both users' counts?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get("/")
+            session_users.get(self.other_id)
+
+            c.post(f"/users/follow/{self.other_id}")
+
+        self.assertEqual(session_users.get(self.user_id).following_count, 1)
+        self.assertEqual(session_users.get(self.other_id).followers_count, 1)
+
+    def test_deleted_user_logged_out(self):
+        """Does a deleted user's snapshot go away?"""
+
+        with self.client as c:
+            self.login(c)
+            c.get("/")
+            c.post("/users/delete")
+
+        self.assertIsNone(session_users.get(self.user_id))
@@ -147,3 +147,20 @@ class UserModelTestCase(TestCase):
         self.assertEqual(autheticate_new_user, False)
         
 
+
+    def test_is_following_lookup(self):
+        """Do is_following / is_followed_by agree with the relationships?"""
+
+        self.assertTrue(self.user1.is_following(self.user2))
+        self.assertFalse(self.user2.is_following(self.user1))
+        self.assertTrue(self.user2.is_followed_by(self.user1))
+        self.assertFalse(self.user1.is_followed_by(self.user2))
+
+    def test_following_among(self):
+        """Does following_among pick out just the followed ids?"""
+
+        ids = [self.user1.id, self.user2.id, self.new_user.id]
+
+        self.assertEqual(self.user1.following_among(ids), {self.user2.id})
+        self.assertEqual(self.user2.following_among(ids), set())
+        self.assertEqual(self.user1.following_among([]), set())
@@ -0,0 +1,523 @@
+"""Materialized home timelines for Warbler.
+
+Instead of rebuilding the home feed with an `IN (...)` query over everyone a
+user follows, each new message is pushed onto its followers' timelines when
+it is posted ("fan-out on write"). Reading the feed is then a single lookup
+in the timeline store.
+
+Accounts with at least CELEBRITY_FOLLOWER_THRESHOLD followers are not fanned
+out (that would mean thousands of writes per post); their recent messages
+are merged into the feed at read time instead.
+
+Timelines are stored as newest-first lists of `(timestamp, msg_id,
+author_id)` entries, bounded to TIMELINE_LENGTH. Timestamps are integer
+microseconds, so an entry's first two fields double as a pagination cursor.
+The store is picked with TIMELINE_STORE_URL:
+
+    memory://               per-process dict (default; fine for one worker)
+    sqlite:////path/to.db   local file shared by every worker on the box
+"""
+
+import heapq
+import sqlite3
+import threading
+
+from models import db, FollowersFollowee, Message
+from pagination import message_key, newest_messages
+from shards import merge
+
+
+def entry_for(msg):
+    """Timeline entry for message `msg`."""
+
+    return message_key(msg) + (msg.user_id, )
+
+
+def entry_key(entry):
+    """Sort position (and cursor) of timeline `entry`: `(timestamp, id)`."""
+
+    return entry[:2]
+
+
+def _sort_key(entry):
+    """Newest first: negate (timestamp, id) so ascending sorts work."""
+
+    return (-entry[0], -entry[1])
+
+
+def _insert(entries, entry):
+    """Insert `entry` into newest-first `entries`, skipping duplicates."""
+
+    key = _sort_key(entry)
+    lo, hi = 0, len(entries)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _sort_key(entries[mid]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    if lo < len(entries) and entries[lo][1] == entry[1]:
+        return
+    entries.insert(lo, entry)
+
+
+##############################################################################
+# Stores
+
+
+class TimelineStore:
+    """Interface for timeline storage backends.
+
+    A user's timeline is either *materialized* (possibly empty) or missing;
+    `get()` returns None for a missing timeline so the caller can rebuild it.
+    Pushes only go to materialized timelines -- the rest get rebuilt from the
+    database when next read.
+
+    A timeline of fewer than `length` entries holds every message it could;
+    a full one may have been trimmed. Removing from a full timeline (given
+    its `length`) drops it instead, as what's left could end short of older
+    messages that were trimmed off.
+    """
+
+    def get(self, user_id):
+        """Return `user_id`'s entries newest-first, or None if missing."""
+
+        raise NotImplementedError
+
+    def put(self, user_id, entries):
+        """Replace `user_id`'s timeline with `entries`."""
+
+        raise NotImplementedError
+
+    def push(self, user_ids, entry, length):
+        """Add `entry` to each materialized timeline in `user_ids`."""
+
+        raise NotImplementedError
+
+    def remove(self, user_ids, msg_id, length=None):
+        """Remove message `msg_id` from the timelines of `user_ids`."""
+
+        raise NotImplementedError
+
+    def remove_author(self, user_id, author_id, length=None):
+        """Remove every message by `author_id` from `user_id`'s timeline."""
+
+        raise NotImplementedError
+
+    def drop(self, user_id):
+        """Forget `user_id`'s timeline; it is rebuilt on the next read."""
+
+        raise NotImplementedError
+
+    def add_celebrity(self, user_id):
+        """Mark `user_id` as merged at read time rather than fanned out."""
+
+        raise NotImplementedError
+
+    def celebrities(self):
+        """Set of user ids marked with `add_celebrity()`."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all timelines and celebrity marks."""
+
+        raise NotImplementedError
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Timelines kept in a dict in this process."""
+
+    def __init__(self):
+        self._timelines = {}
+        self._celebrities = set()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entries = self._timelines.get(user_id)
+            return None if entries is None else list(entries)
+
+    def put(self, user_id, entries):
+        with self._lock:
+            self._timelines[user_id] = sorted(entries, key=_sort_key)
+
+    def push(self, user_ids, entry, length):
+        with self._lock:
+            for user_id in user_ids:
+                entries = self._timelines.get(user_id)
+                if entries is None:
+                    continue
+                _insert(entries, entry)
+                del entries[length:]
+
+    def _remove(self, user_id, keep, length):
+        entries = self._timelines.get(user_id)
+        if not entries:
+            return
+        kept = [e for e in entries if keep(e)]
+        if length is not None and len(entries) >= length > len(kept):
+            del self._timelines[user_id]
+        else:
+            entries[:] = kept
+
+    def remove(self, user_ids, msg_id, length=None):
+        with self._lock:
+            for user_id in user_ids:
+                self._remove(user_id, lambda e: e[1] != msg_id, length)
+
+    def remove_author(self, user_id, author_id, length=None):
+        with self._lock:
+            self._remove(user_id, lambda e: e[2] != author_id, length)
+
+    def drop(self, user_id):
+        with self._lock:
+            self._timelines.pop(user_id, None)
+
+    def add_celebrity(self, user_id):
+        with self._lock:
+            self._celebrities.add(user_id)
+
+    def celebrities(self):
+        with self._lock:
+            return set(self._celebrities)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+            self._celebrities.clear()
+
+
+class SQLiteTimelineStore(TimelineStore):
+    """Timelines kept in a local SQLite file, shared by all workers.
+
+    The file's `user_version` is the entry FORMAT. A file in any other
+    format (1: float-second timestamps) is emptied when opened; timelines
+    are rebuilt from the database as they're read.
+    """
+
+    FORMAT = 2
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS timelines (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            user_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            msg_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, msg_id)
+        );
+        CREATE INDEX IF NOT EXISTS timeline_entries_order
+            ON timeline_entries (user_id, ts DESC, msg_id DESC);
+        CREATE TABLE IF NOT EXISTS celebrities (
+            user_id INTEGER PRIMARY KEY
+        );
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            (version, ), = self._conn.execute("PRAGMA user_version")
+            if version != self.FORMAT:
+                for table in ("timeline_entries", "timelines", "celebrities"):
+                    self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self._conn.execute(f"PRAGMA user_version = {self.FORMAT}")
+            self._conn.execute("COMMIT")
+            self._conn.executescript(self.SCHEMA)
+
+    def _write(self, statements):
+        """Run `(sql, params)` pairs in one transaction."""
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def get(self, user_id):
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM timelines WHERE user_id = ?",
+                (user_id, )).fetchone()
+            if not exists:
+                return None
+            return [
+                tuple(row) for row in self._conn.execute(
+                    "SELECT ts, msg_id, author_id FROM timeline_entries "
+                    "WHERE user_id = ? ORDER BY ts DESC, msg_id DESC",
+                    (user_id, ))
+            ]
+
+    def put(self, user_id, entries):
+        statements = [
+            ("DELETE FROM timeline_entries WHERE user_id = ?", (user_id, )),
+            ("INSERT OR IGNORE INTO timelines (user_id) VALUES (?)",
+             (user_id, )),
+        ]
+        statements.extend(
+            ("INSERT OR REPLACE INTO timeline_entries VALUES (?, ?, ?, ?)",
+             (user_id, ) + tuple(entry)) for entry in entries)
+        self._write(statements)
+
+    def push(self, user_ids, entry, length):
+        statements = []
+        for user_id in user_ids:
+            statements.append((
+                "INSERT OR REPLACE INTO timeline_entries "
+                "SELECT user_id, ?, ?, ? FROM timelines WHERE user_id = ?",
+                tuple(entry) + (user_id, )))
+            statements.append((
+                "DELETE FROM timeline_entries WHERE user_id = ? AND msg_id "
+                "NOT IN (SELECT msg_id FROM timeline_entries WHERE user_id = ?"
+                " ORDER BY ts DESC, msg_id DESC LIMIT ?)",
+                (user_id, user_id, length)))
+        self._write(statements)
+
+    def _removals(self, user_id, column, value, length):
+        """Statements removing `user_id`'s entries with `column` = `value`,
+        dropping the timeline if it was `length` long."""
+
+        statements = []
+        if length is not None:
+            statements.append((
+                "DELETE FROM timelines WHERE user_id = ? AND EXISTS (SELECT 1 "
+                f"FROM timeline_entries WHERE user_id = ? AND {column} = ?) "
+                "AND (SELECT COUNT(*) FROM timeline_entries WHERE user_id = ?)"
+                " >= ?", (user_id, user_id, value, user_id, length)))
+        statements.append((
+            f"DELETE FROM timeline_entries WHERE user_id = ? AND ({column} = ?"
+            " OR NOT EXISTS (SELECT 1 FROM timelines WHERE user_id = ?))",
+            (user_id, value, user_id)))
+        return statements
+
+    def remove(self, user_ids, msg_id, length=None):
+        self._write(
+            statement for user_id in user_ids
+            for statement in self._removals(user_id, "msg_id", msg_id, length))
+
+    def remove_author(self, user_id, author_id, length=None):
+        self._write(self._removals(user_id, "author_id", author_id, length))
+
+    def drop(self, user_id):
+        self._write([
+            ("DELETE FROM timeline_entries WHERE user_id = ?", (user_id, )),
+            ("DELETE FROM timelines WHERE user_id = ?", (user_id, )),
+        ])
+
+    def add_celebrity(self, user_id):
+        self._write([("INSERT OR IGNORE INTO celebrities VALUES (?)",
+                      (user_id, ))])
+
+    def celebrities(self):
+        with self._lock:
+            return {
+                row[0]
+                for row in self._conn.execute("SELECT user_id FROM celebrities")
+            }
+
+    def clear(self):
+        self._write([
+            ("DELETE FROM timeline_entries", ()),
+            ("DELETE FROM timelines", ()),
+            ("DELETE FROM celebrities", ()),
+        ])
+
+
+def store_from_url(url):
+    """Build the timeline store named by `url`."""
+
+    if url == "memory://":
+        return MemoryTimelineStore()
+
+    if url.startswith("sqlite:///"):
+        return SQLiteTimelineStore(url[len("sqlite:///"):])
+
+    raise ValueError(f"Unknown timeline store: {url}")
+
+
+##############################################################################
+# Fan-out / read path
+
+
+class Timelines:
+    """Fan-out-on-write home timelines, wired up like `db`.
+
+        timelines = Timelines()
+        timelines.init_app(app)
+    """
+
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_STORE_URL', 'memory://')
+        app.config.setdefault('TIMELINE_LENGTH', 800)
+        app.config.setdefault('CELEBRITY_FOLLOWER_THRESHOLD', 10000)
+
+        self.store = store_from_url(app.config['TIMELINE_STORE_URL'])
+        self.length = app.config['TIMELINE_LENGTH']
+        self.celebrity_threshold = app.config['CELEBRITY_FOLLOWER_THRESHOLD']
+
+    def add_own(self, msg):
+        """Put newly-posted `msg` on its author's own timeline, so they see
+        it straight away; `fan_out()` (run later) does their followers'."""
+
+        self.store.push([msg.user_id], entry_for(msg), self.length)
+
+    def fan_out(self, msg):
+        """Push newly-posted `msg` onto its author's followers' timelines."""
+
+        follower_ids = [
+            row[0] for row in FollowersFollowee.follower_ids(msg.user_id)
+        ]
+
+        if len(follower_ids) >= self.celebrity_threshold:
+            # Merged at read time instead; see `feed()`.
+            self.store.add_celebrity(msg.user_id)
+            follower_ids = []
+
+        self.store.push(follower_ids + [msg.user_id], entry_for(msg),
+                        self.length)
+
+    def remove_message(self, msg_id, author_id):
+        """Prune deleted message `msg_id` from every timeline holding it."""
+
+        follower_ids = [
+            row[0] for row in FollowersFollowee.follower_ids(author_id)
+        ]
+        self.store.remove(follower_ids + [author_id], msg_id, self.length)
+
+    def follow(self, user_id, followee_id):
+        """`user_id` started following `followee_id`.
+
+        The followee's back catalogue needs merging in, so simply drop the
+        timeline and let the next read rebuild it.
+        """
+
+        self.store.drop(user_id)
+
+    def unfollow(self, user_id, followee_id):
+        """`user_id` stopped following `followee_id`: prune their messages."""
+
+        self.store.remove_author(user_id, followee_id, self.length)
+
+    def forget_user(self, user_id, follower_ids):
+        """Drop a deleted user's own timeline, and prune their messages from
+        their (former) followers' `follower_ids`."""
+
+        self.store.drop(user_id)
+        for follower_id in follower_ids:
+            self.store.remove_author(follower_id, user_id, self.length)
+
+    def rebuild(self, user_id):
+        """Materialize `user_id`'s timeline from the database."""
+
+        entries = self._from_db(self._author_ids(user_id), None, self.length)
+        self.store.put(user_id, entries)
+        return entries
+
+    def _author_ids(self, user_id):
+        """`user_id` plus everyone they follow."""
+
+        return [row[0] for row in FollowersFollowee.following_ids(user_id)
+                ] + [user_id]
+
+    def _from_db(self, author_ids, before, limit):
+        """Entries for the newest `limit` messages by `author_ids`.
+
+        Sharded, the authors' shards are queried in parallel and their
+        entries merged.
+        """
+
+        by_shard = {}
+        for author_id, shard in db.shards.shards_for(author_ids).items():
+            by_shard.setdefault(shard, []).append(author_id)
+
+        def newest(shard):
+            query = Message.visible().with_entities(
+                Message.timestamp, Message.id, Message.user_id).filter(
+                    Message.user_id.in_(by_shard[shard]))
+            return [
+                entry_for(row)
+                for row in newest_messages(query, before, limit)
+            ]
+
+        return merge(
+            db.shards.gather(newest, sorted(by_shard)),
+            entry_key, limit)
+
+    def entries(self, user_id, limit, before=None):
+        """`limit` feed entries for `user_id` older than cursor `before`.
+
+        Reads come from the materialized timeline, with celebrities merged in.
+        Scrolling past the end of a full (trimmed) timeline carries on with
+        a keyset query against the database.
+        """
+
+        stored = self.store.get(user_id)
+        if stored is None:
+            stored = self.rebuild(user_id)
+
+        entries = stored
+        if before is not None:
+            entries = [e for e in stored if e[:2] < tuple(before)]
+
+        sources = [entries]
+
+        if len(stored) >= self.length and len(entries) < limit:
+            oldest = entries[-1][:2] if entries else before
+            sources.append(
+                self._from_db(self._author_ids(user_id), oldest, limit))
+
+        celebrities = self.store.celebrities()
+        if celebrities:
+            followed = [
+                row[0] for row in FollowersFollowee.following_ids(user_id)
+                .filter(FollowersFollowee.follower_id.in_(celebrities))
+            ]
+            if followed:
+                sources.append(self._from_db(followed, before, limit))
+
+        merged = []
+        seen = set()
+        for entry in heapq.merge(*sources, key=_sort_key):
+            if entry[1] not in seen:
+                seen.add(entry[1])
+                merged.append(entry)
+                if len(merged) == limit:
+                    break
+
+        return merged
+
+    def feed(self, user_id, limit=100, before=None):
+        """Messages for `user_id`'s home feed, newest first."""
+
+        return self.messages(self.entries(user_id, limit, before))
+
+    def messages(self, entries, columns=None):
+        """The messages for feed `entries`, in order -- or, given `columns`,
+        rows of just those (including Message.id), without authors."""
+
+        ids = [entry[1] for entry in entries]
+        query = Message.visible()
+        if columns is not None:
+            query = query.with_entities(*columns)
+
+        # Messages deleted or hidden since they were fanned out simply drop
+        # out here.
+        by_id = db.shards.load_messages(
+            ids, query, author_ids={entry[2] for entry in entries},
+            authors=columns is None)
+        return [by_id[msg_id] for msg_id in ids if msg_id in by_id]
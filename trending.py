@@ -0,0 +1,320 @@
+"""Trending hashtags and messages over a sliding window.
+
+Activity is counted in time buckets -- TRENDING_BUCKET_SECONDS wide, the
+last TRENDING_WINDOW_BUCKETS of them making up the window:
+
+    hashtags    a post using the tag, or a like of a message using it
+    messages    a like (an unlike takes one back)
+
+Each `SlidingCounter` keeps one dict per non-empty bucket plus running
+totals over the window; expired buckets are subtracted from the totals as
+the window slides, so recording is O(1) per key. Every
+TRENDING_REFRESH_SECONDS a background thread picks the top
+TRENDING_SIZE of each into a snapshot, which is all a request reads.
+
+Counts live in each process. Set TRENDING_CHECKPOINT to a path, say
+trending.json, and each process saves its buckets to its own file beside it
+(trending-PID.json) every TRENDING_CHECKPOINT_SECONDS, and app.py saves it
+on exit too. On start a process loads every such file, so a restart keeps
+the whole window.
+"""
+
+import heapq
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+HASHTAG_RE = re.compile(r"(?<![\w#])#(\w{1,50})", re.UNICODE)
+
+POST_WEIGHT = 1
+LIKE_WEIGHT = 1
+
+CHECKPOINT_VERSION = 1
+
+Snapshot = namedtuple('Snapshot', 'hashtags messages refreshed_at')
+
+
+def hashtags(text):
+    """Distinct lowercased hashtags in `text`, in order of appearance."""
+
+    return list(
+        dict.fromkeys(tag.lower() for tag in HASHTAG_RE.findall(text or '')))
+
+
+class SlidingCounter:
+    """Counts per key over the last `size` buckets of `width` seconds."""
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self._buckets = deque()  # (bucket number, {key: count}), oldest first
+        self.totals = Counter()
+        self._others = {}  # bucket number: {key: count} loaded as others'
+
+    def _advance(self, now):
+        """Drop buckets that have left the window; return the current one."""
+
+        current = int(now // self.width)
+        while self._buckets and self._buckets[0][0] <= current - self.size:
+            number, counts = self._buckets.popleft()
+            self._others.pop(number, None)
+            for key, count in counts.items():
+                total = self.totals[key] - count
+                if total:
+                    self.totals[key] = total
+                else:
+                    del self.totals[key]
+
+        if not self._buckets or self._buckets[-1][0] != current:
+            self._buckets.append((current, {}))
+        return self._buckets[-1][1]
+
+    def add(self, key, count, now):
+        bucket = self._advance(now)
+        bucket[key] = bucket.get(key, 0) + count
+        self.totals[key] += count
+
+    def top(self, n, now):
+        """The `n` keys with the highest positive totals, highest first."""
+
+        self._advance(now)
+        return heapq.nlargest(
+            n, ((key, total) for key, total in self.totals.items()
+                if total > 0),
+            key=lambda item: item[1])
+
+    def dump(self):
+        """The buckets, less what was loaded as `others`."""
+
+        dumped = []
+        for number, counts in self._buckets:
+            others = self._others.get(number, {})
+            own = [(key, count - others.get(key, 0))
+                   for key, count in counts.items()
+                   if count != others.get(key, 0)]
+            if own:
+                dumped.append([number, own])
+        return dumped
+
+    def load(self, buckets, now, others=()):
+        """Replace the counts with `dump()`ed `buckets`, plus `others`:
+        buckets dumped by other processes, counted but not dumped again."""
+
+        self._buckets.clear()
+        self.totals.clear()
+        self._others = {}
+        merged = {}
+        for number, counts in buckets:
+            merged.setdefault(number, Counter()).update(dict(counts))
+        for number, counts in others:
+            merged.setdefault(number, Counter()).update(dict(counts))
+            self._others.setdefault(number, Counter()).update(dict(counts))
+        for number in sorted(merged):
+            self._buckets.append((number, dict(merged[number])))
+            self.totals.update(merged[number])
+        self._advance(now)
+
+    def __len__(self):
+        return len(self.totals)
+
+
+class Trending:
+    """Sliding-window trending lists, wired up like `db`.
+
+        trending = Trending()
+        trending.init_app(app)
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.checkpointed_at = None
+        self.checkpoint_file = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDING_BUCKET_SECONDS', 60)
+        app.config.setdefault('TRENDING_WINDOW_BUCKETS', 60)
+        app.config.setdefault('TRENDING_SIZE', 10)
+        app.config.setdefault('TRENDING_REFRESH_SECONDS', 10)
+        app.config.setdefault('TRENDING_CHECKPOINT', None)
+        app.config.setdefault('TRENDING_CHECKPOINT_SECONDS', 60)
+
+        self.app = app
+        width = app.config['TRENDING_BUCKET_SECONDS']
+        size = app.config['TRENDING_WINDOW_BUCKETS']
+        self.tags = SlidingCounter(width, size)
+        self.messages = SlidingCounter(width, size)
+        self.snapshot = Snapshot([], [], None)
+
+        # resolved now, as the working directory may change later
+        path = app.config['TRENDING_CHECKPOINT']
+        self.checkpoint_file = os.path.abspath(path) if path else None
+        if self.checkpoint_file:
+            self.restore()
+
+    def record_post(self, msg, now=None):
+        """Count newly-posted `msg`'s hashtags."""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            for tag in hashtags(msg.text):
+                self.tags.add(tag, POST_WEIGHT, now)
+        self._start()
+
+    def record_likes(self, msgs, delta=1, now=None):
+        """Count a like (or, with `delta=-1`, an unlike) of each of `msgs`."""
+
+        now = time.time() if now is None else now
+        with self._lock:
+            for msg in msgs:
+                self.messages.add(msg.id, delta, now)
+                for tag in hashtags(msg.text):
+                    self.tags.add(tag, delta * LIKE_WEIGHT, now)
+        self._start()
+
+    def current(self):
+        """The latest `Snapshot` of what's trending."""
+
+        self._start()
+        return self.snapshot
+
+    def refresh(self, now=None):
+        """Recompute the snapshot from the window's totals."""
+
+        now = time.time() if now is None else now
+        n = self.app.config['TRENDING_SIZE']
+        with self._lock:
+            self.snapshot = Snapshot(
+                self.tags.top(n, now), self.messages.top(n, now), now)
+        return self.snapshot
+
+    def _checkpoint_path(self, pid=None):
+        """This process's checkpoint file (or process `pid`'s)."""
+
+        root, ext = os.path.splitext(self.checkpoint_file)
+        return f"{root}-{pid or os.getpid()}{ext}"
+
+    def _checkpoint_paths(self):
+        """Every process's checkpoint file."""
+
+        root, ext = os.path.splitext(self.checkpoint_file)
+        name = re.compile(
+            re.escape(os.path.basename(root)) + r'-\d+' + re.escape(ext) + '$')
+        directory = os.path.dirname(root)
+        try:
+            return [os.path.join(directory, entry)
+                    for entry in sorted(os.listdir(directory))
+                    if name.match(entry)]
+        except OSError:
+            return []
+
+    def checkpoint(self):
+        """Save this process's buckets to its TRENDING_CHECKPOINT file."""
+
+        if not self.checkpoint_file:
+            return
+        path = self._checkpoint_path()
+
+        with self._lock:
+            state = dict(
+                version=CHECKPOINT_VERSION,
+                width=self.tags.width,
+                tags=self.tags.dump(),
+                messages=self.messages.dump())
+
+        # write a new file and rename it over the old one, so a crash
+        # mid-write leaves the previous checkpoint intact
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.checkpointed_at = time.time()
+
+    def restore(self, now=None):
+        """Load the buckets every process saved with `checkpoint()`, if any
+        still apply. Files with nothing left in the window are deleted."""
+
+        now = time.time() if now is None else now
+        oldest = int(now // self.tags.width) - self.tags.size
+        own = self._checkpoint_path()
+        mine, others = ([], []), ([], [])  # (tags, messages) buckets
+        found = False
+
+        for path in self._checkpoint_paths():
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if (state.get('version') != CHECKPOINT_VERSION
+                    or state.get('width') != self.tags.width):
+                continue
+
+            found = True
+            if all(number <= oldest
+                   for number, _ in state['tags'] + state['messages']):
+                os.unlink(path)
+                continue
+            tags, messages = mine if path == own else others
+            tags.extend(state['tags'])
+            messages.extend(state['messages'])
+
+        if not found:
+            return False
+
+        with self._lock:
+            self.tags.load(mine[0], now, others=others[0])
+            self.messages.load(mine[1], now, others=others[1])
+        self.refresh(now)
+        return True
+
+    def clear(self):
+        """Forget all counts."""
+
+        with self._lock:
+            self.tags.load([], 0)
+            self.messages.load([], 0)
+            self.snapshot = Snapshot([], [], None)
+
+    def _start(self):
+        """Start the refresh/checkpoint thread, the first time it's needed."""
+
+        if self._thread:
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='trending', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        refresh_every = self.app.config['TRENDING_REFRESH_SECONDS']
+        checkpoint_every = self.app.config['TRENDING_CHECKPOINT_SECONDS']
+        last_checkpoint = time.monotonic()
+
+        while True:
+            self.refresh()
+            if time.monotonic() - last_checkpoint >= checkpoint_every:
+                self.checkpoint()
+                last_checkpoint = time.monotonic()
+            time.sleep(refresh_every)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hashtags=len(self.tags),
+                messages=len(self.messages),
+                refreshed_at=self.snapshot.refreshed_at,
+                checkpointed_at=self.checkpointed_at)
@@ -0,0 +1,240 @@
+"""Cache of logged-in users, so `add_user_to_g` needn't hit the database.
+
+Every request used to load the full `User` row for the session's user, even
+for redirects and 404s. Instead `g.user` is now a `CurrentUser` snapshot of
+the handful of columns templates show, held in a bounded cache with a TTL.
+
+Routes that change what's in a snapshot call `session_users.invalidate()`
+for the users affected. Snapshots of *other* users whose counters change as
+a side effect (e.g. the followers of a deleted account) are left to expire,
+so those counts can lag by up to USER_CACHE_TTL seconds.
+
+The cache is picked with USER_CACHE_URL:
+
+    memory://               per-process LRU (default)
+    sqlite:////path/to.db   local file shared by every worker on the box
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from models import FollowersFollowee, User
+
+SNAPSHOT_FIELDS = [
+    'id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+    'messages_count', 'following_count', 'followers_count', 'likes_count'
+]
+
+
+class CurrentUser:
+    """Lightweight stand-in for the logged-in `User`.
+
+    Has the columns in SNAPSHOT_FIELDS plus the read-only follow checks;
+    routes that need to change the user should load the real `User`.
+    """
+
+    def __init__(self, **fields):
+        for name in SNAPSHOT_FIELDS:
+            setattr(self, name, fields.get(name))
+        self._following = {}
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(**{name: getattr(user, name) for name in SNAPSHOT_FIELDS})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in SNAPSHOT_FIELDS}
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`? Remembered per snapshot,
+        so a view and its template can both ask for one query."""
+
+        if other_user.id not in self._following:
+            self._following[other_user.id] = FollowersFollowee.exists(
+                self.id, other_user.id)
+        return self._following[other_user.id]
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set."""
+
+        return FollowersFollowee.following_among(self.id, user_ids)
+
+
+##############################################################################
+# Backends
+
+
+class UserCache:
+    """Interface for snapshot cache backends; values are plain dicts."""
+
+    def get(self, user_id):
+        """Cached snapshot dict for `user_id`, or None."""
+
+        raise NotImplementedError
+
+    def set(self, user_id, snapshot):
+        """Cache `snapshot` for `user_id`."""
+
+        raise NotImplementedError
+
+    def delete(self, user_ids):
+        """Forget the snapshots of `user_ids`."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Forget every snapshot."""
+
+        raise NotImplementedError
+
+
+class MemoryUserCache(UserCache):
+    """LRU cache of at most `max_size` snapshots, each kept `ttl` seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, snapshot = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def set(self, user_id, snapshot):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteUserCache(UserCache):
+    """Snapshots kept in a local SQLite file, shared by all workers.
+
+    Holds at most `max_size` entries; the ones closest to expiry are evicted
+    first.
+    """
+
+    def __init__(self, path, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS user_snapshots (
+                    user_id INTEGER PRIMARY KEY,
+                    expires REAL NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS user_snapshots_expires
+                    ON user_snapshots (expires);
+            """)
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM user_snapshots "
+                "WHERE user_id = ? AND expires >= ?",
+                (user_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id, snapshot):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_snapshots VALUES (?, ?, ?)",
+                (user_id, time.time() + self.ttl, json.dumps(snapshot)))
+            self._conn.execute(
+                "DELETE FROM user_snapshots WHERE user_id IN ("
+                "SELECT user_id FROM user_snapshots "
+                "ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self.max_size, ))
+
+    def delete(self, user_ids):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM user_snapshots WHERE user_id = ?",
+                [(user_id, ) for user_id in user_ids])
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM user_snapshots")
+
+
+def cache_from_url(url, max_size, ttl):
+    """Build the snapshot cache named by `url`."""
+
+    if url == "memory://":
+        return MemoryUserCache(max_size, ttl)
+
+    if url.startswith("sqlite:///"):
+        return SQLiteUserCache(url[len("sqlite:///"):], max_size, ttl)
+
+    raise ValueError(f"Unknown user cache: {url}")
+
+
+##############################################################################
+# Lookups
+
+
+class SessionUsers:
+    """Cached `CurrentUser` lookups, wired up like `db`."""
+
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_URL', 'memory://')
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+
+        self.cache = cache_from_url(app.config['USER_CACHE_URL'],
+                                    app.config['USER_CACHE_SIZE'],
+                                    app.config['USER_CACHE_TTL'])
+
+    def get(self, user_id):
+        """`CurrentUser` for `user_id`, or None if there's no such user."""
+
+        snapshot = self.cache.get(user_id)
+
+        if snapshot is None:
+            user = User.query.get(user_id)
+            if user is None:
+                return None
+            snapshot = CurrentUser.from_user(user).to_dict()
+            self.cache.set(user_id, snapshot)
+
+        return CurrentUser(**snapshot)
+
+    def invalidate(self, *user_ids):
+        """Drop the cached snapshots of `user_ids`."""
+
+        self.cache.delete(user_ids)